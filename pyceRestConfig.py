@@ -28,3 +28,145 @@ ce_volume_create_options['nas']['security_style']                = 'unix'
 # Options maxfiles setting
 ce_vol_maxfiles         = "75000000"
 
+
+# Optional unix socket path used by the pyce_rest daemon ("-o serve") and
+# its clients ("--client").  Defaults to a per-user path in the temp dir.
+#ce_daemon_socket        = "/tmp/pyce_rest.sock"
+
+# Optional default number of operations run concurrently by "-o batch".
+#ce_workers              = 8
+
+# Optional name to uuid cache for volumes, snapshots and snapmirror
+# relationships.  Entries expire after ce_uuid_cache_ttl seconds (0 disables
+# the cache) and at most ce_uuid_cache_size entries are kept.  The cache is
+# stored under $XDG_CACHE_HOME/pyce_rest unless ce_uuid_cache_path is set.
+# list_snapshots, delete_snapshot and update_mirror use it; create_snapshot
+# always looks the volume up, since a renamed volume could leave its old
+# name cached for another volume.
+ce_uuid_cache_ttl       = 3600
+ce_uuid_cache_size      = 10000
+#ce_uuid_cache_path      = "/var/tmp/pyce_rest_uuid_cache.sqlite"
+
+# Optional job polling settings for deferred jobs ("--no-wait", "wait_jobs"
+# and "create_clones"), in seconds.  ce_job_poll_interval is also the poll
+# interval of the jobs that an operation waits for itself.
+#ce_job_poll_interval    = 2
+#ce_job_poll_timeout     = 600
+
+# Optional REST port and scheme, for example to use a pyce_mock.py server.
+#ce_port                 = 8080
+#ce_scheme               = "http"
+
+# Optional metrics file written at the end of every run, as with
+# "--metrics-file".  Names ending in ".prom" are written as a Prometheus
+# textfile, for example for the node_exporter textfile collector, and any
+# other name as JSON.
+#ce_metrics_file         = "/var/lib/node_exporter/textfile/pyce_rest.prom"
+
+# Optional number of records requested per page by the list operations, as
+# with "--page-size".  Larger pages mean fewer REST calls, smaller pages mean
+# less memory and an earlier first row.  0 leaves the page size to the
+# cluster, which returns up to 10000 records per page.
+#ce_page_size            = 500
+
+# Optional settings for "list_mirrors --watch".  While a transfer is running,
+# the relationships are polled every ce_watch_interval seconds (as with
+# "--interval").  When nothing changes, the wait doubles up to
+# ce_watch_max_interval seconds.  The last ce_watch_history polls of each
+# relationship are kept for the transfer rates and lag trends.
+#ce_watch_interval       = 5
+#ce_watch_max_interval   = 60
+#ce_watch_history        = 10
+
+# Optional transfer tracking settings for "update_mirrors --wait", in
+# seconds.  Transfers still running after ce_transfer_timeout seconds are
+# reported as timed out.
+#ce_transfer_poll_interval = 5
+#ce_transfer_timeout       = 3600
+
+# Optional named volume templates for "--template", used by create_volume,
+# create_volumes and batch manifests.  Each template is merged over
+# ce_volume_create_options, and may set files.maximum in place of
+# ce_vol_maxfiles.
+#ce_volume_templates = {
+#    "scratch": {"size": "500g"},
+#    "home":    {"size": "100g", "files": {"maximum": 5000000},
+#                "snapshot_policy": {"name": "default"}},
+#}
+
+# Optional clone pools for checkout_clone, return_clone, fill_pool and
+# pool_status.  Each pool keeps "size" ready clones of the parent "volume"
+# and "snapshot", named "pool_<name>_..." unless a "prefix" is given.  The
+# hit and miss counts are kept in ce_clone_pool_db, which defaults to a
+# file next to the uuid cache.
+#ce_clone_pools = {
+#    "ci": {"volume": "build", "snapshot": "nightly", "size": 8},
+#}
+#ce_clone_pool_db        = "/var/tmp/pyce_rest_clone_pools.sqlite"
+
+# Optional HTTP connection settings.  ce_http_pool_size is the number of
+# connections kept open for reuse, by default the number of workers (and at
+# least 10).  With ce_http_pool_block, threads wait for a free connection
+# instead of opening extra ones that are closed after use.  ce_http_sessions
+# is "shared" for one session for all threads, or "thread" for a session and
+# pool per thread.  ce_http_keepalive = False closes every connection after
+# its request.  ce_http_timeout is the (connect, read) timeout in seconds.
+# ce_http_gzip = False asks the cluster not to compress responses.
+#ce_http_pool_size       = 64
+#ce_http_pool_block      = False
+#ce_http_sessions        = "shared"
+#ce_http_keepalive       = True
+#ce_http_timeout         = (6, 45)
+#ce_http_gzip            = True
+
+# Optional settings for throttled or overloaded clusters.  The REST calls in
+# flight on a connection are limited to what the cluster keeps up with.  The
+# limit starts at ce_concurrency_start (by default the HTTP pool size).  It
+# is halved on every 429 or 503 response, busy job queue or connection
+# error, and grows again by one call at a time.  It also shrinks when calls
+# get ce_concurrency_latency_factor times slower than the fastest calls to
+# the same endpoint.  Throttled calls are retried up to ce_retry_attempts
+# times, after a random backoff of up to ce_retry_backoff * 2^attempt
+# seconds (at most ce_retry_max_backoff).  After ce_breaker_threshold
+# throttled calls at a limit of one, all calls pause for
+# ce_breaker_cooldown seconds, doubling up to ce_breaker_max_cooldown.
+# Calls fail once the pause has lasted ce_breaker_timeout seconds.
+# ce_adaptive_concurrency = False turns all of this off.
+#ce_adaptive_concurrency = True
+#ce_concurrency_start    = 8
+#ce_concurrency_latency_factor = 3
+#ce_retry_attempts       = 5
+#ce_retry_backoff        = 0.5
+#ce_retry_max_backoff    = 30
+#ce_breaker_threshold    = 5
+#ce_breaker_cooldown     = 5
+#ce_breaker_max_cooldown = 60
+#ce_breaker_timeout      = 300
+
+# Optional host-wide rate limits, shared by every pyce_rest process on this
+# host.  Each cluster (as named in ce_cluster or ce_targets, or "*" for any
+# other) gets "rate" REST calls per second, and up to "burst" calls at once
+# after a quiet spell.  The token buckets are small files in
+# ce_rate_limit_dir, which defaults to a per-user directory in the temp dir.
+# Processes of several users can share a limit through a directory that is
+# writable by all of them.
+#ce_rate_limits = {
+#    "cluster-east": {"rate": 20, "burst": 40},
+#    "*":            {"rate": 50, "burst": 100},
+#}
+#ce_rate_limit_dir       = "/var/tmp/pyce_rest_rate_limits"
+
+# Optional list of cluster and SVM targets for "--targets".  A list
+# operation run with "--targets all" or "--targets name,..." queries the
+# targets in parallel and prints their records as one list, tagged with the
+# cluster and SVM.  Any other operation takes a single target in place of
+# ce_cluster and ce_vserver.  The user, passwd, port and scheme of a target
+# default to the settings above.  A target that has not finished its listing
+# after ce_target_timeout seconds (or its own "timeout") is reported as
+# timed out, without holding up the other targets.
+#ce_targets = [
+#    {"name": "east", "cluster": "cluster-east", "vserver": "vs1"},
+#    {"name": "west", "cluster": "cluster-west", "vserver": "vs_build",
+#     "user": "admin", "passwd": "netapp123", "timeout": 120},
+#]
+#ce_target_timeout       = 60
@@ -0,0 +1,547 @@
+#!/usr/bin/env python3
+
+################################################################################
+#
+# Benchmark harness for pyce_rest (pyce_bench)
+#
+# Starts a pyce_mock ONTAP server in-process, runs every pyce_rest.py
+# operation against it, and reports the wall time, REST call count and bytes
+# transferred for each one.  Every operation runs as its own pyce_rest.py
+# process, just as it would from a build script, so the wall time includes
+# startup.
+#
+# Each run is appended to a results file together with the pyce_rest version,
+# the git commit and the mock settings.  The report compares every operation
+# with the previous run that used the same settings and flags regressions.
+#
+# Run "./pyce_bench.py -h" to see usage.
+#
+################################################################################
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import tempfile
+import datetime
+import subprocess
+from optparse import OptionParser
+
+import pyce_mock
+import pyceRestConfig
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+pyce_rest_path = os.path.join(bench_dir, "pyce_rest.py")
+
+# Runs pyce_rest.py with the pyceRestConfig.py from the current directory.
+runner = "import runpy, sys; sys.argv[0] = %r; runpy.run_path(%r, run_name='__main__')" % \
+         (pyce_rest_path, pyce_rest_path)
+
+# Runs pyce_rest.py like runner, then writes its peak memory use in kB to
+# stderr.  On Linux ru_maxrss survives fork() and exec(), so it would report
+# the benchmark's own (mock sized) memory use.  VmHWM does not.
+memory_runner = """import resource
+try:
+    %s
+finally:
+    try:
+        with open("/proc/self/status") as status:
+            maxrss = [line.split()[1] for line in status if line.startswith("VmHWM:")][0]
+    except OSError:
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == "darwin":
+            maxrss = int(maxrss) // 1024
+    sys.stderr.write("maxrss %%s\\n" %% maxrss)
+""" % runner.replace("; ", "\n    ")
+
+# Mock settings that are recorded with each run.
+settings_names = ["volumes", "snapshots", "clones", "mirrors", "latency",
+                  "job_seconds", "clone_count", "batch_size"]
+
+
+# Exit status of scenarios that are expected to fail.
+expected_status = {"startup_error": 2}
+
+
+def scenarios(options, manifest, state):
+    # The operations to run, in order.  Later operations use the objects
+    # created by earlier ones.  The startup scenarios make no REST calls and
+    # guard how quickly help and option errors are returned.
+    return [
+        ("startup_help", ["-h"]),
+        ("startup_error", ["-o", "list_volumes"]),
+        ("list_volumes", ["-o", "list_volumes", "-v", "vol"]),
+        ("capacity_report", ["-o", "capacity_report"]),
+        ("create_volume", ["-o", "create_volume", "-v", "bench_vol", "-j", "/bench_vol"]),
+        ("create_volumes", ["-o", "create_volumes", "-v", "bench_bulk_{n}",
+                            "-n", str(options.clone_count), "-j", "/bench_bulk/{name}"]),
+        ("remount_volume", ["-o", "remount_volume", "-v", "bench_vol", "-j", "/bench"]),
+        ("create_snapshot", ["-o", "create_snapshot", "-v", "bench_vol", "-s", "bench_snap"]),
+        ("list_snapshots", ["-o", "list_snapshots", "-v", "bench_vol"]),
+        ("list_svm_snapshots", ["-o", "list_snapshots", "-v", "*", "--sort", "volume"]),
+        ("delete_snapshot", ["-o", "delete_snapshot", "-v", "vol00002", "-s", "hourly.1"]),
+        ("prune_snapshots", ["-o", "prune_snapshots", "-v", "vol001*", "--match",
+                             "^hourly\\.[1-4]$", "--keep", "3", "--workers", "16"]),
+        ("create_clone", ["-o", "create_clone", "-v", "bench_vol", "-s", "bench_snap",
+                          "-c", "bench_clone", "-j", "/bench_clone"]),
+        ("create_clones", ["-o", "create_clones", "-v", "bench_vol", "-s", "bench_snap",
+                           "-n", str(options.clone_count), "-c", "bench_fan_{n}",
+                           "-j", "/bench_fan/{name}"]),
+        ("list_clones", ["-o", "list_clones", "-c", "clone"]),
+        ("list_clone_tree", ["-o", "list_clones", "-v", "bench_vol"]),
+        ("fill_pool", ["-o", "fill_pool", "--pool", "bench"]),
+        ("checkout_clone", ["-o", "checkout_clone", "--pool", "bench", "-c", "bench_ci",
+                            "-j", "/bench_ci"]),
+        ("return_clone", ["-o", "return_clone", "--pool", "bench", "-c", "bench_ci"]),
+        ("delete_volume", ["-o", "delete_volume", "-v", "bench_clone"]),
+        ("create_mirror", ["-o", "create_mirror", "-v", "bench_vol", "-m", "bench_mirror"]),
+        ("update_mirror", ["-o", "update_mirror", "-m", "bench_mirror"]),
+        ("update_mirrors", ["-o", "update_mirrors", "-m", "vol*_mirror", "--wait"]),
+        ("list_mirrors", ["-o", "list_mirrors"]),
+        ("delete_mirror", ["-o", "delete_mirror", "-m", "bench_mirror"]),
+        ("batch", ["-o", "batch", "-f", manifest]),
+        ("reconcile", ["-o", "reconcile", "-f", state]),
+        ("reconcile_converged", ["-o", "reconcile", "-f", state]),
+        ("delete_volume_tree", ["-o", "delete_volume", "-v", "bench_vol", "--recursive"]),
+    ]
+
+
+def write_config(directory, port, page_size=None, settings=()):
+    # Write a pyceRestConfig.py that points at the mock, keeping the volume
+    # create options from the real configuration.
+    lines = [
+        'ce_cluster = "127.0.0.1"',
+        'ce_port = %d' % port,
+        'ce_scheme = "http"',
+        'ce_user = "vsadmin"',
+        'ce_passwd = "bench"',
+        'ce_vserver = "vs1"',
+        'ce_volume_create_options = %r' % pyceRestConfig.ce_volume_create_options,
+        'ce_vol_maxfiles = %r' % getattr(pyceRestConfig, "ce_vol_maxfiles", "0"),
+        'ce_uuid_cache_ttl = 3600',
+        'ce_uuid_cache_path = %r' % os.path.join(directory, "uuid_cache.sqlite"),
+        'ce_job_poll_interval = 0.1',
+        'ce_transfer_poll_interval = 0.1',
+        'ce_clone_pools = {"bench": {"volume": "bench_vol", "snapshot": "bench_snap", '
+        '"size": 4}}',
+    ]
+    if page_size is not None:
+        lines.append('ce_page_size = %d' % page_size)
+    lines.extend(settings)
+    with open(os.path.join(directory, "pyceRestConfig.py"), "w") as config:
+        config.write("\n".join(lines) + "\n")
+
+
+def write_manifest(directory, size):
+    path = os.path.join(directory, "batch.jsonl")
+    with open(path, "w") as manifest:
+        for n in range(1, size + 1):
+            request = {"operation": "create_snapshot",
+                       "volume": "vol%05d" % n, "snapshot": "bench_batch"}
+            manifest.write(json.dumps(request) + "\n")
+    return path
+
+
+def write_state(directory, size):
+    # A reconcile desired state file with size volumes, each with a snapshot
+    # and a clone of it.
+    volumes = []
+    clones = []
+    for n in range(1, size + 1):
+        volumes.append({"volume": "bench_env_%d" % n, "junction": "/bench_env/%d" % n,
+                        "snapshots": ["gold"]})
+        clones.append({"clone": "bench_env_%d_ci" % n, "volume": "bench_env_%d" % n,
+                       "snapshot": "gold", "junction": "/bench_env/%d_ci" % n})
+    path = os.path.join(directory, "state.json")
+    with open(path, "w") as state:
+        json.dump({"volumes": volumes, "clones": clones}, state, indent=1)
+    return path
+
+
+def run_scenario(server, directory, args):
+    server.cluster.reset_stats()
+    start = time.time()
+    process = subprocess.run([sys.executable, "-c", runner] + args, cwd=directory,
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    seconds = time.time() - start
+    stats = server.cluster.stats_dict()
+    return {
+        "status": process.returncode,
+        "seconds": round(seconds, 4),
+        "calls": stats["calls"],
+        "bytes_in": stats["bytes_in"],
+        "bytes_out": stats["bytes_out"],
+        "endpoints": stats["endpoints"],
+    }, process.stdout.decode("utf-8", "replace")
+
+
+def run_streaming(sizes, page_size, latency):
+    # List every volume of mocks of increasing size and report the time to
+    # the first row, the total time and the peak memory use of pyce_rest.
+    # With streaming pagination the first row time and peak memory should
+    # stay about the same for every size.
+    print("%10s %10s %10s %12s %10s %14s" % \
+          ("Volumes", "Page Size", "Rows", "First Row", "Total", "Peak RSS (MB)"))
+    print("-" * 72)
+    for size in sizes:
+        server = pyce_mock.start(volumes=size, snapshots=0, clones=0, mirrors=0,
+                                 latency=latency)
+        directory = tempfile.mkdtemp(prefix="pyce_bench.")
+        try:
+            write_config(directory, server.server_address[1], page_size)
+            start = time.time()
+            process = subprocess.Popen([sys.executable, "-c", memory_runner,
+                                        "-o", "list_volumes", "-v", "vol"],
+                                       cwd=directory, stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE)
+            # Rows follow the dashed line under the header.
+            first_row = None
+            rows = 0
+            header = True
+            for line in process.stdout:
+                if header:
+                    header = not line.startswith(b"---")
+                    continue
+                if first_row is None:
+                    first_row = time.time() - start
+                rows += 1
+            maxrss = 0
+            for line in process.stderr.read().decode().splitlines():
+                if line.startswith("maxrss "):
+                    maxrss = int(line.split()[1])
+            process.wait()
+            seconds = time.time() - start
+        finally:
+            server.shutdown()
+            shutil.rmtree(directory)
+        print("%10d %10s %10d %12.3f %10.3f %14.1f" % \
+              (size, page_size or "cluster", rows, first_row or 0, seconds, maxrss / 1024.0))
+
+
+# Connection settings compared by the connection benchmark.
+connection_settings = [
+    ("no keep-alive", ["ce_http_keepalive = False"]),
+    ("pool of 10", ["ce_http_pool_size = 10"]),
+    ("shared pool", []),
+    ("thread sessions", ['ce_http_sessions = "thread"']),
+]
+
+
+def run_connections(worker_counts, requests, latency, tls):
+    # Run a batch of single GET operations at each worker count with each of
+    # the connection settings, and report the throughput and the number of
+    # connections the mock accepted.  "pool of 10" is the netapp_ontap
+    # default, which opens a new connection for most calls once there are
+    # more than 10 workers.  With tls, every new connection also costs a
+    # TLS handshake.
+    directory = tempfile.mkdtemp(prefix="pyce_bench.")
+    certfile = None
+    settings = []
+    if tls:
+        certfile = os.path.join(directory, "mock.pem")
+        subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+                        "-subj", "/CN=localhost", "-days", "1",
+                        "-keyout", certfile, "-out", certfile + ".crt"],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        with open(certfile, "a") as pem, open(certfile + ".crt") as crt:
+            pem.write(crt.read())
+        settings.append('ce_scheme = "https"')
+    server = pyce_mock.start(volumes=100, snapshots=0, clones=0, mirrors=0,
+                             latency=latency, gzip=True, certfile=certfile)
+    manifest = os.path.join(directory, "connections.jsonl")
+    with open(manifest, "w") as requests_file:
+        for n in range(requests):
+            request = {"operation": "list_volumes", "volume": "vol%05d" % (n % 100 + 1)}
+            requests_file.write(json.dumps(request) + "\n")
+
+    print("%8s %-16s %10s %10s %12s" % ("Workers", "Setting", "Seconds", "Calls/s",
+                                        "Connections"))
+    print("-" * 60)
+    try:
+        for workers in worker_counts:
+            for name, lines in connection_settings:
+                write_config(directory, server.server_address[1], settings=settings + lines)
+                server.cluster.reset_stats()
+                start = time.time()
+                subprocess.run([sys.executable, "-c", runner, "-o", "batch", "-f", manifest,
+                                "--workers", str(workers)], cwd=directory,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                seconds = time.time() - start
+                stats = server.cluster.stats_dict()
+                print("%8d %-16s %10.3f %10.1f %12d" % (workers, name, seconds,
+                      stats["calls"] / seconds, stats["connections"]))
+    finally:
+        server.shutdown()
+        shutil.rmtree(directory)
+
+
+# Settings compared by the throttling benchmark.
+throttling_settings = [
+    ("no limiter", ["ce_adaptive_concurrency = False"]),
+    ("adaptive", []),
+]
+
+
+def run_throttling(workers, requests, max_inflight, latency):
+    # Run a batch of single GET operations against a mock that returns 429
+    # above max_inflight concurrent requests, with and without the adaptive
+    # concurrency limiter, and report how many operations succeeded and the
+    # throughput of the successful ones.
+    directory = tempfile.mkdtemp(prefix="pyce_bench.")
+    server = pyce_mock.start(volumes=100, snapshots=0, clones=0, mirrors=0,
+                             latency=latency, max_inflight=max_inflight)
+    manifest = os.path.join(directory, "throttling.jsonl")
+    with open(manifest, "w") as requests_file:
+        for n in range(requests):
+            request = {"operation": "list_volumes", "volume": "vol%05d" % (n % 100 + 1)}
+            requests_file.write(json.dumps(request) + "\n")
+
+    print("%8s %-12s %10s %10s %10s %10s" % ("Workers", "Setting", "Seconds", "Succeeded",
+                                            "Ops/s", "429s"))
+    print("-" * 65)
+    try:
+        for name, lines in throttling_settings:
+            write_config(directory, server.server_address[1], settings=lines)
+            server.cluster.reset_stats()
+            start = time.time()
+            process = subprocess.run([sys.executable, "-c", runner, "-o", "batch", "-f",
+                                      manifest, "--workers", str(workers)], cwd=directory,
+                                     stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            seconds = time.time() - start
+            stats = server.cluster.stats_dict()
+            match = re.search(r"(\d+) succeeded", process.stdout.decode("utf-8", "replace"))
+            succeeded = int(match.group(1)) if match else 0
+            print("%8d %-12s %10.3f %10d %10.1f %10d" % (workers, name, seconds, succeeded,
+                  succeeded / seconds, stats["errors"]))
+    finally:
+        server.shutdown()
+        shutil.rmtree(directory)
+
+
+def run_rate_limit(processes, requests, rate, burst, latency):
+    # Start processes batches of list operations at once, sharing a
+    # host-wide rate limit of rate calls per second, and report the rate the
+    # mock saw.
+    directory = tempfile.mkdtemp(prefix="pyce_bench.")
+    server = pyce_mock.start(volumes=100, snapshots=0, clones=0, mirrors=0,
+                             latency=latency)
+    manifest = os.path.join(directory, "rate_limit.jsonl")
+    with open(manifest, "w") as requests_file:
+        for n in range(requests // processes):
+            request = {"operation": "list_volumes", "volume": "vol%05d" % (n % 100 + 1)}
+            requests_file.write(json.dumps(request) + "\n")
+
+    print("%10s %10s %10s %10s %10s" % ("Processes", "Limit", "Calls", "Seconds", "Calls/s"))
+    print("-" * 54)
+    try:
+        for limit in [None, rate]:
+            settings = ['ce_rate_limit_dir = %r' % os.path.join(directory, "rate_limits")]
+            if limit:
+                settings.append('ce_rate_limits = {"127.0.0.1": {"rate": %r, "burst": %r}}' % \
+                                (limit, burst))
+            write_config(directory, server.server_address[1], settings=settings)
+            server.cluster.reset_stats()
+            start = time.time()
+            running = [subprocess.Popen([sys.executable, "-c", runner, "-o", "batch", "-f",
+                                         manifest, "--workers", "4"], cwd=directory,
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                       for n in range(processes)]
+            for process in running:
+                process.wait()
+            seconds = time.time() - start
+            calls = server.cluster.stats_dict()["calls"]
+            print("%10d %10s %10d %10.3f %10.1f" % (processes, limit or "none", calls,
+                                                    seconds, calls / seconds))
+    finally:
+        server.shutdown()
+        shutil.rmtree(directory)
+
+
+def pyce_rest_version():
+    with open(pyce_rest_path) as source:
+        match = re.search(r'^version\s*=\s*"([^"]*)"', source.read(), re.M)
+    if match:
+        return match.group(1)
+    return ""
+
+
+def git_commit():
+    try:
+        process = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=bench_dir,
+                                 stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    except OSError:
+        return ""
+    return process.stdout.decode().strip()
+
+
+def load_results(path):
+    try:
+        with open(path) as results:
+            return json.load(results)
+    except (OSError, ValueError):
+        return []
+
+
+def previous_run(runs, settings):
+    for run in reversed(runs):
+        if run["settings"] == settings:
+            return run
+    return None
+
+
+def regressed(result, previous, tolerance):
+    # More REST calls or bytes is always a regression.  Wall time is allowed
+    # to vary by the tolerance, plus 50ms for process startup noise.
+    if previous is None:
+        return False
+    if result["calls"] > previous["calls"]:
+        return True
+    if result["bytes_in"] + result["bytes_out"] > \
+       previous["bytes_in"] + previous["bytes_out"]:
+        return True
+    return result["seconds"] > previous["seconds"] * (1 + tolerance) + 0.05
+
+
+def report(run, previous, tolerance):
+    print("%-16s %6s %9s %7s %10s %10s  %s" % \
+          ("Operation", "Status", "Seconds", "Calls", "Bytes In", "Bytes Out", "Previous"))
+    print("-" * 96)
+    regressions = []
+    for name, result in run["results"].items():
+        before = None
+        if previous:
+            before = previous["results"].get(name)
+        compared = ""
+        if before:
+            compared = "%.3fs %d calls" % (before["seconds"], before["calls"])
+            if regressed(result, before, tolerance):
+                compared += "  REGRESSION"
+                regressions.append(name)
+        print("%-16s %6s %9.3f %7d %10d %10d  %s" % \
+              (name, result["status"], result["seconds"], result["calls"],
+               result["bytes_in"], result["bytes_out"], compared))
+    return regressions
+
+
+# ---------------------------------------------------------------------------
+# MAIN
+# ---------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("--volumes", dest="volumes", type="int", default=1000,
+                      help="number of volumes in the mock")
+    parser.add_option("--snapshots", dest="snapshots", type="int", default=5,
+                      help="number of snapshots per volume in the mock")
+    parser.add_option("--clones", dest="clones", type="int", default=50,
+                      help="number of flexclones in the mock")
+    parser.add_option("--mirrors", dest="mirrors", type="int", default=10,
+                      help="number of snapmirror relationships in the mock")
+    parser.add_option("--latency", dest="latency", type="float", default=0.002,
+                      help="seconds added to every mock request")
+    parser.add_option("--job-seconds", dest="job_seconds", type="float", default=0.0,
+                      help="seconds until a mock job finishes")
+    parser.add_option("--clone-count", dest="clone_count", type="int", default=20,
+                      help="number of clones made by create_clones")
+    parser.add_option("--batch-size", dest="batch_size", type="int", default=20,
+                      help="number of operations in the batch manifest")
+    parser.add_option("--only", dest="only", help="comma separated operations to run")
+    parser.add_option("--results", dest="results", default="pyce_bench_results.json",
+                      help="file the results are stored in")
+    parser.add_option("--tolerance", dest="tolerance", type="float", default=0.25,
+                      help="allowed wall time increase before a regression")
+    parser.add_option("--no-save", dest="no_save", action="store_true",
+                      help="do not store the results of this run")
+    parser.add_option("--verbose", dest="verbose", action="store_true",
+                      help="print the output of each operation")
+    parser.add_option("--streaming", dest="streaming",
+                      help="only run the streaming list benchmark for these comma "
+                           "separated volume counts")
+    parser.add_option("--page-size", dest="page_size", type="int",
+                      help="ce_page_size for the streaming benchmark")
+    parser.add_option("--connections", dest="connections",
+                      help="only run the connection benchmark for these comma "
+                           "separated worker counts")
+    parser.add_option("--requests", dest="requests", type="int", default=1000,
+                      help="number of operations in the connection benchmark")
+    parser.add_option("--tls", dest="tls", action="store_true",
+                      help="serve HTTPS in the connection benchmark")
+    parser.add_option("--throttle", dest="throttle", type="int",
+                      help="only run the throttling benchmark against a mock that "
+                           "allows this many concurrent requests")
+    parser.add_option("--throttle-workers", dest="throttle_workers", type="int",
+                      default=32, help="number of workers in the throttling benchmark")
+    parser.add_option("--rate-limit", dest="rate_limit", type="float",
+                      help="only run the rate limit benchmark with this host-wide "
+                           "limit in calls per second")
+    parser.add_option("--processes", dest="processes", type="int", default=10,
+                      help="number of concurrent processes in the rate limit benchmark")
+    (options, args) = parser.parse_args()
+
+    if options.streaming:
+        page_size = options.page_size
+        if page_size is None:
+            page_size = getattr(pyceRestConfig, "ce_page_size", 500)
+        run_streaming([int(size) for size in options.streaming.split(",")],
+                      page_size, options.latency)
+        sys.exit(0)
+
+    if options.connections:
+        run_connections([int(workers) for workers in options.connections.split(",")],
+                        options.requests, options.latency, options.tls)
+        sys.exit(0)
+
+    if options.throttle:
+        run_throttling(options.throttle_workers, options.requests, options.throttle,
+                       options.latency)
+        sys.exit(0)
+
+    if options.rate_limit:
+        run_rate_limit(options.processes, options.requests, options.rate_limit,
+                       max(1, options.rate_limit // 4), options.latency)
+        sys.exit(0)
+
+    settings = {}
+    for name in settings_names:
+        settings[name] = getattr(options, name)
+    server = pyce_mock.start(volumes=options.volumes, snapshots=options.snapshots,
+                             clones=options.clones, mirrors=options.mirrors,
+                             latency=options.latency, job_seconds=options.job_seconds)
+    directory = tempfile.mkdtemp(prefix="pyce_bench.")
+    try:
+        write_config(directory, server.server_address[1])
+        manifest = write_manifest(directory, options.batch_size)
+        state = write_state(directory, options.batch_size)
+        run = {
+            "time": datetime.datetime.now().replace(microsecond=0).isoformat(),
+            "version": pyce_rest_version(),
+            "commit": git_commit(),
+            "settings": settings,
+            "results": {},
+        }
+        only = None
+        if options.only:
+            only = options.only.split(",")
+        for name, scenario_args in scenarios(options, manifest, state):
+            if only and name not in only:
+                continue
+            result, output = run_scenario(server, directory, scenario_args)
+            run["results"][name] = result
+            if options.verbose or result["status"] != expected_status.get(name, 0):
+                print(output)
+    finally:
+        server.shutdown()
+        shutil.rmtree(directory)
+
+    runs = load_results(options.results)
+    regressions = report(run, previous_run(runs, settings), options.tolerance)
+    if not options.no_save:
+        runs.append(run)
+        with open(options.results, "w") as results:
+            json.dump(runs, results, indent=1)
+    if regressions:
+        print("")
+        print("Regressions: " + ", ".join(regressions))
+        sys.exit(1)
@@ -0,0 +1,869 @@
+#!/usr/bin/env python3
+
+################################################################################
+#
+# Mock ONTAP REST server for pyce_rest (pyce_mock)
+#
+# This is a small, in-memory stand-in for the parts of the ONTAP REST API that
+# pyce_rest.py uses: volumes, snapshots, snapmirror relationships and
+# transfers, and jobs.  It is meant for measuring and regression testing
+# pyce_rest without a live cluster, and is used by pyce_bench.py.
+#
+# The server speaks HTTP with keep-alive, or HTTPS given a certificate, and
+# ignores credentials.  Responses are gzip compressed for clients that
+# accept it when "--gzip" is given.  It
+# supports the ONTAP query syntax that pyce_rest relies on ("*" wildcards,
+# "|" alternatives, "!" negation and "<", ">" comparisons), field selection
+# with "fields", "order_by" and paging with "max_records".  All mutating calls
+# return a job, which finishes after a configurable time.
+#
+# Latency, object counts and failure injection are set on the command line.
+# Per-endpoint call counts and byte totals are kept for every request and can
+# be fetched from "/mock/stats" and cleared with a POST to "/mock/reset".
+#
+# To point pyce_rest.py at the mock, set these in pyceRestConfig.py:
+#   ce_cluster = "127.0.0.1"
+#   ce_port    = 8080
+#   ce_scheme  = "http"
+#
+# Run "./pyce_mock.py -h" to see usage.
+#
+################################################################################
+
+import re
+import sys
+import gzip
+import json
+import time
+import uuid
+import random
+import fnmatch
+import datetime
+import threading
+import collections
+from optparse import OptionParser
+from urllib.parse import urlsplit, parse_qsl, urlencode, unquote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+GB = 1024 * 1024 * 1024
+
+# Query parameters that control a request rather than filter records.
+control_params = ["fields", "max_records", "order_by", "return_records",
+                  "return_timeout", "_offset"]
+
+def timestamp(seconds):
+    return datetime.datetime.fromtimestamp(seconds, datetime.timezone.utc) \
+        .replace(microsecond=0).isoformat()
+
+
+def parse_size(size):
+    # Accepts a byte count or an ONTAP style size such as "10240g".
+    size = str(size).lower()
+    units = {"k": 1024, "m": 1024 ** 2, "g": GB, "t": 1024 * GB}
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def merge(record, changes):
+    # Recursively merge a PATCH or POST body into a record.
+    for key, value in changes.items():
+        if isinstance(value, dict) and isinstance(record.get(key), dict):
+            merge(record[key], value)
+        else:
+            record[key] = value
+
+
+def values_at(record, path):
+    # Returns every value found at a dotted path, descending into lists.
+    values = [record]
+    for key in path.split("."):
+        found = []
+        for value in values:
+            if isinstance(value, list):
+                value = [item.get(key) for item in value if isinstance(item, dict)]
+                found.extend(item for item in value if item is not None)
+            elif isinstance(value, dict) and key in value:
+                found.append(value[key])
+        values = found
+    flat = []
+    for value in values:
+        if isinstance(value, list):
+            flat.extend(value)
+        else:
+            flat.append(value)
+    return flat
+
+
+def query_text(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
+
+
+def compare(value, operator, operand):
+    try:
+        value, operand = float(value), float(operand)
+    except (TypeError, ValueError):
+        value, operand = query_text(value), operand
+    if operator == "<=":
+        return value <= operand
+    if operator == ">=":
+        return value >= operand
+    if operator == "<":
+        return value < operand
+    return value > operand
+
+
+def matches_one(value, pattern):
+    for operator in ["<=", ">=", "<", ">"]:
+        if pattern.startswith(operator):
+            return compare(value, operator, pattern[len(operator):])
+    return fnmatch.fnmatchcase(query_text(value).lower(), pattern.lower())
+
+
+def matches(record, path, query):
+    # A record matches if any "|" alternative matches any value at the path.
+    values = values_at(record, path)
+    for pattern in query.split("|"):
+        if pattern.startswith("!"):
+            if not any(matches_one(value, pattern[1:]) for value in values):
+                return True
+        elif any(matches_one(value, pattern) for value in values):
+            return True
+    return False
+
+
+def project(record, fields, keys):
+    # Returns a copy of the record with just the key fields and the requested
+    # fields.  "*" or "**" selects every field.
+    if fields is None:
+        fields = []
+    else:
+        fields = [field.strip() for field in fields.split(",") if field.strip()]
+    if "*" in fields or "**" in fields:
+        return json.loads(json.dumps(record))
+    result = {}
+    for path in keys + fields:
+        source, target = record, result
+        parts = path.split(".")
+        for depth, key in enumerate(parts):
+            if not isinstance(source, dict) or key not in source:
+                break
+            if depth == len(parts) - 1:
+                target[key] = json.loads(json.dumps(source[key]))
+            else:
+                source = source[key]
+                if isinstance(source, list):
+                    target[key] = json.loads(json.dumps(source))
+                    break
+                target = target.setdefault(key, {})
+    return result
+
+
+class MockError(Exception):
+    def __init__(self, status, message, code="1"):
+        Exception.__init__(self, message)
+        self.status = status
+        self.code = code
+
+
+class MockCluster(object):
+    # The in-memory state of one SVM plus the request statistics.
+    def __init__(self, svm="vs1", volumes=100, snapshots=5, clones=10,
+                 mirrors=5, latency=0.0, jitter=0.0, fail_rate=0.0,
+                 job_seconds=0.0, job_fail_rate=0.0, transfer_seconds=1.0,
+                 max_inflight=0, page_size=10000, gzip=False, seed=1):
+        self.svm = {"name": svm, "uuid": str(uuid.UUID(int=1))}
+        self.latency = latency
+        self.jitter = jitter
+        self.fail_rate = fail_rate
+        self.job_seconds = job_seconds
+        self.job_fail_rate = job_fail_rate
+        self.transfer_seconds = transfer_seconds
+        self.max_inflight = max_inflight
+        self.page_size = page_size
+        self.gzip = gzip
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.inflight = 0
+        self.volumes = collections.OrderedDict()
+        self.volume_names = {}
+        # Filtered and sorted records of the last collection queries, reused
+        # for their next pages until something changes.
+        self.generation = 0
+        self.pages = {}
+        self.snapshots = {}
+        self.relationships = collections.OrderedDict()
+        self.transfers = {}
+        self.jobs = {}
+        self.reset_stats()
+        self.populate(volumes, snapshots, clones, mirrors)
+
+    # -- statistics --------------------------------------------------------
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {
+                "calls": 0,
+                "bytes_in": 0,
+                "bytes_out": 0,
+                "connections": 0,
+                "errors": 0,
+                "endpoints": collections.Counter(),
+            }
+
+    def stats_dict(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["endpoints"] = dict(self.stats["endpoints"])
+        return stats
+
+    def record_call(self, method, path, bytes_in, bytes_out, status):
+        endpoint = re.sub(r"/[0-9a-f]{8}-[0-9a-f-]{27}", "/{uuid}", path)
+        with self.lock:
+            self.stats["calls"] += 1
+            self.stats["bytes_in"] += bytes_in
+            self.stats["bytes_out"] += bytes_out
+            self.stats["endpoints"][method + " " + endpoint] += 1
+            if status >= 400:
+                self.stats["errors"] += 1
+
+    # -- initial objects ---------------------------------------------------
+
+    def new_uuid(self):
+        return str(uuid.UUID(int=self.random.getrandbits(128), version=4))
+
+    def populate(self, volumes, snapshots, clones, mirrors):
+        now = time.time()
+        for n in range(1, volumes + 1):
+            size = self.random.choice([100, 500, 1024, 10240]) * GB
+            volume = self.add_volume({
+                "name": "vol%05d" % n,
+                "size": size,
+                "nas": {"path": "/vol%05d" % n},
+            })
+            volume["space"]["used"] = int(size * self.random.random())
+            for s in range(snapshots):
+                self.add_snapshot(volume, "hourly.%d" % s,
+                                  now - 3600 * (snapshots - s))
+        parents = list(self.volumes.values())
+        for n in range(1, min(clones, len(parents) * snapshots) + 1):
+            parent = parents[(n - 1) % len(parents)]
+            snapshot = list(self.snapshots[parent["uuid"]].values())[0]
+            self.add_volume({
+                "name": "clone%05d" % n,
+                "nas": {"path": "/clone%05d" % n},
+                "clone": {
+                    "is_flexclone": True,
+                    "parent_volume": {"name": parent["name"]},
+                    "parent_snapshot": {"name": snapshot["name"]},
+                },
+            })
+        for n in range(1, min(mirrors, len(parents)) + 1):
+            source = parents[n - 1]
+            destination = self.add_volume({
+                "name": source["name"] + "_mirror",
+                "type": "dp",
+                "size": source["size"],
+            })
+            relationship = self.add_relationship({
+                "source": {"path": self.svm["name"] + ":" + source["name"]},
+                "destination": {"path": self.svm["name"] + ":" + destination["name"]},
+            })
+            relationship["state"] = "snapmirrored"
+
+    def find_volume(self, reference):
+        # Find a volume by a {"name": ...} or {"uuid": ...} reference.
+        if "uuid" in reference:
+            return self.volumes.get(reference["uuid"])
+        return self.volumes.get(self.volume_names.get(reference.get("name")))
+
+    def find_snapshot(self, volume, reference):
+        snapshots = self.snapshots.get(volume["uuid"], {})
+        if "uuid" in reference:
+            return snapshots.get(reference["uuid"])
+        for snapshot in snapshots.values():
+            if snapshot["name"] == reference.get("name"):
+                return snapshot
+        return None
+
+    def add_volume(self, body):
+        if not body.get("name"):
+            raise MockError(400, "Missing name for the volume.", "2")
+        if self.find_volume({"name": body["name"]}):
+            raise MockError(409, "Duplicate volume name " + body["name"] + ".", "917536")
+        volume = {
+            "uuid": self.new_uuid(),
+            "name": body["name"],
+            "svm": dict(self.svm),
+            "type": "rw",
+            "state": "online",
+            "style": "flexvol",
+            "size": 20 * 1024 * 1024,
+            "create_time": timestamp(time.time()),
+            "aggregates": [{"name": "aggr1"}],
+            "snapshot_policy": {"name": "default"},
+            "guarantee": {"type": "volume"},
+            "files": {"maximum": 21251, "used": 96},
+            "nas": {"security_style": "unix", "unix_permissions": 755,
+                    "uid": 0, "gid": 0, "export_policy": {"name": "default"}},
+            "clone": {"is_flexclone": False},
+        }
+        clone = body.get("clone", {})
+        if str(clone.get("is_flexclone", "false")).lower() == "true":
+            parent = self.find_volume(clone.get("parent_volume", {}))
+            if parent is None:
+                raise MockError(404, "Parent volume not found.", "917835")
+            snapshot = self.find_snapshot(parent, clone.get("parent_snapshot", {}))
+            if snapshot is None:
+                raise MockError(404, "Parent snapshot not found.", "917835")
+            volume["size"] = parent["size"]
+            volume["clone"] = {
+                "is_flexclone": True,
+                "parent_volume": {"name": parent["name"], "uuid": parent["uuid"]},
+                "parent_snapshot": {"name": snapshot["name"], "uuid": snapshot["uuid"]},
+            }
+            body = dict(body)
+            del body["clone"]
+        body = json.loads(json.dumps(body))
+        body.pop("svm", None)
+        if "size" in body:
+            body["size"] = parse_size(body["size"])
+        merge(volume, body)
+        if volume["type"] == "dp":
+            volume["nas"].pop("path", None)
+        volume["space"] = {
+            "size": volume["size"],
+            "used": 0,
+            "available": volume["size"],
+            "snapshot": {"reserve_percent": 5},
+        }
+        self.volumes[volume["uuid"]] = volume
+        self.volume_names[volume["name"]] = volume["uuid"]
+        self.snapshots[volume["uuid"]] = collections.OrderedDict()
+        return volume
+
+    def add_snapshot(self, volume, name, created=None):
+        for snapshot in self.snapshots[volume["uuid"]].values():
+            if snapshot["name"] == name:
+                raise MockError(409, "Snapshot " + name + " already exists.", "1638420")
+        snapshot = {
+            "uuid": self.new_uuid(),
+            "name": name,
+            "create_time": timestamp(created or time.time()),
+            "volume": {"name": volume["name"], "uuid": volume["uuid"]},
+            "svm": dict(self.svm),
+            "size": int(self.random.random() * GB),
+        }
+        self.snapshots[volume["uuid"]][snapshot["uuid"]] = snapshot
+        return snapshot
+
+    def add_relationship(self, body):
+        destination_path = body.get("destination", {}).get("path", "")
+        destination = self.find_volume({"name": destination_path.split(":")[-1]})
+        if destination is None or destination["type"] != "dp":
+            raise MockError(400, "Destination volume must be a dp volume.", "13303812")
+        for relationship in self.relationships.values():
+            if relationship["destination"]["path"] == destination_path:
+                raise MockError(409, "Relationship already exists.", "13303808")
+        relationship = {
+            "uuid": self.new_uuid(),
+            "source": {"path": body.get("source", {}).get("path", ""),
+                       "svm": {"name": self.svm["name"]}},
+            "destination": {"path": destination_path,
+                            "svm": {"name": self.svm["name"]}},
+            "policy": {"name": "MirrorAllSnapshots"},
+            "state": "uninitialized",
+            "healthy": True,
+            "lag_time": "PT0S",
+        }
+        self.relationships[relationship["uuid"]] = relationship
+        self.transfers[relationship["uuid"]] = collections.OrderedDict()
+        return relationship
+
+    # -- jobs and transfers ------------------------------------------------
+
+    def start_job(self, description, action):
+        # Run the action now and return a job that reports its result after
+        # job_seconds.  Errors raised by the action become job failures.
+        job = {
+            "uuid": self.new_uuid(),
+            "description": description,
+            "state": "running",
+            "message": "",
+            "code": 0,
+            "start_time": timestamp(time.time()),
+        }
+        job["_links"] = {"self": {"href": "/api/cluster/jobs/" + job["uuid"]}}
+        try:
+            if self.random.random() < self.job_fail_rate:
+                raise MockError(500, "Injected job failure.", "999")
+            action()
+            job["result"] = ("success", "success", 0)
+        except MockError as error:
+            job["result"] = ("failure", str(error), int(error.code))
+        job["done_at"] = time.time() + self.job_seconds
+        self.jobs[job["uuid"]] = job
+        return job
+
+    def job_view(self, job):
+        job = dict(job)
+        if time.time() >= job.pop("done_at"):
+            job["state"], job["message"], job["code"] = job.pop("result")
+            job["end_time"] = timestamp(time.time())
+        else:
+            job.pop("result")
+        return job
+
+    def transfer_view(self, transfer):
+        transfer = dict(transfer)
+        started = transfer.pop("started")
+        progress = min(1.0, (time.time() - started) / max(self.transfer_seconds, 0.001))
+        transfer["bytes_transferred"] = int(transfer.pop("total_bytes") * progress)
+        if progress >= 1.0:
+            transfer["state"] = "success"
+            transfer["end_time"] = timestamp(started + self.transfer_seconds)
+        else:
+            transfer["state"] = "transferring"
+        return transfer
+
+    def relationship_view(self, relationship):
+        relationship = dict(relationship)
+        transfers = list(self.transfers.get(relationship["uuid"], {}).values())
+        if transfers:
+            # As on ONTAP, the relationship shows its latest transfer, which
+            # may have finished.
+            transfer = self.transfer_view(transfers[-1])
+            relationship["transfer"] = {
+                "uuid": transfer["uuid"],
+                "state": transfer["state"],
+                "bytes_transferred": transfer["bytes_transferred"],
+            }
+            if transfer["state"] != "transferring":
+                relationship["state"] = "snapmirrored"
+                relationship["lag_time"] = "PT%dS" % \
+                    max(0, int(time.time() - transfers[-1]["started"]))
+        return relationship
+
+    # -- request handling --------------------------------------------------
+
+    def collection(self, records, params, path, keys):
+        # Filter, order, project and page a list of records.
+        query = (path,) + tuple(sorted((key, value) for key, value in params.items()
+                                       if key not in ["_offset", "max_records"]))
+        cached = self.pages.get(query)
+        if "_offset" in params and cached and cached[0] == self.generation:
+            records = cached[1]
+        else:
+            records = self.filter_records(records, params)
+            if len(self.pages) > 100:
+                self.pages.clear()
+            self.pages[query] = (self.generation, records)
+        offset = int(params.get("_offset", 0))
+        page_size = int(params.get("max_records") or self.page_size)
+        page = records[offset:offset + page_size]
+        body = {
+            "records": [project(record, params.get("fields"), keys) for record in page],
+            "num_records": len(page),
+            "_links": {"self": {"href": path}},
+        }
+        if offset + page_size < len(records):
+            next_params = dict(params)
+            next_params["_offset"] = offset + page_size
+            next_params["max_records"] = page_size
+            body["_links"]["next"] = {"href": path + "?" + urlencode(next_params)}
+        return 200, body
+
+    def filter_records(self, records, params):
+        for key, value in params.items():
+            if key not in control_params:
+                records = [record for record in records if matches(record, key, value)]
+        records = list(records)
+        if "order_by" in params:
+            for order in reversed(params["order_by"].split(",")):
+                parts = order.split()
+                reverse = len(parts) > 1 and parts[1].lower() == "desc"
+                records.sort(key=lambda record: [query_text(value) for value in
+                                                 values_at(record, parts[0])],
+                             reverse=reverse)
+        return records
+
+    def instance(self, record, params, keys):
+        if record is None:
+            raise MockError(404, "Entry doesn't exist.", "4")
+        return 200, project(record, params.get("fields", "*"), keys)
+
+    def query_jobs(self, description, records, params, action):
+        # A PATCH or DELETE on a collection applies the action to every
+        # record that matches the query, with one job each, and reports how
+        # many there were.
+        records = self.filter_records(records, params)
+        jobs = [self.start_job(description, lambda record=record: action(record))
+                for record in records]
+        response = {"num_records": len(jobs)}
+        if not jobs:
+            return 200, response
+        response["jobs"] = [{"uuid": job["uuid"], "_links": job["_links"]} for job in jobs]
+        return 202, response
+
+    def accepted(self, job):
+        return 202, {"job": {"uuid": job["uuid"], "_links": job["_links"]}}
+
+    def handle(self, method, path, params, body):
+        # Dispatch one request.  Returns an HTTP status and a response body.
+        # netapp_ontap quotes the "*" volume of cross-volume queries as %2A.
+        parts = [unquote(part) for part in path.split("/") if part][1:]
+        volume_keys = ["uuid", "name"]
+
+        if parts[:2] == ["storage", "volumes"]:
+            if len(parts) == 2:
+                if method == "GET":
+                    return self.collection(list(self.volumes.values()), params,
+                                           path, volume_keys)
+                if method == "POST":
+                    if not body.get("name"):
+                        raise MockError(400, "Missing name for the volume.", "2")
+                    return self.accepted(self.start_job(
+                        "POST " + path, lambda: self.add_volume(body)))
+                if method == "PATCH":
+                    return self.query_jobs(
+                        "PATCH " + path, list(self.volumes.values()), params,
+                        lambda volume: self.patch_volume(volume, body))
+            elif len(parts) == 3:
+                volume = self.volumes.get(parts[2])
+                if method == "GET":
+                    return self.instance(volume, params, volume_keys)
+                if volume is None:
+                    raise MockError(404, "Entry doesn't exist.", "4")
+                if method == "PATCH":
+                    return self.accepted(self.start_job(
+                        "PATCH " + path, lambda: self.patch_volume(volume, body)))
+                if method == "DELETE":
+                    return self.accepted(self.start_job(
+                        "DELETE " + path, lambda: self.delete_volume(volume)))
+            elif parts[3] == "snapshots":
+                return self.handle_snapshots(method, path, params, body, parts)
+
+        if parts[:2] == ["snapmirror", "relationships"]:
+            return self.handle_relationships(method, path, params, body, parts)
+
+        if parts[:2] == ["cluster", "jobs"]:
+            if method == "GET" and len(parts) == 2:
+                jobs = [self.job_view(job) for job in self.jobs.values()]
+                return self.collection(jobs, params, path, ["uuid"])
+            if method == "GET" and len(parts) == 3:
+                job = self.jobs.get(parts[2])
+                return self.instance(job and self.job_view(job), params, ["uuid"])
+
+        raise MockError(404, "API not found.", "3")
+
+    def handle_snapshots(self, method, path, params, body, parts):
+        snapshot_keys = ["uuid", "name", "volume"]
+        if parts[2] == "*" and method == "GET" and len(parts) == 4:
+            snapshots = []
+            for volume_snapshots in self.snapshots.values():
+                snapshots.extend(volume_snapshots.values())
+            return self.collection(snapshots, params, path, snapshot_keys)
+        volume = self.volumes.get(parts[2])
+        if volume is None:
+            raise MockError(404, "Volume not found.", "917927")
+        snapshots = self.snapshots[volume["uuid"]]
+        if len(parts) == 4:
+            if method == "GET":
+                return self.collection(list(snapshots.values()), params, path,
+                                       snapshot_keys)
+            if method == "POST":
+                return self.accepted(self.start_job(
+                    "POST " + path,
+                    lambda: self.add_snapshot(volume, body.get("name", ""))))
+            if method == "DELETE":
+                return self.query_jobs(
+                    "DELETE " + path, list(snapshots.values()), params,
+                    lambda snapshot: self.delete_snapshot(volume, snapshot))
+        elif len(parts) == 5:
+            snapshot = snapshots.get(parts[4])
+            if method == "GET":
+                return self.instance(snapshot, params, snapshot_keys)
+            if snapshot is None:
+                raise MockError(404, "Entry doesn't exist.", "4")
+            if method == "PATCH":
+                return self.accepted(self.start_job(
+                    "PATCH " + path, lambda: merge(snapshot, body)))
+            if method == "DELETE":
+                return self.accepted(self.start_job(
+                    "DELETE " + path,
+                    lambda: self.delete_snapshot(volume, snapshot)))
+        raise MockError(404, "API not found.", "3")
+
+    def handle_relationships(self, method, path, params, body, parts):
+        relationship_keys = ["uuid"]
+        if len(parts) == 2:
+            if method == "GET":
+                relationships = [self.relationship_view(relationship)
+                                 for relationship in self.relationships.values()]
+                return self.collection(relationships, params, path, relationship_keys)
+            if method == "POST":
+                return self.accepted(self.start_job(
+                    "POST " + path, lambda: self.add_relationship(body)))
+            if method == "DELETE":
+                return self.query_jobs(
+                    "DELETE " + path, list(self.relationships.values()), params,
+                    self.delete_relationship)
+        relationship = self.relationships.get(parts[2])
+        if len(parts) == 3:
+            if method == "GET":
+                return self.instance(relationship and self.relationship_view(relationship),
+                                     params, relationship_keys)
+            if relationship is None:
+                raise MockError(404, "Entry doesn't exist.", "4")
+            if method == "DELETE":
+                return self.accepted(self.start_job(
+                    "DELETE " + path,
+                    lambda: self.delete_relationship(relationship)))
+        if relationship is None:
+            raise MockError(404, "Entry doesn't exist.", "4")
+        if len(parts) >= 4 and parts[3] == "transfers":
+            transfers = self.transfers[relationship["uuid"]]
+            if len(parts) == 4 and method == "GET":
+                return self.collection([self.transfer_view(transfer)
+                                        for transfer in transfers.values()],
+                                       params, path, ["uuid"])
+            if len(parts) == 4 and method == "POST":
+                transfer = self.start_transfer(relationship)
+                transfer["_links"] = {"self": {"href": path + "/" + transfer["uuid"]}}
+                return 201, {"num_records": 1, "records": [transfer]}
+            if len(parts) == 5 and method == "GET":
+                transfer = transfers.get(parts[4])
+                return self.instance(transfer and self.transfer_view(transfer),
+                                     params, ["uuid"])
+        raise MockError(404, "API not found.", "3")
+
+    def patch_volume(self, volume, body):
+        body = json.loads(json.dumps(body))
+        if "name" in body and body["name"] != volume["name"]:
+            if self.find_volume({"name": body["name"]}):
+                raise MockError(409, "Duplicate volume name " + body["name"] + ".", "917536")
+            del self.volume_names[volume["name"]]
+            self.volume_names[body["name"]] = volume["uuid"]
+            for snapshot in self.snapshots[volume["uuid"]].values():
+                snapshot["volume"]["name"] = body["name"]
+        if "size" in body:
+            body["size"] = parse_size(body["size"])
+            body.setdefault("space", {})["size"] = body["size"]
+        merge(volume, body)
+
+    def delete_volume(self, volume):
+        for other in self.volumes.values():
+            parent = other.get("clone", {}).get("parent_volume", {})
+            if parent.get("uuid") == volume["uuid"]:
+                raise MockError(409, "Volume " + volume["name"] + " has clones.", "917623")
+        del self.volumes[volume["uuid"]]
+        del self.volume_names[volume["name"]]
+        del self.snapshots[volume["uuid"]]
+
+    def delete_snapshot(self, volume, snapshot):
+        for other in self.volumes.values():
+            parent = other.get("clone", {}).get("parent_snapshot", {})
+            if parent.get("uuid") == snapshot["uuid"]:
+                raise MockError(409, "Snapshot " + snapshot["name"] + " is busy.", "1638555")
+        del self.snapshots[volume["uuid"]][snapshot["uuid"]]
+
+    def delete_relationship(self, relationship):
+        del self.relationships[relationship["uuid"]]
+        del self.transfers[relationship["uuid"]]
+
+    def start_transfer(self, relationship):
+        transfer = {
+            "uuid": self.new_uuid(),
+            "relationship": {"uuid": relationship["uuid"]},
+            "state": "transferring",
+            "started": time.time(),
+            "total_bytes": int(self.random.random() * 10 * GB),
+        }
+        self.transfers[relationship["uuid"]][transfer["uuid"]] = transfer
+        return self.transfer_view(transfer)
+
+    def request(self, method, path, params, body):
+        # Apply latency, throttling and failure injection around handle().
+        with self.lock:
+            self.inflight += 1
+            inflight = self.inflight
+        try:
+            delay = self.latency + self.random.uniform(0, self.jitter)
+            if delay > 0:
+                time.sleep(delay)
+            if self.max_inflight and inflight > self.max_inflight:
+                raise MockError(429, "Too many requests.", "6")
+            if self.fail_rate and self.random.random() < self.fail_rate:
+                raise MockError(503, "Injected failure.", "8")
+            with self.lock:
+                if method != "GET":
+                    self.generation += 1
+                return self.handle(method, path, params, body)
+        except MockError as error:
+            return error.status, {"error": {"message": str(error),
+                                            "code": str(error.code)}}
+        finally:
+            with self.lock:
+                self.inflight -= 1
+
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # The headers and body are sent separately, which with Nagle's algorithm
+    # and delayed ACKs would add 40ms to every keep-alive response.
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        # Do the TLS handshake on this connection's thread, not the one
+        # accepting connections.
+        if hasattr(self.request, "do_handshake"):
+            self.request.do_handshake()
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.cluster.lock:
+            self.server.cluster.stats["connections"] += 1
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def respond(self, status, body, bytes_in, path):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/hal+json")
+        if self.server.cluster.gzip and len(data) > 1024 and \
+                "gzip" in self.headers.get("Accept-Encoding", ""):
+            data = gzip.compress(data, 5)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(data)))
+        if status == 201:
+            # Like ONTAP, point at the created record so that the client
+            # can learn its keys.
+            records = body.get("records") or [{}]
+            href = records[0].get("_links", {}).get("self", {}).get("href")
+            if href:
+                self.send_header("Location", href)
+        self.end_headers()
+        self.wfile.write(data)
+        if not path.startswith("/mock/"):
+            self.server.cluster.record_call(self.command, path, bytes_in,
+                                            len(data), status)
+
+    def dispatch(self):
+        cluster = self.server.cluster
+        url = urlsplit(self.path)
+        params = dict(parse_qsl(url.query, keep_blank_values=True))
+        length = int(self.headers.get("Content-Length") or 0)
+        data = self.rfile.read(length) if length else b""
+        bytes_in = len(self.path) + len(data)
+        if url.path == "/mock/stats":
+            return self.respond(200, cluster.stats_dict(), bytes_in, url.path)
+        if url.path == "/mock/reset":
+            cluster.reset_stats()
+            return self.respond(200, {}, bytes_in, url.path)
+        if not url.path.startswith("/api/"):
+            return self.respond(404, {"error": {"message": "API not found."}},
+                                bytes_in, url.path)
+        try:
+            body = json.loads(data.decode("utf-8")) if data else {}
+        except ValueError:
+            return self.respond(400, {"error": {"message": "Invalid JSON."}},
+                                bytes_in, url.path)
+        status, response = cluster.request(self.command, url.path, params, body)
+        self.respond(status, response, bytes_in, url.path)
+
+    do_GET = do_POST = do_PATCH = do_DELETE = dispatch
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, cluster, verbose=False, certfile=None):
+        ThreadingHTTPServer.__init__(self, address, MockRequestHandler)
+        self.cluster = cluster
+        self.verbose = verbose
+        if certfile:
+            # The certificate file holds the key too.
+            import ssl
+
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(certfile)
+            self.socket = context.wrap_socket(self.socket, server_side=True,
+                                              do_handshake_on_connect=False)
+
+
+def start(host="127.0.0.1", port=0, certfile=None, **settings):
+    # Start a mock server on a background thread and return it.  The port it
+    # listens on is server.server_address[1] and its state is server.cluster.
+    server = MockServer((host, port), MockCluster(**settings), certfile=certfile)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+# ---------------------------------------------------------------------------
+# MAIN
+# ---------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("--host", dest="host", default="127.0.0.1", help="listen address")
+    parser.add_option("--port", dest="port", type="int", default=8080, help="listen port")
+    parser.add_option("--svm", dest="svm", default="vs1", help="SVM name")
+    parser.add_option("--volumes", dest="volumes", type="int", default=100,
+                      help="number of volumes to create")
+    parser.add_option("--snapshots", dest="snapshots", type="int", default=5,
+                      help="number of snapshots per volume")
+    parser.add_option("--clones", dest="clones", type="int", default=10,
+                      help="number of flexclones to create")
+    parser.add_option("--mirrors", dest="mirrors", type="int", default=5,
+                      help="number of snapmirror relationships to create")
+    parser.add_option("--latency", dest="latency", type="float", default=0.0,
+                      help="seconds added to every request")
+    parser.add_option("--jitter", dest="jitter", type="float", default=0.0,
+                      help="random extra seconds added to every request")
+    parser.add_option("--fail-rate", dest="fail_rate", type="float", default=0.0,
+                      help="fraction of requests that fail with HTTP 503")
+    parser.add_option("--job-seconds", dest="job_seconds", type="float", default=0.0,
+                      help="seconds until a job finishes")
+    parser.add_option("--job-fail-rate", dest="job_fail_rate", type="float", default=0.0,
+                      help="fraction of jobs that fail")
+    parser.add_option("--transfer-seconds", dest="transfer_seconds", type="float",
+                      default=1.0, help="seconds until a snapmirror transfer finishes")
+    parser.add_option("--max-inflight", dest="max_inflight", type="int", default=0,
+                      help="concurrent requests above which HTTP 429 is returned")
+    parser.add_option("--page-size", dest="page_size", type="int", default=10000,
+                      help="default number of records per page")
+    parser.add_option("--gzip", dest="gzip", action="store_true",
+                      help="compress responses for clients that accept gzip")
+    parser.add_option("--cert", dest="cert",
+                      help="serve HTTPS with this PEM file holding the certificate and key")
+    parser.add_option("--seed", dest="seed", type="int", default=1, help="random seed")
+    parser.add_option("--verbose", dest="verbose", action="store_true",
+                      help="log every request")
+    (options, args) = parser.parse_args()
+
+    cluster = MockCluster(svm=options.svm, volumes=options.volumes,
+                          snapshots=options.snapshots, clones=options.clones,
+                          mirrors=options.mirrors, latency=options.latency,
+                          jitter=options.jitter, fail_rate=options.fail_rate,
+                          job_seconds=options.job_seconds,
+                          job_fail_rate=options.job_fail_rate,
+                          transfer_seconds=options.transfer_seconds,
+                          max_inflight=options.max_inflight,
+                          page_size=options.page_size, gzip=options.gzip,
+                          seed=options.seed)
+    server = MockServer((options.host, options.port), cluster, options.verbose,
+                        options.cert)
+    print("Mock ONTAP listening on %s://%s:%d with %d volumes." % \
+          ("https" if options.cert else "http", options.host, options.port,
+           len(cluster.volumes)))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
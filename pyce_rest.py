@@ -22,124 +22,545 @@
 
 version="2020.04.08"
 
+import io
+import os
+import re
+import csv
 import sys
+import json
+import time
+import random
+import calendar
+import copy
+import math
+import array
+import heapq
+import fnmatch
+import socket
+import sqlite3
 import logging
-from optparse import OptionParser
+import cProfile
+import tempfile
+import functools
+import contextlib
+import itertools
+import collections
+import queue
+import threading
+import socketserver
+import concurrent.futures
+from optparse import OptionParser, Values
+from urllib.parse import urlsplit
 import pyceRestConfig
 
-# Import the required netap_ontap modules.
-from netapp_ontap import config as NaConfig
-from netapp_ontap.host_connection import HostConnection as NaHostConnection
-from netapp_ontap.error import NetAppRestError
-from netapp_ontap.resources import Volume as NaVolume
-from netapp_ontap.resources import Snapshot as NaSnapshot
-from netapp_ontap.resources import SnapmirrorRelationship as NaSnapmirrorRelationship
-from netapp_ontap.resources import SnapmirrorTransfer as NaSnapmirrorTransfer
+# The netapp_ontap modules, asyncio and concurrent.futures are imported by
+# the functions that use them, so that "-h" and option errors do not pay for
+# importing them.  Each operation imports only the resources it works with.
+
+# List of supported operation types.
+operations = ["list_volumes","create_volume","create_volumes","delete_volume","remount_volume",
+              "list_snapshots","create_snapshot","delete_snapshot","prune_snapshots",
+              "list_clones","create_clone","create_clones",
+              "checkout_clone","return_clone","fill_pool","pool_status",
+              "list_mirrors", "create_mirror","update_mirror","update_mirrors","delete_mirror",
+              "capacity_report", "reconcile",
+              "serve", "batch", "wait_jobs",
+             ]
+
+# Returns an optional pyceRestConfig setting, or the default if it is not set.
+def config_option(name, default):
+    return getattr(pyceRestConfig, name, default)
+
+# The cluster and SVM that operations on this thread work on.  They are
+# ce_cluster and ce_vserver, except on the threads of a multi-target list
+# operation (see "TARGETS").
+target_local = threading.local()
+
+
+def current_cluster():
+    return getattr(target_local, "cluster", None) or pyceRestConfig.ce_cluster
+
+
+def current_vserver():
+    return getattr(target_local, "vserver", None) or pyceRestConfig.ce_vserver
 
 # Uncomment these for additional ONTAP REST API debugging.
 #logging.basicConfig(level=logging.DEBUG)
 #utils.DEBUG = 1
 #utils.LOG_ALL_API_CALLS = 1
 
+# The list operations stream their collections.  Each page of ce_page_size
+# records is requested as plain dicts (raw=True) and printed as it arrives,
+# so memory use stays flat and the first rows are printed before the last
+# page has been requested, however large the SVM is.  A page size of 0 leaves
+# it to the cluster.
+def collection_records(resource, *args, **query):
+    # Generate the records of a collection query as dicts.
+    page_size = config_option("ce_page_size", 500) or None
+    for record in resource.get_collection(*args, raw=True, max_records=page_size,
+                                          **query):
+        yield record.resource_data
+
+
+def record_value(record, path, default=""):
+    # Returns a dotted field, such as "space.used", of a record dict.
+    for key in path.split("."):
+        if not isinstance(record, dict) or key not in record:
+            return default
+        record = record[key]
+    return record
+
+
+# Output format of the list operations running on this thread: "table" (the
+# default) or, for scripts, "json", "ndjson" or "csv" with raw values.
+output_formats = ["table", "json", "ndjson", "csv"]
+output_local = threading.local()
+
+
+def output_format():
+    return getattr(output_local, "format", None) or "table"
+
+
+def print_list_header(message, heading=None, rule=None):
+    # Print the message and column headings of a table.  The other formats
+    # only write records to stdout, so their message goes to stderr.
+    sink = getattr(output_local, "sink", None)
+    if sink:
+        sink("header", (message, heading, rule))
+        return
+    if output_format() != "table":
+        sys.stderr.write(message + "\n")
+        return
+    print(message)
+    if heading:
+        print("")
+        print(heading)
+        print(rule)
+
+
+def table_values(record):
+    return tuple("" if value is None else value for value in record)
+
+
+def print_list_message(message, columns=None):
+    # Print an error or "not found" message of a list operation.  Tables
+    # show it in place.  The other formats keep stdout for records, so the
+    # message goes to stderr, and with columns an empty list is written so
+    # that the output still parses.  On the threads of a multi-target
+    # listing it is printed, which reports it with the target's name.
+    if output_format() == "table" or getattr(output_local, "sink", None):
+        print(message)
+    else:
+        sys.stderr.write(message + "\n")
+    if columns:
+        print_records(columns, iter([]), "")
+
+
+def print_records(columns, records, row_format, table_row=table_values):
+    # Print records (tuples of raw values for the columns) as they are
+    # generated.  Tables show table_row(record) in row_format, and the other
+    # formats show the raw values, with None as null or an empty CSV field.
+    # Output is flushed after the first record and then once per page, so a
+    # reader on a pipe sees it right away.  On the threads of a multi-target
+    # listing, the records go to the thread's sink instead.
+    sink = getattr(output_local, "sink", None)
+    if sink:
+        sink("records", (columns, row_format, table_row))
+        for record in records:
+            sink("record", record)
+        return
+    page_size = config_option("ce_page_size", 500)
+    output = output_format()
+    if output == "csv":
+        writer = csv.writer(sys.stdout, lineterminator="\n")
+        writer.writerow(columns)
+    count = 0
+    for record in records:
+        if output == "table":
+            print(row_format % table_row(record))
+        elif output == "csv":
+            writer.writerow(["" if value is None else value for value in record])
+        else:
+            text = json.dumps(collections.OrderedDict(zip(columns, record)))
+            if output == "ndjson":
+                print(text)
+            elif count == 0:
+                sys.stdout.write("[\n" + text)
+            else:
+                sys.stdout.write(",\n" + text)
+        count += 1
+        if count == 1 or (page_size and count % page_size == 0):
+            sys.stdout.flush()
+    if output == "json":
+        if count == 0:
+            sys.stdout.write("[]\n")
+        else:
+            sys.stdout.write("\n]\n")
+
+
+def gigabytes(size):
+    # Whole GB for tables, or "" if the size is unknown.
+    if size is None:
+        return ""
+    return int(size / (1024*1024*1024))
+
 
 def list_volumes(volume_string):
-    print("Getting list of volumes that match: " + volume_string)
+    from netapp_ontap.error import NetAppRestError
+    from netapp_ontap.resources import Volume as NaVolume
 
     # Print header
-    print("")
-    print("%-24s %-40s %10s %10s" % ("Volume Name", "Junction Path", "Size (GB)", "Used (GB)"))
-    print("---------------------------------------------------------------------------------------")
+    print_list_header("Getting list of volumes that match: " + volume_string,
+        "%-24s %-40s %10s %10s" % ("Volume Name", "Junction Path", "Size (GB)", "Used (GB)"),
+        "---------------------------------------------------------------------------------------")
 
-    # Get list of volumes and print matches as we go.    
+    # Get list of volumes and print matches as we go.  The name match is
+    # done by the cluster with a wildcard query, and all of the fields we
+    # print are requested in the same paginated collection query.
     volume_args = {
-        "svm.name": pyceRestConfig.ce_vserver,
+        "svm.name": current_vserver(),
+        "name": "*" + volume_string + "*",
+        "fields": "name,space.used,space.size,nas.path",
     }
-    try:
-        for volume in NaVolume.get_collection(**volume_args):
-            name = volume.to_dict()['name']
+
+    def records(volumes):
+        for volume in volumes:
+            name = volume["name"]
             if volume_string in name:
-                try:
-                    volume.get(fields="name,space.used,space.size,nas.path")
-                except NetAppRestError:
-                    print("Error retrieving volume details for volume: " + name)
-                    raise
-                volume_dict = volume.to_dict()
-                used = size = junc_path = ""
-                if "space" in volume_dict:
-                    if "used" in volume_dict["space"]:
-                        used = volume_dict['space']['used']
-                        size = volume_dict['space']['size']
-                        size  = int(size / (1024*1024*1024))
-                        used  = int(used / (1024*1024*1024))
-                if "nas" in volume_dict:
-                    if "path" in volume_dict['nas']:
-                        junc_path = volume_dict['nas']['path']
-                print("%-24s %-40s %10s %10s" % (name, junc_path, size, used))
+                used = size = None
+                if record_value(volume, "space.used", None) is not None:
+                    size = volume["space"]["size"]
+                    used = volume["space"]["used"]
+                yield (name, record_value(volume, "nas.path", None), size, used)
+
+    def table_row(record):
+        name, junction_path, size, used = record
+        return (name, junction_path or "", gigabytes(size), gigabytes(used))
+
+    try:
+        print_records(["name", "junction_path", "size", "used"],
+                      records(collection_records(NaVolume, **volume_args)),
+                      "%-24s %-40s %10s %10s", table_row)
     except NetAppRestError:
-        print("Error retrieving volume list.")
+        print_list_message("Error retrieving volume list.")
         raise
 
 
-def create_volume(name, junction_path, type):
-    if type == "dp":
-        print("Creating mirror volume: " + name)
-    else: 
-        print("Creating volume: " + name + " with junction-path " + junction_path)
+# The capacity report keeps the name, size and used space of every volume in
+# a list and two arrays, rather than a dict per volume, so that 100k volumes
+# take a few MB.  The top volumes are picked with a heap, and only the
+# utilizations are sorted, for the percentiles.
+report_percentiles = [("p50", 50), ("p90", 90), ("p95", 95), ("p99", 99), ("max", 100)]
 
-    # Build arguments for volume creation.
-    volume_dict = {}
-    volume_dict.update(pyceRestConfig.ce_volume_create_options)
+
+def volume_prefix(name):
+    # The rollup prefix of a volume without --prefixes: the name up to its
+    # first "_", "-", "." or digit, whichever comes first, so that
+    # "build_1", "build123_clone" and "build-7" all roll up to "build*".
+    match = re.match("[^0-9_.-]+", name)
+    if not match:
+        return name
+    return match.group(0) + "*"
+
+
+def capacity_report(volume_string, top, prefixes):
+    from netapp_ontap.error import NetAppRestError
+    from netapp_ontap.resources import Volume as NaVolume
+
+    print_list_header("Getting capacity report for volumes that match: " + volume_string)
+
+    # Read the space of every matching volume in one paginated query.
+    # Volumes without space information, such as offline ones, are counted
+    # but left out of the figures.
+    volume_args = {
+        "svm.name": current_vserver(),
+        "name": volume_string,
+        "fields": "name,space.size,space.used",
+    }
+    names = []
+    sizes = array.array("q")
+    used = array.array("q")
+    unknown = 0
+    try:
+        for volume in collection_records(NaVolume, **volume_args):
+            size = record_value(volume, "space.size", None)
+            if size is None or record_value(volume, "space.used", None) is None:
+                unknown += 1
+                continue
+            names.append(volume["name"])
+            sizes.append(size)
+            used.append(volume["space"]["used"])
+    except NetAppRestError:
+        print_list_message("Error retrieving volume list.")
+        raise
+
+    def percent(used_bytes, size_bytes):
+        if not size_bytes:
+            return 0.0
+        return 100.0 * used_bytes / size_bytes
+
+    count = len(names)
+    utilization = array.array("d", (percent(used[n], sizes[n]) for n in range(count)))
+    ordered = sorted(utilization)
+    percentiles = collections.OrderedDict()
+    for name, rank in report_percentiles:
+        if ordered:
+            percentiles[name] = ordered[max(0, int(math.ceil(rank / 100.0 * count)) - 1)]
+    del ordered
+
+    def volume_entry(n):
+        return collections.OrderedDict([("name", names[n]), ("size", sizes[n]),
+                                        ("used", used[n]), ("percent_used", utilization[n])])
+
+    largest = [volume_entry(n) for n in heapq.nlargest(top, range(count), key=sizes.__getitem__)]
+    fullest = [volume_entry(n) for n in heapq.nlargest(top, range(count),
+                                                       key=utilization.__getitem__)]
+
+    # Roll the volumes up by the --prefixes patterns, or by name prefix.
+    rollups = collections.OrderedDict()
+    for pattern in prefixes or []:
+        rollups[pattern] = [0, 0, 0]
+    for n in range(count):
+        if prefixes:
+            keys = [pattern for pattern in prefixes if fnmatch.fnmatchcase(names[n], pattern)]
+        else:
+            keys = [volume_prefix(names[n])]
+        for key in keys:
+            rollup = rollups.setdefault(key, [0, 0, 0])
+            rollup[0] += 1
+            rollup[1] += sizes[n]
+            rollup[2] += used[n]
+    if not prefixes:
+        rollups = collections.OrderedDict(sorted(rollups.items(), key=lambda item: -item[1][1]))
+
+    total_size = sum(sizes)
+    total_used = sum(used)
+    output = output_format()
+    if output == "csv":
+        print_records(["prefix", "volumes", "size", "used", "percent_used"],
+                      [(key, rollup[0], rollup[1], rollup[2], percent(rollup[2], rollup[1]))
+                       for key, rollup in rollups.items()] +
+                      [("total", count, total_size, total_used, percent(total_used, total_size))],
+                      None)
+        return
+    if output in ["json", "ndjson"]:
+        report = collections.OrderedDict([
+            ("volumes", count),
+            ("no_space_info", unknown),
+            ("size", total_size),
+            ("used", total_used),
+            ("percent_used", percent(total_used, total_size)),
+            ("percentiles", percentiles),
+            ("largest", largest),
+            ("fullest", fullest),
+            ("prefixes", [collections.OrderedDict([
+                ("prefix", key), ("volumes", rollup[0]), ("size", rollup[1]),
+                ("used", rollup[2]), ("percent_used", percent(rollup[2], rollup[1]))])
+                for key, rollup in rollups.items()]),
+        ])
+        if output == "json":
+            print(json.dumps(report, indent=1))
+        else:
+            print(json.dumps(report))
+        return
+
+    print("")
+    print("Volumes: %d, Size: %s GB, Used: %s GB (%.1f%%)" % \
+          (count, gigabytes(total_size), gigabytes(total_used),
+           percent(total_used, total_size)))
+    if unknown:
+        print("Volumes without space information: %d" % unknown)
+    if percentiles:
+        print("Utilization: " + ", ".join("%s %.1f%%" % (name, value)
+                                          for name, value in percentiles.items()))
+    for title, entries in [("Largest volumes:", largest), ("Fullest volumes:", fullest)]:
+        print("")
+        print(title)
+        print("%-40s %10s %10s %7s" % ("Volume Name", "Size (GB)", "Used (GB)", "Used %"))
+        print("----------------------------------------------------------------------")
+        for entry in entries:
+            print("%-40s %10s %10s %6.1f%%" % (entry["name"], gigabytes(entry["size"]),
+                                              gigabytes(entry["used"]), entry["percent_used"]))
+    print("")
+    print("%-32s %7s %10s %10s %7s" % ("Prefix", "Volumes", "Size (GB)", "Used (GB)", "Used %"))
+    print("----------------------------------------------------------------------")
+    for key, rollup in rollups.items():
+        print("%-32s %7d %10s %10s %6.1f%%" % (key, rollup[0], gigabytes(rollup[1]),
+                                              gigabytes(rollup[2]),
+                                              percent(rollup[2], rollup[1])))
+
+
+def merge_options(options, overrides):
+    # Merge the overrides dict into options, recursing into nested dicts.
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(options.get(key), dict):
+            merge_options(options[key], value)
+        else:
+            options[key] = value
+    return options
+
+
+def volume_create_dict(name, junction_path, type, template=None):
+    # Build the POST body for a new volume from a deep copy of
+    # ce_volume_create_options, so that the configuration itself is never
+    # changed and concurrent creates cannot share nested dicts.  A named
+    # template from ce_volume_templates is merged over the options, and
+    # ce_vol_maxfiles becomes files.maximum unless the template sets it.
+    volume_dict = copy.deepcopy(pyceRestConfig.ce_volume_create_options)
+    if template:
+        templates = config_option("ce_volume_templates", {})
+        merge_options(volume_dict, copy.deepcopy(templates[template]))
     volume_dict["name"] = name
     volume_dict["svm"] = {}
-    volume_dict["svm"]["name"] = pyceRestConfig.ce_vserver
-    volume_dict["nas"]["path"] = junction_path
+    volume_dict["svm"]["name"] = current_vserver()
     volume_dict["type"] = type
     if type == "dp":
         # Mirror destinations cannot have these attributes set.
-        del volume_dict["nas"]
+        volume_dict.pop("nas", None)
+        volume_dict.pop("files", None)
+        return volume_dict
+    volume_dict.setdefault("nas", {})["path"] = junction_path
+    maxfiles = int(config_option("ce_vol_maxfiles", "0"))
+    if maxfiles > 0:
+        volume_dict.setdefault("files", {}).setdefault("maximum", maxfiles)
+    return volume_dict
+
+
+# Whether the cluster accepts files.maximum in a volume POST.  Cleared the
+# first time the cluster rejects it, so that later creates go straight to
+# the POST and PATCH pair.
+volume_post_state = {"files": True}
 
-    # Create the volume.
+
+def rejected_field_error(error, field):
+    # A 400, or a failed job, naming the field means the cluster does not
+    # accept it here.
+    response = error.http_err_response
+    if response is not None and response.http_response.status_code != 400:
+        return False
+    return field in str(error)
+
+
+def post_volume(volume_dict, poll=True):
+    # POST a new volume with all of its attributes in one request.  If the
+    # cluster rejects files.maximum on POST, the volume is created without
+    # it and then patched, which needs the creation job to finish first.
+    # Returns the post() response, or None when the volume was patched.
+    from netapp_ontap.error import NetAppRestError
+    from netapp_ontap.resources import Volume as NaVolume
+
+    files = volume_dict.get("files")
+    if not files or volume_post_state["files"]:
+        try:
+            return NaVolume.from_dict(volume_dict).post(poll=poll)
+        except NetAppRestError as error:
+            if not files or not rejected_field_error(error, "files.maximum"):
+                raise
+        volume_post_state["files"] = False
+
+    volume_dict = dict(volume_dict)
+    del volume_dict["files"]
     volume = NaVolume.from_dict(volume_dict)
+    volume.post()
+    if not getattr(volume, "uuid", None):
+        volume_args = {
+            "name": volume_dict["name"],
+            "svm.name": current_vserver(),
+        }
+        volume = NaVolume.find(fields="uuid", **volume_args)
+    maxfiles = NaVolume(uuid=volume.uuid)
+    maxfiles.files = files
+    maxfiles.patch()
+    return None
+
+
+def create_volume(name, junction_path, type, template=None):
+    from netapp_ontap.error import NetAppRestError
+
+    if type == "dp":
+        print("Creating mirror volume: " + name)
+    else: 
+        print("Creating volume: " + name + " with junction-path " + junction_path)
+
+    # Create the volume, maxfiles included, with a single POST.
+    volume_dict = volume_create_dict(name, junction_path, type, template)
     try:
-        volume.post()
+        done = submit_job(functools.partial(post_volume, volume_dict),
+                          "create volume " + name)
     except NetAppRestError:
         print("Error creating volume!")
         raise
-    print("Volume created succesfully.")
+    uuid_cache_delete("volume", name)
+    if done:
+        print("Volume created succesfully.")
 
-    # Set maxfiles if required.
-    try:
-        pyceRestConfig.ce_vol_maxfiles
-    except NameError:
-        pyceRestConfig.ce_vol_maxfiles = "0"
-    if int(pyceRestConfig.ce_vol_maxfiles) > 0 and type != "dp":
-        # First find the volume that we just created.
-        volume_args = {
-            "name": name,
-            "svm.name": pyceRestConfig.ce_vserver,
-        }
-        try:
-            volume = NaVolume.find(fields="files.maximum", **volume_args)
-        except NetAppRestError:
-            print("Error finding new volume to set maxfiles!")
-            raise
-        # Now set the files.maximum field and patch the volume.
-        volume.files.maximum = pyceRestConfig.ce_vol_maxfiles
-        try:
-            volume.patch()
-        except NetAppRestError:
-            print("Error setting maxfiles on volume!")
-            raise
-        print("Volume maxfiles updated successfully.")
+
+def create_volumes(name_template, junction_template, count, template, workers):
+    # Create count volumes from a template, workers at a time.  The names
+    # and junction paths come from template_names(), as with create_clones.
+    import concurrent.futures
+    from netapp_ontap.error import NetAppRestError
+
+    volumes = template_names(name_template, junction_template, count)
+    message = "Creating " + str(count) + " volumes"
+    if template:
+        message += " from template " + template
+    print(message + ", " + str(workers) + " at a time")
+
+    # Submit the volume jobs from a thread pool, each with its own copy of
+    # the create options, then wait for all of them with one job poller.
+    poller = JobPoller()
+
+    def create_one(name, junction_path):
+        volume_dict = volume_create_dict(name, junction_path, "rw", template)
+        with measure_operation("create_volumes", run=False):
+            response = post_volume(volume_dict, poll=False)
+        uuid_cache_delete("volume", name)
+        return job_uuid(response)
+
+    failed = 0
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for name, junction_path in volumes:
+            futures[executor.submit(create_one, name, junction_path)] = \
+                (name, junction_path)
+        for future in concurrent.futures.as_completed(futures):
+            name, junction_path = futures[future]
+            try:
+                job = future.result()
+            except NetAppRestError as error:
+                print("Error creating volume " + name + ": " + str(error))
+                failed += 1
+                continue
+            if job:
+                poller.add(job, (name, junction_path))
+            else:
+                print("Created volume %s at %s in %.2fs" % \
+                      (name, junction_path, time.time() - start))
+
+    for job, (name, junction_path), state, message in poller.wait():
+        if state == "success":
+            print("Created volume %s at %s in %.2fs" % \
+                  (name, junction_path, time.time() - start))
+        else:
+            print("Error creating volume " + name + ": " + message)
+            failed += 1
+
+    print("Created %d of %d volumes in %.2fs." % (count - failed, count, time.time() - start))
+    return failed == 0
 
 
 def delete_volume(name):
+    from netapp_ontap.error import NetAppRestError
+    from netapp_ontap.resources import Volume as NaVolume
+
     print("Deleting volume: " + name)
 
     # First find the volume to be deleted.
     volume_args = {
         "name": name,
-        "svm.name": pyceRestConfig.ce_vserver,
+        "svm.name": current_vserver(),
     }
     try:
         volume = NaVolume.find(**volume_args)
@@ -150,22 +571,28 @@ def delete_volume(name):
     # If we have found the volume, delete it.
     if volume:
         try:
-            volume.delete()
+            done = submit_job(volume.delete, "delete volume " + name)
         except NetAppRestError:
             print("Error deleting volume!")
             raise
-        print("Volume deleted.")
+        uuid_cache_delete("volume", name)
+        uuid_cache_delete("mirror", name)
+        if done:
+            print("Volume deleted.")
     else:
         print("Error: Volume not found!")
 
 
 def remount_volume(name, junction_path):
+    from netapp_ontap.error import NetAppRestError
+    from netapp_ontap.resources import Volume as NaVolume
+
     print("Re-mounting volume: " + name + " with junction of " + junction_path)
 
     # First find the volume to be remounted.
     volume_args = {
         "name": name,
-        "svm.name": pyceRestConfig.ce_vserver,
+        "svm.name": current_vserver(),
     }
     try:
         volume = NaVolume.find(fields="nas.path", **volume_args)
@@ -176,167 +603,553 @@ def remount_volume(name, junction_path):
     # Now set the new nas.path for the volume and update it.
     volume.nas.path = junction_path
     try:
-        volume.patch()
+        done = submit_job(volume.patch, "remount volume " + name)
     except NetAppRestError:
         print("Error remounting volume!")
         raise
+    uuid_cache_delete("volume", name)
 
-    print("Volume remounted successfully.")
+    if done:
+        print("Volume remounted successfully.")
 
-def list_snapshots(volume_name):
-    print("Getting list of snapshots on volume: " + volume_name)
+# Cluster side sort orders of snapshot listings, oldest first.
+snapshot_orders = {
+    "age": "create_time,volume.name",
+    "volume": "volume.name,create_time",
+}
+
+
+def list_snapshots(volume_name, sort=None):
+    from netapp_ontap.error import NetAppRestError
+    from netapp_ontap.resources import Snapshot as NaSnapshot
+
+    # A volume name with a "*" wildcard lists the snapshots of every matching
+    # volume ("*" for the whole SVM).
+    if "*" in volume_name:
+        return list_svm_snapshots(volume_name, sort)
+
+    message = "Getting list of snapshots on volume: " + volume_name
+    for use_cache in [True, False]:
+        # First find the volume uuid.
+        try:
+            volume_uuid, cached = find_volume_uuid(volume_name, use_cache)
+        except NetAppRestError:
+            print_list_header(message)
+            print_list_message("Error finding volume for snapshot listing!")
+            raise
+        if volume_uuid is None:
+           print_list_header(message)
+           print_list_message("Volume not found!", ["volume", "name", "create_time"])
+           return False
+
+        # Now get the collection of snapshots for the volume.  The first
+        # record is fetched before printing anything, so that a stale cached
+        # volume uuid can be looked up again.  A cached uuid may also belong
+        # to another volume if volumes were renamed, so the query is filtered
+        # on the volume name too, and finding nothing counts as stale.
+        snapshot_args = {"fields": "name,create_time"}
+        if cached:
+            snapshot_args["volume.name"] = volume_name
+        if sort:
+            snapshot_args["order_by"] = snapshot_orders[sort]
+        snapshots = collection_records(NaSnapshot, volume_uuid, **snapshot_args)
+        try:
+            first = next(snapshots, None)
+        except NetAppRestError as error:
+            if cached and stale_uuid_error(error):
+                uuid_cache_delete("volume", volume_name)
+                continue
+            print_list_header(message)
+            print_list_message("Error retrieving snapshot list.")
+            raise
+        if cached and first is None:
+            uuid_cache_delete("volume", volume_name)
+            continue
+        break
+
+    # Print header.
+    print_list_header(message,
+        "%-32s %-32s %-28s" % ("Volume Name", "Snapshot Name", "Snapshot Date"),
+        "----------------------------------------------------------------------------------------------")
+
+    # Print details for each snapshot.
+    if first is None:
+        snapshots = iter([])
+    else:
+        snapshots = itertools.chain([first], snapshots)
+
+    def records(snapshots):
+        for snapshot in snapshots:
+            yield (volume_name, record_value(snapshot, "name", None),
+                   record_value(snapshot, "create_time", None))
 
-    # First find the volume uuid.
-    volume_args = {
-        "name": volume_name,
-        "svm.name": pyceRestConfig.ce_vserver,
-    }
     try:
-        volume = NaVolume.find(fields="uuid", **volume_args)
+        print_records(["volume", "name", "create_time"], records(snapshots),
+                      "%-32s %-32s %-28s")
     except NetAppRestError:
-        print("Error finding volume for snapshot listing!")
+        print_list_message("Error retrieving snapshot list.")
         raise
-    if volume is None:
-       print("Volume not found!")
-       return
 
-    # Print header.
-    print("")
-    print("%-32s %-32s %-28s" % ("Volume Name", "Snapshot Name", "Snapshot Date"))
-    print("----------------------------------------------------------------------------------------------")
 
-    # Now get the collection of snapshots for the volume and print details.
+def list_svm_snapshots(volume_pattern, sort=None):
+    from netapp_ontap.error import NetAppRestError
+    from netapp_ontap.resources import Snapshot as NaSnapshot
+
+    # Print header
+    print_list_header("Getting list of snapshots on volumes that match: " + volume_pattern,
+        "%-32s %-32s %-28s %10s" % ("Volume Name", "Snapshot Name", "Snapshot Date", "Size (MB)"),
+        "---------------------------------------------------------------------------------------------------------")
+
+    # One collection query on the "*" volume returns the snapshots of all of
+    # the matching volumes, sorted by the cluster, instead of a volume lookup
+    # and a snapshot query for each volume.
+    snapshot_args = {
+        "volume.name": volume_pattern,
+        "svm.name": current_vserver(),
+        "fields": "volume.name,name,create_time,size",
+    }
+    if sort:
+        snapshot_args["order_by"] = snapshot_orders[sort]
+
+    def records(snapshots):
+        for snapshot in snapshots:
+            yield (record_value(snapshot, "volume.name", None),
+                   record_value(snapshot, "name", None),
+                   record_value(snapshot, "create_time", None),
+                   record_value(snapshot, "size", None))
+
+    def table_row(record):
+        volume_name, name, create_time, size = record
+        if size is not None:
+            size = int(size / (1024*1024))
+        return table_values((volume_name, name, create_time, size))
+
     try:
-        for snapshot in NaSnapshot.get_collection(volume.uuid):
-            try:
-                snapshot.get(fields="name,create_time")
-            except NetAppRestError:
-                print("Error retrieving snapshot details for volume!")
-                raise
-            snapshot_dict = snapshot.to_dict()
-            snapname = create_time = ""
-            if "name" in snapshot_dict:
-                snapname = snapshot_dict["name"]
-            if "create_time" in snapshot_dict:
-                snaptime = snapshot_dict["create_time"]
-            print("%-32s %-32s %-28s" % (volume_name, snapname, snaptime))
+        print_records(["volume", "name", "create_time", "size"],
+                      records(collection_records(NaSnapshot, "*", **snapshot_args)),
+                      "%-32s %-32s %-28s %10s", table_row)
     except NetAppRestError:
-        print("Error retrieving snapshot list.")
+        print_list_message("Error retrieving snapshot list.")
         raise
 
 
 def create_snapshot(volume_name, snapshot_name):
-    # First find the volume uuid.
-    volume_args = {
-        "name": volume_name,
-        "svm.name": pyceRestConfig.ce_vserver,
-    }
+    from netapp_ontap.error import NetAppRestError
+    from netapp_ontap.resources import Snapshot as NaSnapshot
+
+    # First find the volume uuid.  A snapshot can only be created through
+    # the volume uuid, which a cached entry could give for another volume
+    # after a rename, so this always looks the uuid up.
     try:
-        volume = NaVolume.find(fields="uuid", **volume_args)
+        volume_uuid, cached = find_volume_uuid(volume_name, use_cache=False)
     except NetAppRestError:
         print("Error finding volume for snapshot listing!")
         raise
-    if volume is None:
+    if volume_uuid is None:
        print("Volume not found!")
        return
     
     # Create the snapshot.
     print("Creating snapshot " + snapshot_name + " in volume " + volume_name)
-    snapshot = NaSnapshot(volume.uuid)
+    snapshot = NaSnapshot(volume_uuid)
     snapshot.name = snapshot_name
     try:
-        snapshot.post()
+        done = submit_job(snapshot.post, "create snapshot " + snapshot_name + \
+                          " in volume " + volume_name)
     except NetAppRestError:
         print("Error creating snapshot!")
         raise
-    print("Created snapshot.")
+    uuid_cache_delete("snapshot", volume_uuid + "/" + snapshot_name)
+    if done:
+        print("Created snapshot.")
 
 
 def delete_snapshot(volume_name, snapshot_name):
-    # First find the volume uuid.
-    volume_args = {
-        "name": volume_name,
-        "svm.name": pyceRestConfig.ce_vserver,
+    from netapp_ontap.error import NetAppRestError
+    from netapp_ontap.resources import Snapshot as NaSnapshot
+
+    for use_cache in [True, False]:
+        # First find the volume uuid.
+        try:
+            volume_uuid, cached = find_volume_uuid(volume_name, use_cache)
+        except NetAppRestError:
+            print("Error finding volume for snapshot listing!")
+            raise
+        if volume_uuid is None:
+           print("Volume not found!")
+           return
+
+        # Then delete the snapshot by name, with one DELETE that also matches
+        # on the volume name.  A cached uuid that now belongs to another
+        # volume matches nothing, and the volume is looked up again.
+        if use_cache:
+            print("Deleting snapshot " + snapshot_name + " in volume " + volume_name)
+        delete = functools.partial(NaSnapshot.delete_collection, volume_uuid,
+                                   name=snapshot_name, **{"volume.name": volume_name})
+        try:
+            matched, done = submit_collection_job(delete, "delete snapshot " + \
+                                                  snapshot_name + " in volume " + volume_name)
+        except NetAppRestError as error:
+            if cached and stale_uuid_error(error):
+                uuid_cache_delete("volume", volume_name)
+                continue
+            print("Error deleting snapshot!")
+            raise
+        if cached and not matched:
+            uuid_cache_delete("volume", volume_name)
+            continue
+        break
+    uuid_cache_delete("snapshot", volume_uuid + "/" + snapshot_name)
+    if not matched:
+        print("Snapshot not found!")
+    elif done:
+        print("Deleted snapshot.")
+
+
+def parse_age(text):
+    # Returns the seconds in an age such as "90m", "12h", "7d" or "3600".
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+    text = text.strip().lower()
+    if text[-1:] in units:
+        return float(text[:-1]) * units[text[-1]]
+    return float(text)
+
+
+def parse_timestamp(text):
+    # Returns the epoch seconds of an ONTAP timestamp such as
+    # "2020-04-08T10:15:00-04:00".
+    seconds = calendar.timegm(time.strptime(text[:19], "%Y-%m-%dT%H:%M:%S"))
+    zone = text[19:]
+    if zone and zone != "Z":
+        hours, minutes = zone[1:].split(":")
+        offset = int(hours) * 3600 + int(minutes) * 60
+        if zone[0] == "-":
+            offset = -offset
+        seconds -= offset
+    return seconds
+
+
+def prune_plan(volume_pattern, keep, max_age, match):
+    # Returns the snapshots to delete as (volume name, volume uuid, snapshot
+    # name, snapshot uuid, create_time) tuples, and the matching snapshots
+    # without a create_time as (volume name, snapshot name) tuples.  Every
+    # snapshot of the matching volumes comes from one collection query.
+    # Within a volume, the snapshots whose names match the regex are deleted
+    # unless they are among the "keep" newest of them or are younger than
+    # max_age seconds.  A snapshot that cannot be dated is always kept.
+    from netapp_ontap.resources import Snapshot as NaSnapshot
+
+    snapshot_args = {
+        "volume.name": volume_pattern,
+        "svm.name": current_vserver(),
+        "fields": "volume.name,volume.uuid,name,create_time",
     }
+    pattern = None
+    if match:
+        pattern = re.compile(match)
+    volumes = collections.OrderedDict()
+    undated = []
+    for snapshot in collection_records(NaSnapshot, "*", **snapshot_args):
+        if pattern and not pattern.search(snapshot["name"]):
+            continue
+        volume = (snapshot["volume"]["name"], snapshot["volume"]["uuid"])
+        if record_value(snapshot, "create_time", None) is None:
+            undated.append((volume[0], snapshot["name"]))
+            continue
+        created = parse_timestamp(snapshot["create_time"])
+        volumes.setdefault(volume, []).append((created, snapshot))
+
+    now = time.time()
+    plan = []
+    for (volume_name, volume_uuid), snapshots in volumes.items():
+        snapshots.sort(key=lambda entry: entry[0], reverse=True)
+        for created, snapshot in snapshots[keep:]:
+            if max_age is not None and now - created < max_age:
+                continue
+            plan.append((volume_name, volume_uuid, snapshot["name"],
+                         snapshot["uuid"], snapshot["create_time"]))
+    return plan, undated
+
+
+def prune_snapshots(volume_pattern, keep, max_age, match, dry_run, workers,
+                    per_volume):
+    # Delete the snapshots chosen by prune_plan(), workers at a time and at
+    # most per_volume at a time in any one volume.  Returns True if every
+    # delete succeeded.
+    import concurrent.futures
+    from netapp_ontap.error import NetAppRestError
+    from netapp_ontap.resources import Snapshot as NaSnapshot
+
+    print_list_header("Finding snapshots to prune on volumes that match: " + volume_pattern)
     try:
-        volume = NaVolume.find(fields="uuid", **volume_args)
+        plan, undated = prune_plan(volume_pattern, keep or 0, max_age, match)
     except NetAppRestError:
-        print("Error finding volume for snapshot listing!")
+        print_list_message("Error retrieving snapshot list.")
         raise
-    if volume is None:
-       print("Volume not found!")
-       return
+    for volume_name, name in undated:
+        print_list_message("Keeping snapshot " + name + " in volume " + volume_name + \
+                           ", it has no create time.")
 
-    # Now find the snapshot and delete it.
-    snapshot_args = {
-        "name": snapshot_name,
+    # A dry run prints the plan, in any of the list output formats.
+    if dry_run:
+        if output_format() == "table":
+            print("")
+            print("%-32s %-32s %-28s" % ("Volume Name", "Snapshot Name", "Snapshot Date"))
+            print("----------------------------------------------------------------------------------------------")
+        print_records(["volume", "name", "create_time"],
+                      ((volume_name, name, create_time) for
+                       volume_name, volume_uuid, name, uuid, create_time in plan),
+                      "%-32s %-32s %-28s")
+        if output_format() == "table":
+            print("")
+            print("Would delete " + str(len(plan)) + " snapshots.")
+        return True
+
+    if not plan:
+        print("No snapshots to prune.")
+        return True
+    print("Pruning " + str(len(plan)) + " snapshots, " + str(workers) + \
+          " at a time and " + str(per_volume) + " at a time per volume")
+
+    # Split the deletes of each volume into per_volume lanes.  Each lane
+    # deletes its snapshots one after the other, waiting for each job, and
+    # the lanes run on the thread pool.
+    by_volume = collections.OrderedDict()
+    for entry in plan:
+        by_volume.setdefault(entry[1], []).append(entry)
+    lanes = []
+    for entries in by_volume.values():
+        for lane in range(min(per_volume, len(entries))):
+            lanes.append(entries[lane::per_volume])
+
+    print_lock = threading.Lock()
+    start = time.time()
+
+    def run_lane(entries):
+        failed = 0
+        with measure_operation("prune_snapshots", run=False):
+            for volume_name, volume_uuid, name, uuid, create_time in entries:
+                snapshot = NaSnapshot(volume_uuid, uuid=uuid)
+                try:
+                    submit_job(snapshot.delete, "delete snapshot " + name + \
+                               " in volume " + volume_name, wait=True)
+                    result = "Deleted snapshot %s in volume %s in %.2fs" % \
+                             (name, volume_name, time.time() - start)
+                except NetAppRestError as error:
+                    result = "Error deleting snapshot " + name + " in volume " + \
+                             volume_name + ": " + str(error)
+                    failed += 1
+                uuid_cache_delete("snapshot", volume_uuid + "/" + name)
+                with print_lock:
+                    print(result)
+        return failed
+
+    failed = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for lane_failed in executor.map(run_lane, lanes):
+            failed += lane_failed
+    print("Deleted %d of %d snapshots in %.2fs." % \
+          (len(plan) - failed, len(plan), time.time() - start))
+    return failed == 0
+
+
+def list_clones(volume_string, parent=None, parent_snapshot=None):
+    from netapp_ontap.error import NetAppRestError
+    from netapp_ontap.resources import Volume as NaVolume
+
+    if parent:
+        list_clone_tree(parent, parent_snapshot)
+        return
+
+    # Print header
+    print_list_header("Getting list of clones that match: " + volume_string,
+        "%-24s %-24s %-24s %-24s" % ("Parent Volume", "Parent Snapshot", "FlexClone Volume", "FlexClone Junction"),
+        "----------------------------------------------------------------------------------------------------")
+
+    # Get list of volume clones and print matches as we go.  As with
+    # list_volumes, the name match and field selection happen in a single
+    # paginated collection query.
+    volume_args = {
+        "svm.name": current_vserver(),
+        "clone.is_flexclone": True,
+        "name": "*" + volume_string + "*",
+        "fields": "name,clone.parent_volume.name,clone.parent_snapshot.name,nas.path",
     }
+
+    def records(volumes):
+        for volume in volumes:
+            if volume_string in volume["name"]:
+                yield (record_value(volume, "clone.parent_volume.name", None),
+                       record_value(volume, "clone.parent_snapshot.name", None),
+                       volume["name"], record_value(volume, "nas.path", None))
+
     try:
-        snapshot = NaSnapshot.find(volume.uuid, **snapshot_args)
+        print_records(["parent_volume", "parent_snapshot", "name", "junction_path"],
+                      records(collection_records(NaVolume, **volume_args)),
+                      "%-24s %-24s %-24s %-24s")
     except NetAppRestError:
-        print("Error finding snapshot!")
+        print_list_message("Error retrieving volume list.")
         raise
-    if snapshot:
-        print("Deleting snapshot " + snapshot_name + " in volume " + volume_name)
-        try:
-            snapshot.delete()
-        except NetAppRestError:
-            print("Error deleting snapshot!")
-            raise
-        print("Deleted snapshot.")
-    else:
-        print("Snapshot not found!")
-
 
-def list_clones(volume_string):
-    print("Getting list of clones that match: " + volume_string)
 
-    # Print header
-    print("")
-    print("%-24s %-24s %-24s %-24s" % ("Parent Volume", "Parent Snapshot", "FlexClone Volume", "FlexClone Junction"))
-    print("----------------------------------------------------------------------------------------------------")
+# The clone lineage of an SVM is read with one collection query of its
+# flexclones, and indexed by parent volume name.  A clone of a clone is
+# indexed under its parent clone, so the index holds every clone tree.
+def clone_index():
+    # Returns a dict of parent volume name to a list of (name, uuid,
+    # parent snapshot, junction path) tuples of its clones.
+    from netapp_ontap.resources import Volume as NaVolume
 
-    # Get list of volume clones and print matches as we go.    
     volume_args = {
-        "svm.name": pyceRestConfig.ce_vserver,
-        "clone.is_flexclone": True
+        "svm.name": current_vserver(),
+        "clone.is_flexclone": True,
+        "fields": "name,uuid,clone.parent_volume.name,clone.parent_snapshot.name,nas.path",
     }
+    index = collections.defaultdict(list)
+    for volume in collection_records(NaVolume, **volume_args):
+        parent = record_value(volume, "clone.parent_volume.name", None)
+        if parent:
+            index[parent].append((volume["name"], volume["uuid"],
+                                  record_value(volume, "clone.parent_snapshot.name", None),
+                                  record_value(volume, "nas.path", None)))
+    for clones in index.values():
+        clones.sort()
+    return index
+
+
+def clone_levels(index, parent, parent_snapshot=None):
+    # Returns the clones below parent as a list of levels, its clones first,
+    # then their clones and so on.  With parent_snapshot, only the clones of
+    # that snapshot of the parent (and their clones) are included.  Each
+    # level is a list of (parent, name, uuid, parent snapshot, junction path)
+    # tuples.
+    levels = []
+    level = [(parent,) + clone for clone in index.get(parent, [])
+             if not parent_snapshot or clone[2] == parent_snapshot]
+    seen = set([parent])
+    while level:
+        levels.append(level)
+        seen.update(clone[1] for clone in level)
+        level = [(clone[1],) + child for clone in level for child in index.get(clone[1], [])
+                 if child[0] not in seen]
+    return levels
+
+
+def list_clone_tree(parent, parent_snapshot=None):
+    from netapp_ontap.error import NetAppRestError
+
+    # Print header
+    message = "Getting clone tree of volume: " + parent
+    if parent_snapshot:
+        message += " snapshot: " + parent_snapshot
+    print_list_header(message,
+        "%-24s %-24s %-24s %-24s" % ("Parent Volume", "Parent Snapshot", "FlexClone Volume", "FlexClone Junction"),
+        "----------------------------------------------------------------------------------------------------")
+
     try:
-        for volume in NaVolume.get_collection(**volume_args): 
-            name = volume.to_dict()['name']
-            if volume_string in name:
-                try:
-                    volume.get(fields="name,clone,nas.path")
-                except NetAppRestError:
-                    print("Error retrieving volume details for volume: " + name)
-                    raise
-                volume_dict = volume.to_dict()
-                volume_name = snapshot = clone_name = junction_path = ""
-                if "name" in volume_dict:
-                    clone_name = volume_dict["name"]
-                if "clone" in volume_dict:
-                    if "parent_volume" in volume_dict["clone"]:
-                        volume_name = volume_dict["clone"]["parent_volume"]["name"]
-                    if "parent_snapshot" in volume_dict["clone"]:
-                        snapshot = volume_dict["clone"]["parent_snapshot"]["name"]
-                if "nas" in volume_dict:
-                    if "path" in volume_dict["nas"]:
-                        junction_path = volume_dict["nas"]["path"]
-                print("%-24s %-24s %-24s %-24s" % \
-                (volume_name, snapshot, clone_name, junction_path))
+        index = clone_index()
     except NetAppRestError:
-        print("Error retrieving volume list.")
+        print_list_message("Error retrieving clone list.")
         raise
 
-  
-def create_clone(volume, clone, snapshot, junction_path):
-    print("Creating clone volume " + clone + " of parent volume " + volume + \
-          " with snapshot " + snapshot + " and junction-path " + junction_path)
+    # Print each clone below its parent, with its level in the tree, which
+    # tables show by indenting the clone name.
+    children = collections.defaultdict(list)
+    for depth, level in enumerate(clone_levels(index, parent, parent_snapshot)):
+        for parent_name, name, uuid, snapshot, junction_path in level:
+            children[parent_name].append((parent_name, snapshot, name, junction_path, depth + 1))
 
-    # Build arguments for volume clone creation.
-    volume_dict = {
+    def records(name):
+        for record in children.get(name, []):
+            yield record
+            for child in records(record[2]):
+                yield child
+
+    def table_row(record):
+        parent_name, snapshot, name, junction_path, level = record
+        return (parent_name, snapshot or "", "  " * (level - 1) + name, junction_path or "")
+
+    print_records(["parent_volume", "parent_snapshot", "name", "junction_path", "level"],
+                  records(parent), "%-24s %-24s %-24s %-24s", table_row)
+
+
+def delete_volume_tree(name, workers, dry_run=False):
+    # Delete a volume and every clone below it, leaf first.  The clones of
+    # each level of the tree are deleted in parallel, workers at a time, and
+    # their jobs waited for with one poller.  Stops at the first level with
+    # a failure, since the clones above it cannot be deleted then.
+    import concurrent.futures
+    from netapp_ontap.error import NetAppRestError
+    from netapp_ontap.resources import Volume as NaVolume
+
+    try:
+        levels = clone_levels(clone_index(), name)
+    except NetAppRestError:
+        print("Error retrieving clone list.")
+        raise
+    # A dry run prints only the plan.
+    if dry_run:
+        for depth in range(len(levels) - 1, -1, -1):
+            for clone in levels[depth]:
+                print("Would delete clone %s (level %d, clone of %s)" % \
+                      (clone[1], depth + 1, clone[0]))
+        print("Would delete volume " + name)
+        return True
+    count = sum(len(level) for level in levels)
+    print("Deleting volume " + name + " and its " + str(count) + " clones in " + \
+          str(len(levels)) + " levels, " + str(workers) + " at a time")
+
+    def delete_one(clone, uuid):
+        with measure_operation("delete_volume", run=False):
+            response = NaVolume(uuid=uuid).delete(poll=False)
+        uuid_cache_delete("volume", clone)
+        uuid_cache_delete("mirror", clone)
+        return job_uuid(response)
+
+    start = time.time()
+    deleted = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for depth in range(len(levels) - 1, -1, -1):
+            poller = JobPoller()
+            failed = 0
+            futures = dict((executor.submit(delete_one, clone[1], clone[2]), clone[1])
+                           for clone in levels[depth])
+            for future in concurrent.futures.as_completed(futures):
+                clone = futures[future]
+                try:
+                    job = future.result()
+                except NetAppRestError as error:
+                    print("Error deleting clone " + clone + ": " + str(error))
+                    failed += 1
+                    continue
+                if job:
+                    poller.add(job, clone)
+                else:
+                    deleted += 1
+            for job, clone, state, message in poller.wait():
+                if state == "success":
+                    deleted += 1
+                else:
+                    print("Error deleting clone %s: %s %s" % (clone, state, message))
+                    failed += 1
+            print("Deleted level %d: %d of %d clones in %.2fs" % \
+                  (depth + 1, len(levels[depth]) - failed, len(levels[depth]),
+                   time.time() - start))
+            if failed:
+                print("Deleted %d of %d clones, not deleting volume %s." % \
+                      (deleted, count, name))
+                return False
+
+    delete_volume(name)
+    return True
+
+
+def clone_volume_dict(clone, junction_path, parent_volume, parent_snapshot):
+    # Build arguments for volume clone creation.  The parent volume and
+    # snapshot are given as dicts holding either their name or their uuid.
+    return {
         "svm": {
-            "name": pyceRestConfig.ce_vserver
+            "name": current_vserver()
         },
         "name": clone,
         "nas": {
@@ -344,136 +1157,3008 @@ def create_clone(volume, clone, snapshot, junction_path):
         }, 
         "clone": {
             "is_flexclone": "true",
-            "parent_snapshot": {"name": snapshot},
-            "parent_volume": {"name": volume},
+            "parent_snapshot": parent_snapshot,
+            "parent_volume": parent_volume,
         },
     }
 
+
+def create_clone(volume, clone, snapshot, junction_path):
+    from netapp_ontap.error import NetAppRestError
+    from netapp_ontap.resources import Volume as NaVolume
+
+    print("Creating clone volume " + clone + " of parent volume " + volume + \
+          " with snapshot " + snapshot + " and junction-path " + junction_path)
+
+    # Build arguments for volume clone creation.
+    volume_dict = clone_volume_dict(clone, junction_path,
+                                    {"name": volume}, {"name": snapshot})
+
     # Create the clone.
     volume = NaVolume.from_dict(volume_dict)
     try:
-        volume.post()
+        done = submit_job(volume.post, "create clone " + clone)
     except NetAppRestError:
         print("Error creating clone!")
         raise
+    uuid_cache_delete("volume", clone)
 
-    print("Volume clone created succesfully.")
+    if done:
+        print("Volume clone created succesfully.")
 
 
-def list_mirrors():
-    print("Getting list snapmirror relationships.")
+def template_names(name_template, junction_template, count):
+    # Returns the (name, junction path) of each of count volumes.  "{n}" is
+    # replaced by the number (1 to count) and, in the junction path template,
+    # "{name}" is replaced by the name.  A name template without "{n}" gets
+    # "_{n}" added.
+    if "{n" not in name_template:
+        name_template = name_template + "_{n}"
+    names = []
+    for n in range(1, count + 1):
+        name = name_template.format(n=n)
+        names.append((name, junction_template.format(n=n, name=name)))
+    return names
 
-    # Print header
-    print("")
-    print("%-32s %-32s %-16s %-16s" % ("Source", "Destination", "State", "Status"))
-    print("------------------------------------------------------------------------------------------------")
 
-    # Get list of volumes and print matches as we go.    
-    sm_args = {
-        "destination.svm.name": pyceRestConfig.ce_vserver
+def check_templates(op, name_template, junction_template, count):
+    # Returns an error message if the templates cannot be rendered, or would
+    # give several volumes the same junction path, otherwise returns None.
+    if count > 1 and "{n" not in junction_template:
+        return "Junction path template needs {n} or {name} for op: " + op
+    try:
+        template_names(name_template, junction_template, 1)
+    except KeyError as error:
+        return "Unknown field " + str(error) + " in name or junction path template " + \
+               "for op: " + op
+    except (IndexError, ValueError) as error:
+        return "Invalid name or junction path template (" + str(error) + \
+               ") for op: " + op
+    return None
+
+
+def create_clones(volume_name, snapshot_name, count, clone_template,
+                  junction_template, workers):
+    import concurrent.futures
+    from netapp_ontap.error import NetAppRestError
+    from netapp_ontap.resources import Volume as NaVolume
+    from netapp_ontap.resources import Snapshot as NaSnapshot
+
+    # Build the list of clone names and junction paths from the templates.
+    clones = template_names(clone_template, junction_template, count)
+    print("Creating " + str(count) + " clones of parent volume " + volume_name + \
+          " with snapshot " + snapshot_name + ", " + str(workers) + " at a time")
+
+    # Resolve the parent volume and snapshot once for all of the clones.
+    volume_args = {
+        "name": volume_name,
+        "svm.name": current_vserver(),
     }
     try:
-        for mirror in NaSnapmirrorRelationship.get_collection(**sm_args):
-            try:
-                mirror.get(fields="state,transfer,source.path,destination.path")
-            except NetAppRestError:
-                print("Error retrieving mirror details.")
-                raise
-            src = dst = state = status = ""
-            mirror_dict = mirror.to_dict()
-            if "source" in mirror_dict:
-                if "path" in mirror_dict["source"]:
-                    src = mirror_dict["source"]["path"]
-            if "destination" in mirror_dict:
-                if "path" in mirror_dict["destination"]:
-                    dst = mirror_dict["destination"]["path"]
-            if "state" in mirror_dict:
-                state = mirror_dict["state"]
-            if "transfer" in mirror_dict:
-                if "state" in mirror_dict["transfer"]:
-                    status = mirror_dict["transfer"]["state"]
-            # The transfer.status is only returned for active relationships.
-            if status == "":
-                status = "idle"
-            print("%-32s %-32s %-16s %-16s" % (src, dst, state, status))
+        volume = NaVolume.find(fields="uuid", **volume_args)
+    except NetAppRestError:
+        print("Error finding parent volume for clones!")
+        raise
+    if volume is None:
+        print("Volume not found!")
+        return False
+    try:
+        snapshot = NaSnapshot.find(volume.uuid, name=snapshot_name)
     except NetAppRestError:
-        print("Error retrieving mirror relationship list.")
+        print("Error finding parent snapshot for clones!")
         raise
+    if snapshot is None:
+        print("Snapshot not found!")
+        return False
+    parent_volume = {"uuid": volume.uuid}
+    parent_snapshot = {"uuid": snapshot.uuid}
 
+    # Submit the clone jobs from a thread pool without waiting for each one,
+    # then wait for all of them with a single job poller.  A clone job has
+    # finished once the clone is mounted at its junction path.
+    poller = JobPoller()
+
+    def create_one(clone, junction_path):
+        volume_dict = clone_volume_dict(clone, junction_path,
+                                        parent_volume, parent_snapshot)
+        with measure_operation("create_clones", run=False):
+            response = NaVolume.from_dict(volume_dict).post(poll=False)
+        uuid_cache_delete("volume", clone)
+        return job_uuid(response)
+
+    failed = 0
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for clone, junction_path in clones:
+            futures[executor.submit(create_one, clone, junction_path)] = \
+                (clone, junction_path)
+        for future in concurrent.futures.as_completed(futures):
+            clone, junction_path = futures[future]
+            try:
+                job = future.result()
+            except NetAppRestError as error:
+                print("Error creating clone " + clone + ": " + str(error))
+                failed += 1
+                continue
+            if job:
+                poller.add(job, (clone, junction_path))
+            else:
+                print("Created clone %s at %s in %.2fs" % \
+                      (clone, junction_path, time.time() - start))
+
+    for job, (clone, junction_path), state, message in poller.wait():
+        if state == "success":
+            print("Created clone %s at %s in %.2fs" % \
+                  (clone, junction_path, time.time() - start))
+        else:
+            print("Error creating clone " + clone + ": " + message)
+            failed += 1
+    elapsed = time.time() - start
+
+    print("Created %d of %d clones in %.2fs." % (count - failed, count, elapsed))
+    return failed == 0
+
+
+def list_mirrors():
+    from netapp_ontap.error import NetAppRestError
+    from netapp_ontap.resources import SnapmirrorRelationship as NaSnapmirrorRelationship
+
+    # Print header
+    print_list_header("Getting list snapmirror relationships.",
+        "%-32s %-32s %-16s %-16s" % ("Source", "Destination", "State", "Status"),
+        "------------------------------------------------------------------------------------------------")
+
+    # Get list of relationships and print them as we go.  The fields we
+    # print are requested in the collection query itself.
+    sm_args = {
+        "destination.svm.name": current_vserver(),
+        "fields": "state,transfer.state,source.path,destination.path",
+    }
+
+    def records(mirrors):
+        for mirror in mirrors:
+            # The transfer.status is only returned for active relationships.
+            yield (record_value(mirror, "source.path", None),
+                   record_value(mirror, "destination.path", None),
+                   record_value(mirror, "state", None),
+                   record_value(mirror, "transfer.state") or "idle")
+
+    try:
+        print_records(["source", "destination", "state", "status"],
+                      records(collection_records(NaSnapmirrorRelationship, **sm_args)),
+                      "%-32s %-32s %-16s %-16s")
+    except NetAppRestError:
+        print_list_message("Error retrieving mirror relationship list.")
+        raise
+
+
+def parse_duration(text):
+    # Returns the seconds in an ISO 8601 duration such as "PT8H35M42S", or
+    # None if there is no duration.
+    match = re.match(r"^P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$", text or "")
+    if not match:
+        return None
+    days, hours, minutes, seconds = [int(value or 0) for value in match.groups()]
+    return ((days * 24 + hours) * 60 + minutes) * 60 + seconds
+
+
+def format_seconds(seconds):
+    # "1d02h", "3h05m", "4m12s" or "9s".
+    seconds = int(seconds)
+    for size, unit, next_size, next_unit in [(86400, "d", 3600, "h"), (3600, "h", 60, "m"),
+                                             (60, "m", 1, "s")]:
+        if seconds >= size:
+            return "%d%s%02d%s" % (seconds // size, unit, seconds % size // next_size, next_unit)
+    return "%ds" % seconds
+
+
+def transfer_rate(samples, transfer_uuid):
+    # Bytes per second of a transfer, from the first and last samples of it
+    # in a relationship's ring buffer, or None with fewer than two samples.
+    transfer = [sample for sample in samples
+                if sample["transfer_uuid"] == transfer_uuid and sample["bytes"] is not None]
+    if len(transfer) < 2 or transfer[-1]["time"] <= transfer[0]["time"]:
+        return None
+    return (transfer[-1]["bytes"] - transfer[0]["bytes"]) / \
+           (transfer[-1]["time"] - transfer[0]["time"])
+
+
+def lag_trend(samples):
+    # Whether the lag of a relationship is "rising", "falling" or "steady"
+    # over its ring buffer.  A lag that grows by about a second per second
+    # means the mirror is not being updated.
+    lags = [sample for sample in samples if sample["lag"] is not None]
+    if len(lags) < 2 or lags[-1]["time"] <= lags[0]["time"]:
+        return None
+    slope = (lags[-1]["lag"] - lags[0]["lag"]) / (lags[-1]["time"] - lags[0]["time"])
+    if slope > 0.5:
+        return "rising"
+    if slope < -0.5:
+        return "falling"
+    return "steady"
+
+
+def mirror_changes(previous, sample):
+    # The events between two samples of a relationship.
+    events = []
+    if sample["state"] != previous["state"]:
+        events.append("state")
+    transferring = sample["transfer_state"] == "transferring"
+    was_transferring = previous["transfer_state"] == "transferring"
+    if was_transferring and (not transferring or
+                             sample["transfer_uuid"] != previous["transfer_uuid"]):
+        events.append("finished")
+    if transferring and (not was_transferring or
+                         sample["transfer_uuid"] != previous["transfer_uuid"]):
+        events.append("started")
+    elif transferring and sample["bytes"] != previous["bytes"]:
+        events.append("progress")
+    return events
+
+
+def mirror_events(interval, max_interval, history):
+    # Poll every relationship with one collection query per cycle and
+    # generate a record for each change.  The last "history" samples of each
+    # relationship are kept in a ring buffer for the transfer rates and lag
+    # trends.  While a transfer is running, or after a change, the next poll
+    # is "interval" seconds away.  Otherwise the wait doubles, up to
+    # max_interval seconds.
+    from netapp_ontap.resources import SnapmirrorRelationship as NaSnapmirrorRelationship
+
+    sm_args = {
+        "destination.svm.name": current_vserver(),
+        "fields": "source.path,destination.path,state,lag_time,"
+                  "transfer.uuid,transfer.state,transfer.bytes_transferred",
+    }
+    buffers = {}
+    delay = interval
+    while True:
+        now = time.time()
+        changed = False
+        seen = set()
+        for mirror in collection_records(NaSnapmirrorRelationship, **sm_args):
+            src = record_value(mirror, "source.path", None)
+            dst = record_value(mirror, "destination.path", None)
+            seen.add(dst)
+            sample = {
+                "time": now,
+                "state": record_value(mirror, "state", None),
+                "transfer_uuid": record_value(mirror, "transfer.uuid", None),
+                "transfer_state": record_value(mirror, "transfer.state", None),
+                "bytes": record_value(mirror, "transfer.bytes_transferred", None),
+                "lag": parse_duration(record_value(mirror, "lag_time", None)),
+            }
+            samples = buffers.get(dst)
+            if samples is None:
+                samples = buffers[dst] = collections.deque(maxlen=history)
+                events = ["found"]
+            else:
+                events = mirror_changes(samples[-1], sample)
+            previous_transfer = samples and samples[-1]["transfer_uuid"]
+            samples.append(sample)
+            for event in events:
+                changed = True
+                if event == "finished":
+                    rate = transfer_rate(samples, previous_transfer)
+                else:
+                    rate = transfer_rate(samples, sample["transfer_uuid"])
+                yield (time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(now)), src, dst,
+                       event, sample["state"], sample["transfer_state"],
+                       sample["bytes"], rate, sample["lag"], lag_trend(samples))
+        for dst in [dst for dst in buffers if dst not in seen]:
+            del buffers[dst]
+            changed = True
+            yield (time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(now)), None, dst,
+                   "removed", None, None, None, None, None, None)
+
+        # Everything for this cycle has been printed by now.
+        sys.stdout.flush()
+        active = any(samples[-1]["transfer_state"] == "transferring"
+                     for samples in buffers.values())
+        if changed or active:
+            delay = interval
+        else:
+            delay = min(delay * 2, max_interval)
+        time.sleep(delay)
+
+
+def watch_mirrors(interval):
+    # Print relationship changes until interrupted.
+    from netapp_ontap.error import NetAppRestError
+
+    print_list_header("Watching snapmirror relationships, press Ctrl-C to stop.",
+        "%-8s %-32s %-9s %s" % ("Time", "Destination", "Event", "Details"),
+        "------------------------------------------------------------------------------------------------")
+
+    def table_row(record):
+        when, src, dst, event, state, transfer_state, size, rate, lag, trend = record
+        details = []
+        if event == "found":
+            details.append("from " + src)
+        for value in [state, transfer_state]:
+            if value:
+                details.append(value)
+        if size is not None and event in ["started", "progress"]:
+            details.append("%.2f GB" % (size / (1024.0*1024*1024)))
+        if rate is not None:
+            details.append("at %.1f MB/s" % (rate / (1024.0*1024)))
+        if lag is not None:
+            details.append("lag " + format_seconds(lag))
+        if trend:
+            details.append(trend)
+        return (when[11:], dst, event, ", ".join(details))
+
+    events = mirror_events(interval, config_option("ce_watch_max_interval", 60),
+                           config_option("ce_watch_history", 10))
+    try:
+        print_records(["time", "source", "destination", "event", "state",
+                       "transfer_state", "bytes_transferred", "throughput", "lag",
+                       "lag_trend"],
+                      events, "%-8s %-32s %-9s %s", table_row)
+    except NetAppRestError:
+        print_list_message("Error retrieving mirror relationship list.")
+        raise
+    except KeyboardInterrupt:
+        sys.stdout.flush()
+
+
+def create_mirror(src, dst):
+    from netapp_ontap.error import NetAppRestError
+    from netapp_ontap.resources import SnapmirrorRelationship as NaSnapmirrorRelationship
 
-def create_mirror(src, dst):
     print("Creating mirror " + dst + " of source " + src)
 
-    # Build arguments for volume creation.
-    sm_dict = {
-        "source": {
-            "path": pyceRestConfig.ce_vserver + ":" + src
-        },
-        "destination": {
-            "path": pyceRestConfig.ce_vserver + ":" + dst
-        },
-    }
+    # Build arguments for volume creation.
+    sm_dict = {
+        "source": {
+            "path": current_vserver() + ":" + src
+        },
+        "destination": {
+            "path": current_vserver() + ":" + dst
+        },
+    }
+
+    # Create the snapmirror.
+    # This assumes we have already created a DP mirror destination.
+    mirror = NaSnapmirrorRelationship.from_dict(sm_dict)
+    try:
+        done = submit_job(mirror.post, "create mirror " + dst)
+    except NetAppRestError:
+        print("Error creating mirror!")
+        raise
+    uuid_cache_delete("mirror", dst)
+    if done:
+        print("Mirror created succesfully.")
+
+
+def update_mirror(dst):
+    from netapp_ontap.error import NetAppRestError
+    from netapp_ontap.resources import SnapmirrorTransfer as NaSnapmirrorTransfer
+
+    # First find the snapmirror relationship uuid.  A transfer can only be
+    # started through the uuid.  If a cached one was given to another mirror
+    # after renames, that mirror is brought up to date from its own source.
+    # This loses no data, so the cache is used and only a 404 is stale.
+    try:
+        mirror_uuid, cached = find_mirror_uuid(dst)
+    except NetAppRestError:
+        print("Error finding mirror volume!")
+        raise
+
+    # If we found the relationshp, perform the update.
+    if mirror_uuid:
+        print("Updating mirror " + dst)
+        mirror_transfer = NaSnapmirrorTransfer(mirror_uuid)
+        try:
+            done = submit_job(mirror_transfer.post, "update mirror " + dst)
+        except NetAppRestError as error:
+            if cached and stale_uuid_error(error):
+                uuid_cache_delete("mirror", dst)
+                return update_mirror(dst)
+            print("Error updating mirror!")
+            raise
+        if done:
+            print("Mirror updated.")
+    else:
+        print("Mirror not found.")
+
+
+# States in which a snapmirror transfer has finished.
+transfer_done_states = ["success", "failed", "aborted", "hard_aborted"]
+
+
+def find_mirror_uuids(mirror_string):
+    # Resolve a comma separated list of destination volumes, which may
+    # contain "*" wildcards, with one collection query.  Returns a list of
+    # (destination path, relationship uuid) tuples and a list of the names
+    # without wildcards that were not found.
+    from netapp_ontap.resources import SnapmirrorRelationship as NaSnapmirrorRelationship
+
+    vserver = current_vserver()
+    names = [name.strip() for name in mirror_string.split(",") if name.strip()]
+    sm_args = {
+        "destination.path": "|".join(vserver + ":" + name for name in names),
+        "destination.svm.name": vserver,
+        "fields": "uuid,destination.path",
+        "order_by": "destination.path",
+    }
+    mirrors = []
+    for mirror in collection_records(NaSnapmirrorRelationship, **sm_args):
+        dst = mirror["destination"]["path"]
+        mirrors.append((dst, mirror["uuid"]))
+        uuid_cache_put("mirror", dst.split(":", 1)[-1], mirror["uuid"])
+    found = set(dst for dst, uuid in mirrors)
+    missing = [name for name in names
+               if "*" not in name and vserver + ":" + name not in found]
+    return mirrors, missing
+
+
+def poll_transfers(running):
+    # Check the transfers in running, a dict of relationship uuid to
+    # transfer uuid, and return a dict of relationship uuid to (state,
+    # bytes transferred) for the ones that have finished.  The relationships
+    # are queried 100 at a time.  A transfer that is no longer the current
+    # one of its relationship is looked up on its own.
+    from netapp_ontap.resources import SnapmirrorRelationship as NaSnapmirrorRelationship
+    from netapp_ontap.resources import SnapmirrorTransfer as NaSnapmirrorTransfer
+
+    uuids = list(running)
+    finished = {}
+    for start in range(0, len(uuids), 100):
+        sm_args = {
+            "uuid": "|".join(uuids[start:start + 100]),
+            "fields": "transfer.uuid,transfer.state,transfer.bytes_transferred",
+        }
+        for mirror in collection_records(NaSnapmirrorRelationship, **sm_args):
+            transfer_uuid = running[mirror["uuid"]]
+            state = record_value(mirror, "transfer.state", None)
+            size = record_value(mirror, "transfer.bytes_transferred", None)
+            if transfer_uuid and record_value(mirror, "transfer.uuid", None) != transfer_uuid:
+                transfer = NaSnapmirrorTransfer(mirror["uuid"], uuid=transfer_uuid)
+                transfer.get(fields="state,bytes_transferred")
+                state = getattr(transfer, "state", None)
+                size = getattr(transfer, "bytes_transferred", None)
+            if state in transfer_done_states:
+                finished[mirror["uuid"]] = (state, size)
+    return finished
+
+
+def update_mirrors(mirror_string, workers, wait):
+    # Start a transfer for every relationship whose destination matches
+    # mirror_string, with at most "workers" transfers in flight.  With wait,
+    # the transfers are tracked by poll_transfers() until they finish, and
+    # further transfers start as earlier ones finish.  Returns True if every
+    # transfer started, and with wait, succeeded.
+    import concurrent.futures
+    from netapp_ontap.error import NetAppRestError
+    from netapp_ontap.resources import SnapmirrorTransfer as NaSnapmirrorTransfer
+
+    print("Finding mirrors that match: " + mirror_string)
+    try:
+        mirrors, missing = find_mirror_uuids(mirror_string)
+    except NetAppRestError:
+        print("Error finding mirror volumes!")
+        raise
+    for name in missing:
+        print("Mirror not found: " + name)
+    if not mirrors:
+        print("No mirrors to update.")
+        return not missing
+    print("Updating " + str(len(mirrors)) + " mirrors, " + str(workers) + " at a time")
+
+    def start_transfer(mirror):
+        dst, mirror_uuid = mirror
+        transfer = NaSnapmirrorTransfer(mirror_uuid)
+        with measure_operation("update_mirrors", run=False):
+            try:
+                submit_job(transfer.post, "update mirror " + dst, wait=True)
+            except NetAppRestError as error:
+                return None, error
+        return getattr(transfer, "uuid", None), None
+
+    interval = config_option("ce_transfer_poll_interval", 5)
+    timeout = config_option("ce_transfer_timeout", 3600)
+    queue = list(mirrors)
+    running = collections.OrderedDict()
+    results = collections.Counter()
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        while queue or running:
+            batch = queue[:workers - len(running)]
+            del queue[:len(batch)]
+            for (dst, mirror_uuid), (transfer_uuid, error) in \
+                    zip(batch, executor.map(start_transfer, batch)):
+                if error is not None:
+                    print("Error updating mirror " + dst + ": " + str(error))
+                    results["failed"] += 1
+                elif not wait:
+                    print("Started transfer for mirror " + dst)
+                    results["started"] += 1
+                elif transfer_uuid is None:
+                    print("Started transfer for mirror " + dst + ", but cannot track it.")
+                    results["unknown"] += 1
+                else:
+                    running[mirror_uuid] = (dst, transfer_uuid, time.time())
+            if not running:
+                continue
+
+            # Wait for a transfer to finish before starting more.
+            time.sleep(interval)
+            poll_start = time.time()
+            try:
+                finished = poll_transfers(collections.OrderedDict(
+                    (mirror_uuid, transfer[1]) for mirror_uuid, transfer in running.items()))
+            except NetAppRestError:
+                print("Error polling transfer status.")
+                raise
+            add_job_wait(time.time() - poll_start + interval)
+            now = time.time()
+            for mirror_uuid, (dst, transfer_uuid, started) in list(running.items()):
+                if mirror_uuid in finished:
+                    state, size = finished[mirror_uuid]
+                    message = "Mirror %s: %s in %.1fs" % (dst, state, now - started)
+                    if size is not None:
+                        message += ", %.2f GB" % (size / (1024.0*1024*1024))
+                elif now - started > timeout:
+                    state = "timeout"
+                    message = "Mirror %s: timed out after %.1fs" % (dst, now - started)
+                else:
+                    continue
+                del running[mirror_uuid]
+                results[state] += 1
+                print(message)
+
+    total = len(mirrors) + len(missing)
+    if wait:
+        print("Updated %d of %d mirrors in %.2fs." % (results["success"], total,
+                                                      time.time() - start))
+        succeeded = results["success"]
+    else:
+        print("Started %d of %d mirror updates in %.2fs." % (results["started"], total,
+                                                            time.time() - start))
+        succeeded = results["started"]
+    problems = ["%d %s" % (count, state) for state, count in sorted(results.items())
+                if state not in ["success", "started"]]
+    if missing:
+        problems.append("%d not found" % len(missing))
+    if problems:
+        print("    " + ", ".join(problems))
+    return succeeded == total
+
+
+def delete_mirror(dst):
+    from netapp_ontap.error import NetAppRestError
+    from netapp_ontap.resources import SnapmirrorRelationship as NaSnapmirrorRelationship
+
+    # Delete the relationship by its destination path, with one DELETE and
+    # no uuid lookup.
+    print("Deleting mirror " + dst)
+    sm_args = {
+        "destination.path": current_vserver() + ":" + dst,
+        "destination.svm.name": current_vserver(),
+    }
+    delete = functools.partial(NaSnapmirrorRelationship.delete_collection, **sm_args)
+    try:
+        matched, done = submit_collection_job(delete, "delete mirror " + dst)
+    except NetAppRestError:
+        print("Error deleting mirror!")
+        raise
+    uuid_cache_delete("mirror", dst)
+    if not matched:
+        print("Mirror not found.")
+    elif done:
+        print("Mirror deleted.")
+
+
+# ---------------------------------------------------------------------------
+# UUID CACHE
+#
+# Name to uuid mappings for volumes, snapshots and snapmirror relationships
+# are kept in a small SQLite database under the user's cache directory, keyed
+# by cluster and SVM.  Entries expire after ce_uuid_cache_ttl seconds and the
+# oldest entries are evicted once there are more than ce_uuid_cache_size.
+# Our own create, delete and remount operations invalidate the names they
+# touch, and a cached uuid that the cluster no longer knows about (HTTP 404)
+# is dropped and looked up again.  A volume renamed outside of pyce_rest can
+# leave a name pointing at another volume that still exists, so calls made
+# with a cached volume uuid also match on the volume name (list_snapshots,
+# delete_snapshot), and create_snapshot, whose call has no such filter, does
+# not use the cache.
+# ---------------------------------------------------------------------------
+
+uuid_cache_local = threading.local()
+
+
+def uuid_cache_path():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or \
+                 os.path.join(os.path.expanduser("~"), ".cache")
+    return config_option("ce_uuid_cache_path",
+                         os.path.join(cache_home, "pyce_rest", "uuid_cache.sqlite"))
+
+
+def uuid_cache_db():
+    # Returns this thread's connection to the cache database, or None if the
+    # cache is disabled or cannot be opened.
+    if config_option("ce_uuid_cache_ttl", 0) <= 0:
+        return None
+    db = getattr(uuid_cache_local, "db", None)
+    if db is None:
+        path = uuid_cache_path()
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            db = sqlite3.connect(path, timeout=5)
+            db.execute("CREATE TABLE IF NOT EXISTS uuids ("
+                       "cluster TEXT, svm TEXT, kind TEXT, name TEXT, "
+                       "uuid TEXT, stored REAL, "
+                       "PRIMARY KEY (cluster, svm, kind, name))")
+            db.commit()
+        except (OSError, sqlite3.Error):
+            db = False
+        uuid_cache_local.db = db
+    return db or None
+
+
+def uuid_cache_get(kind, name):
+    db = uuid_cache_db()
+    if db is None:
+        return None
+    oldest = time.time() - config_option("ce_uuid_cache_ttl", 0)
+    try:
+        row = db.execute("SELECT uuid FROM uuids WHERE cluster = ? AND svm = ? "
+                         "AND kind = ? AND name = ? AND stored > ?",
+                         (current_cluster(), current_vserver(),
+                          kind, name, oldest)).fetchone()
+    except sqlite3.Error:
+        return None
+    if row:
+        return row[0]
+    return None
+
+
+def uuid_cache_put(kind, name, uuid):
+    db = uuid_cache_db()
+    if db is None:
+        return
+    now = time.time()
+    try:
+        db.execute("INSERT OR REPLACE INTO uuids VALUES (?, ?, ?, ?, ?, ?)",
+                   (current_cluster(), current_vserver(),
+                    kind, name, uuid, now))
+        # Drop expired entries, then the oldest ones if we are over size.
+        db.execute("DELETE FROM uuids WHERE stored <= ?",
+                   (now - config_option("ce_uuid_cache_ttl", 0),))
+        db.execute("DELETE FROM uuids WHERE rowid IN (SELECT rowid FROM uuids "
+                   "ORDER BY stored DESC LIMIT -1 OFFSET ?)",
+                   (config_option("ce_uuid_cache_size", 10000),))
+        db.commit()
+    except sqlite3.Error:
+        pass
+
+
+def uuid_cache_delete(kind, name):
+    db = uuid_cache_db()
+    if db is None:
+        return
+    try:
+        db.execute("DELETE FROM uuids WHERE cluster = ? AND svm = ? "
+                   "AND kind = ? AND name = ?",
+                   (current_cluster(), current_vserver(),
+                    kind, name))
+        db.commit()
+    except sqlite3.Error:
+        pass
+
+
+def stale_uuid_error(error):
+    # A 404 means the uuid we used no longer exists on the cluster.
+    response = error.http_err_response
+    return response is not None and response.http_response.status_code == 404
+
+
+def find_volume_uuid(volume_name, use_cache=True):
+    # Returns the volume uuid (or None if there is no such volume) and
+    # whether it came from the cache.  A cached uuid is only a hint: callers
+    # that change anything pass use_cache=False.
+    from netapp_ontap.resources import Volume as NaVolume
+
+    uuid = use_cache and uuid_cache_get("volume", volume_name)
+    if uuid:
+        return uuid, True
+    volume_args = {
+        "name": volume_name,
+        "svm.name": current_vserver(),
+    }
+    volume = NaVolume.find(fields="uuid", **volume_args)
+    if volume is None:
+        return None, False
+    uuid_cache_put("volume", volume_name, volume.uuid)
+    return volume.uuid, False
+
+
+def find_snapshot_uuid(volume_uuid, snapshot_name, use_cache=True):
+    # Same as find_volume_uuid(), for a snapshot in the given volume.
+    from netapp_ontap.resources import Snapshot as NaSnapshot
+
+    key = volume_uuid + "/" + snapshot_name
+    uuid = use_cache and uuid_cache_get("snapshot", key)
+    if uuid:
+        return uuid, True
+    snapshot = NaSnapshot.find(volume_uuid, name=snapshot_name)
+    if snapshot is None:
+        return None, False
+    uuid_cache_put("snapshot", key, snapshot.uuid)
+    return snapshot.uuid, False
+
+
+def find_mirror_uuid(dst, use_cache=True):
+    # Same as find_volume_uuid(), for the snapmirror relationship of the
+    # given destination volume.
+    from netapp_ontap.resources import SnapmirrorRelationship as NaSnapmirrorRelationship
+
+    uuid = use_cache and uuid_cache_get("mirror", dst)
+    if uuid:
+        return uuid, True
+    sm_args = {
+        "destination.path": current_vserver() + ":" + dst,
+        "destination.svm.name": current_vserver(),
+    }
+    mirror = NaSnapmirrorRelationship.find(fields="uuid", **sm_args)
+    if mirror is None:
+        return None, False
+    uuid_cache_put("mirror", dst, mirror.uuid)
+    return mirror.uuid, False
+
+
+# ---------------------------------------------------------------------------
+# JOBS
+#
+# By default every post(), patch() and delete() polls its own ONTAP job until
+# it finishes.  With "--no-wait", mutating operations only submit their jobs
+# and print the job uuids.  The jobs are then tracked by one JobPoller, which
+# checks all of them with a single /cluster/jobs collection query per
+# interval, so waiting for many jobs takes about as long as the slowest one.
+# ---------------------------------------------------------------------------
+
+# The job poller used for deferred jobs, or None to wait for each job.
+job_state = {"poller": None}
+
+# Set "blocking" on a thread to wait for each job even when jobs are
+# deferred, for operations that depend on an earlier job having finished.
+job_local = threading.local()
+
+# Job states that mean the job has finished.
+job_done_states = ["success", "failure"]
+
+
+def job_uuid(response):
+    # Returns the job uuid of a post(poll=False) style response, or None if
+    # the call completed without starting a job.
+    try:
+        return response.http_response.json()["job"]["uuid"]
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+
+def submit_job(call, description, wait=False):
+    # Make a post(), patch() or delete() call.  Returns True if the change is
+    # complete, or False if its job was handed to the job poller.  With
+    # wait=True the call always waits for its job.
+    poller = job_state["poller"]
+    if wait or poller is None or getattr(job_local, "blocking", False):
+        with measure_job_wait():
+            call()
+        return True
+    job = job_uuid(call(poll=False))
+    if job is None:
+        return True
+    poller.add(job, description)
+    print("Submitted job " + job + " to " + description + ".")
+    return False
+
+
+def submit_collection_job(call, description, wait=False):
+    # Same as submit_job(), for a patch_collection() or delete_collection()
+    # call with a query, which starts a job for each record it matches.
+    # Returns the number of records matched and whether the change is
+    # complete.
+    poller = job_state["poller"]
+    if wait or poller is None or getattr(job_local, "blocking", False):
+        with measure_job_wait():
+            response = call()
+        return response.http_response.json().get("num_records", 0), True
+    body = call(poll=False).http_response.json()
+    jobs = [job["uuid"] for job in body.get("jobs", []) if job.get("uuid")]
+    for job in jobs:
+        poller.add(job, description)
+        print("Submitted job " + job + " to " + description + ".")
+    return body.get("num_records", 0), not jobs
+
+
+@contextlib.contextmanager
+def blocking_jobs():
+    blocking = getattr(job_local, "blocking", False)
+    job_local.blocking = True
+    try:
+        yield
+    finally:
+        job_local.blocking = blocking
+
+
+class JobPoller(object):
+    # Tracks outstanding ONTAP jobs, each with a caller supplied description.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def add(self, job, description):
+        with self.lock:
+            self.pending[job] = description
+
+    def poll(self):
+        # Check every pending job and return a list of (uuid, description,
+        # state, message) tuples for the jobs that have finished.  Jobs are
+        # queried 100 at a time to keep the query string short.
+        from netapp_ontap.resources import Job as NaJob
+
+        with self.lock:
+            jobs = list(self.pending)
+        finished = []
+        for start in range(0, len(jobs), 100):
+            job_args = {
+                "uuid": "|".join(jobs[start:start + 100]),
+                "fields": "state,message",
+            }
+            for job in NaJob.get_collection(**job_args):
+                job_dict = job.to_dict()
+                state = job_dict.get("state")
+                if state not in job_done_states:
+                    continue
+                with self.lock:
+                    description = self.pending.pop(job_dict["uuid"], None)
+                finished.append((job_dict["uuid"], description, state,
+                                 job_dict.get("message", "")))
+        return finished
+
+    def wait(self):
+        # Generate (uuid, description, state, message) tuples as the pending
+        # jobs finish.  Jobs still running after ce_job_poll_timeout seconds
+        # are reported with a "timeout" state.
+        from netapp_ontap.error import NetAppRestError
+
+        interval = config_option("ce_job_poll_interval", 2)
+        deadline = time.time() + config_option("ce_job_poll_timeout", 600)
+        while self.pending:
+            start = time.time()
+            try:
+                finished = self.poll()
+            except NetAppRestError:
+                print("Error polling job status.")
+                raise
+            add_job_wait(time.time() - start)
+            for result in finished:
+                yield result
+            if not self.pending:
+                break
+            if time.time() > deadline:
+                with self.lock:
+                    pending = self.pending
+                    self.pending = {}
+                for job, description in pending.items():
+                    yield (job, description, "timeout",
+                           "Timed out waiting for job to finish.")
+                break
+            time.sleep(interval)
+            add_job_wait(interval)
+
+
+def wait_jobs(poller):
+    # Wait for the poller's jobs and print their results.  Returns True if
+    # they all succeeded.
+    if not poller.pending:
+        return True
+    print("Waiting for " + str(len(poller.pending)) + " jobs.")
+    total = failed = 0
+    for job, description, state, message in poller.wait():
+        total += 1
+        if description:
+            print("Job " + job + " to " + description + ": " + state)
+        else:
+            print("Job " + job + ": " + state)
+        if state != "success":
+            failed += 1
+            if message:
+                print("    " + message)
+    print("%d of %d jobs succeeded." % (total - failed, total))
+    return failed == 0
+
+
+# ---------------------------------------------------------------------------
+# CLONE POOLS
+#
+# A clone pool keeps ready, unmounted clones of a parent snapshot, named
+# with the pool's prefix, so that checkout_clone only has to rename and
+# mount one of them with a single PATCH.  Pools are defined in
+# ce_clone_pools.  When the pool is empty, checkout_clone falls back to
+# creating the clone, which counts as a miss.  Checkouts and returns submit
+# the clone jobs that refill the pool without waiting for them, and
+# fill_pool creates the missing clones and waits for them.
+#
+# The hit and miss counts of each pool are kept in an SQLite database next
+# to the uuid cache, and a write transaction on it serializes the checkouts
+# made on this host, so that two of them cannot take the same clone.
+# ---------------------------------------------------------------------------
+
+pool_local = threading.local()
+pool_counters = ["hits", "misses", "destroyed"]
+
+
+def clone_pool(pool_name):
+    # Returns the settings of a pool, with the default prefix filled in.
+    pool = dict(config_option("ce_clone_pools", {})[pool_name])
+    pool.setdefault("prefix", "pool_" + pool_name + "_")
+    return pool
+
+
+def pool_db():
+    # Returns this thread's connection to the pool database, or None if it
+    # cannot be opened.  Transactions are managed by pool_lock().
+    db = getattr(pool_local, "db", None)
+    if db is None:
+        path = config_option("ce_clone_pool_db",
+                             os.path.join(os.path.dirname(uuid_cache_path()),
+                                          "clone_pools.sqlite"))
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            db = sqlite3.connect(path, timeout=300, isolation_level=None)
+            db.execute("CREATE TABLE IF NOT EXISTS pool_stats ("
+                       "cluster TEXT, svm TEXT, pool TEXT, hits INTEGER, "
+                       "misses INTEGER, destroyed INTEGER, "
+                       "PRIMARY KEY (cluster, svm, pool))")
+        except (OSError, sqlite3.Error):
+            db = False
+        pool_local.db = db
+    return db or None
+
+
+@contextlib.contextmanager
+def pool_lock():
+    # Hold a write transaction on the pool database, which other processes
+    # wait for.
+    db = pool_db()
+    if db is None:
+        yield
+        return
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+    finally:
+        db.execute("COMMIT")
+
+
+def pool_count(pool_name, counter):
+    db = pool_db()
+    if db is None:
+        return
+    key = (current_cluster(), current_vserver(), pool_name)
+    try:
+        db.execute("INSERT OR IGNORE INTO pool_stats (cluster, svm, pool, hits, misses, "
+                   "destroyed) VALUES (?, ?, ?, 0, 0, 0)", key)
+        db.execute("UPDATE pool_stats SET " + counter + " = " + counter + " + 1 "
+                   "WHERE cluster = ? AND svm = ? AND pool = ?", key)
+    except sqlite3.Error:
+        pass
+
+
+def pool_stats(pool_name):
+    # Returns a dict of the pool's counters.
+    stats = dict((counter, 0) for counter in pool_counters)
+    db = pool_db()
+    if db is None:
+        return stats
+    try:
+        row = db.execute("SELECT " + ", ".join(pool_counters) + " FROM pool_stats "
+                         "WHERE cluster = ? AND svm = ? AND pool = ?",
+                         (current_cluster(), current_vserver(),
+                          pool_name)).fetchone()
+    except sqlite3.Error:
+        return stats
+    if row:
+        stats.update(zip(pool_counters, row))
+    return stats
+
+
+def pool_clones(pool):
+    # Returns the (name, uuid) of the pool's ready clones, oldest first, with
+    # one collection query.
+    from netapp_ontap.resources import Volume as NaVolume
+
+    volume_args = {
+        "name": pool["prefix"] + "*",
+        "svm.name": current_vserver(),
+        "clone.parent_volume.name": pool["volume"],
+        "state": "online",
+        "fields": "name,uuid,create_time",
+        "order_by": "create_time",
+    }
+    return [(volume["name"], volume["uuid"])
+            for volume in collection_records(NaVolume, **volume_args)]
+
+
+def submit_pool_clones(pool, count):
+    # Submit the jobs of count new pool clones without waiting for them.
+    # Returns a JobPoller holding the jobs and a list of errors.
+    from netapp_ontap.error import NetAppRestError
+    from netapp_ontap.resources import Volume as NaVolume
+
+    poller = JobPoller()
+    errors = []
+    for n in range(count):
+        name = pool["prefix"] + os.urandom(6).hex()
+        volume_dict = clone_volume_dict(name, "", {"name": pool["volume"]},
+                                        {"name": pool["snapshot"]})
+        del volume_dict["nas"]
+        try:
+            job = job_uuid(NaVolume.from_dict(volume_dict).post(poll=False))
+        except NetAppRestError as error:
+            errors.append(str(error))
+            continue
+        if job:
+            poller.add(job, name)
+    return poller, errors
+
+
+def refill_pool(pool_name, pool, ready, wait=False):
+    # Submit the clones the pool is short of, given its number of ready
+    # clones, and with wait, wait for them.  Returns True if every clone was
+    # submitted, or with wait, created.
+    missing = pool["size"] - ready
+    if missing <= 0:
+        return True
+    poller, errors = submit_pool_clones(pool, missing)
+    return report_refill(pool_name, missing, poller, errors, wait)
+
+
+def report_refill(pool_name, missing, poller, errors, wait=False):
+    for error in errors:
+        print("Error refilling pool " + pool_name + ": " + error)
+    failed = len(errors)
+    if not wait:
+        print("Refilling pool " + pool_name + " with " + str(missing - failed) + " clones.")
+        return failed == 0
+    for job, name, state, message in poller.wait():
+        if state != "success":
+            print("Error creating pool clone " + name + ": " + message)
+            failed += 1
+    print("Added %d clones to pool %s." % (missing - failed, pool_name))
+    return failed == 0
+
+
+def fill_pool(pool_name):
+    # Create the clones the pool is short of and wait for them.
+    from netapp_ontap.error import NetAppRestError
+
+    pool = clone_pool(pool_name)
+    try:
+        ready = len(pool_clones(pool))
+    except NetAppRestError:
+        print("Error listing pool clones!")
+        raise
+    print("Pool %s has %d of %d clones ready." % (pool_name, ready, pool["size"]))
+    return refill_pool(pool_name, pool, ready, wait=True)
+
+
+def checkout_clone(pool_name, clone, junction_path):
+    # Rename a ready clone of the pool to clone and mount it at
+    # junction_path, with one PATCH, or create the clone if the pool is
+    # empty.  The pool is refilled on another thread while the clone is
+    # being checked out.
+    from netapp_ontap.error import NetAppRestError
+    from netapp_ontap.resources import Volume as NaVolume
+
+    pool = clone_pool(pool_name)
+    start = time.time()
+    refill = None
+    checked_out = None
+    with pool_lock():
+        try:
+            ready = pool_clones(pool)
+        except NetAppRestError:
+            print("Error listing pool clones!")
+            raise
+        # Taking a clone leaves the pool one short.
+        missing = pool["size"] - max(0, len(ready) - 1)
+        refill_results = []
+
+        def refill_pool_clones():
+            with measure_operation("checkout_clone", run=False):
+                refill_results.append(submit_pool_clones(pool, missing))
+
+        refill = threading.Thread(target=refill_pool_clones)
+        refill.start()
+        for name, uuid in ready:
+            # The PATCH only matches the clone while it still has its pool
+            # name.  The pool lock only covers this user on this host, so
+            # another host may have taken or deleted it, and then we try the
+            # next one.
+            body = {"name": clone, "nas": {"path": junction_path}}
+            claim = functools.partial(NaVolume.patch_collection, body, uuid=uuid, name=name)
+            try:
+                matched, done = submit_collection_job(claim, "check out clone " + clone,
+                                                      wait=True)
+            except NetAppRestError:
+                print("Error checking out clone!")
+                raise
+            if not matched:
+                continue
+            checked_out = name
+            break
+
+    try:
+        if checked_out:
+            pool_count(pool_name, "hits")
+            print("Checked out pool clone %s as %s at %s in %.2fs." % \
+                  (checked_out, clone, junction_path, time.time() - start))
+        else:
+            pool_count(pool_name, "misses")
+            print("Pool " + pool_name + " is empty.")
+            create_clone(pool["volume"], clone, pool["snapshot"], junction_path)
+        uuid_cache_delete("volume", clone)
+    finally:
+        refill.join()
+    if missing > 0 and refill_results:
+        poller, errors = refill_results[0]
+        report_refill(pool_name, missing, poller, errors)
+
+
+def return_clone(pool_name, clone):
+    # Destroy a clone checked out from the pool and refill the pool.  A used
+    # clone is never put back, since its data may have changed.
+    from netapp_ontap.error import NetAppRestError
+    from netapp_ontap.resources import Volume as NaVolume
+
+    pool = clone_pool(pool_name)
+    volume_args = {
+        "name": clone,
+        "svm.name": current_vserver(),
+    }
+    try:
+        volume = NaVolume.find(fields="uuid,clone.parent_volume.name", **volume_args)
+    except NetAppRestError:
+        print("Error finding clone to return!")
+        raise
+    if volume is None:
+        print("Error: Volume not found!")
+        return
+    volume = volume.to_dict()
+    if record_value(volume, "clone.parent_volume.name", None) != pool["volume"]:
+        print("Error: " + clone + " is not a clone of pool " + pool_name + "!")
+        return
+
+    with pool_lock():
+        try:
+            ready = len(pool_clones(pool))
+        except NetAppRestError:
+            print("Error listing pool clones!")
+            raise
+
+    try:
+        done = submit_job(NaVolume(uuid=volume["uuid"]).delete, "delete volume " + clone)
+    except NetAppRestError:
+        print("Error deleting clone!")
+        raise
+    uuid_cache_delete("volume", clone)
+    pool_count(pool_name, "destroyed")
+    if done:
+        print("Clone " + clone + " deleted.")
+    refill_pool(pool_name, pool, ready)
+
+
+def pool_status(pool_name=None):
+    # Print the ready clones and the counters of one pool, or of all of them.
+    from netapp_ontap.error import NetAppRestError
+
+    pools = sorted(config_option("ce_clone_pools", {}))
+    if pool_name:
+        pools = [pool_name]
+    print_list_header("Getting clone pool status.",
+        "%-16s %-24s %-16s %6s %6s %8s %8s %8s" % ("Pool", "Parent Volume",
+            "Parent Snapshot", "Size", "Ready", "Hits", "Misses", "Hit Rate"),
+        "----------------------------------------------------------------------------------------------------")
+
+    def records():
+        for name in pools:
+            pool = clone_pool(name)
+            stats = pool_stats(name)
+            checkouts = stats["hits"] + stats["misses"]
+            hit_rate = None
+            if checkouts:
+                hit_rate = round(100.0 * stats["hits"] / checkouts, 1)
+            yield (name, pool["volume"], pool["snapshot"], pool["size"],
+                   len(pool_clones(pool)), stats["hits"], stats["misses"], hit_rate,
+                   stats["destroyed"])
+
+    def table_row(record):
+        record = list(table_values(record))
+        if record[7] != "":
+            record[7] = "%.1f%%" % record[7]
+        return tuple(record[:8])
+
+    try:
+        print_records(["pool", "parent_volume", "parent_snapshot", "size", "ready",
+                       "hits", "misses", "hit_rate", "destroyed"],
+                      records(), "%-16s %-24s %-16s %6s %6s %8s %8s %8s", table_row)
+    except NetAppRestError:
+        print("Error listing pool clones!")
+        raise
+
+
+# ---------------------------------------------------------------------------
+# METRICS
+#
+# Every REST call is counted by a response hook on the connection's session,
+# under the operation running on the calling thread.  "--stats" prints the
+# figures for each operation at the end of the run, "--metrics-file" (or
+# ce_metrics_file) exports them as JSON, or as a Prometheus textfile when the
+# file name ends in ".prom", and "--profile" writes a cProfile dump.
+#
+# Network time runs from sending a request until its response body has been
+# read, without the time spent waiting for a free slot or retrying after the
+# cluster throttled the request (see "THROTTLING").  Local time is the CPU
+# time of the threads running the operation.  Job wait time is the time
+# spent waiting for submitted jobs to finish, including the job status polls.
+# Rate limit time is the time spent waiting for ce_rate_limits.
+# ---------------------------------------------------------------------------
+
+# Upper bounds of the latency histogram buckets, in seconds.
+metrics_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+metrics_lock = threading.Lock()
+metrics_data = collections.OrderedDict()
+metrics_local = threading.local()
+
+# CPU time of the current thread, or of the process before Python 3.7.
+thread_time = getattr(time, "thread_time", time.process_time)
+
+# Object uuids are replaced by "{uuid}" in endpoint names.
+uuid_pattern = re.compile("[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+
+
+def operation_metrics(op):
+    # Returns the metrics of an operation, creating them on first use.  Needs
+    # metrics_lock to be held.
+    if op not in metrics_data:
+        metrics_data[op] = {
+            "runs": 0,
+            "seconds": 0.0,
+            "local_seconds": 0.0,
+            "network_seconds": 0.0,
+            "job_wait_seconds": 0.0,
+            "rate_limit_seconds": 0.0,
+            "bytes_sent": 0,
+            "bytes_received": 0,
+            "retries": 0,
+            "calls": collections.OrderedDict(),
+            "latency": [0] * (len(metrics_buckets) + 1),
+        }
+    return metrics_data[op]
+
+
+def current_operation():
+    return getattr(metrics_local, "operation", None) or "other"
+
+
+@contextlib.contextmanager
+def measure_operation(op, run=True):
+    # Count the REST calls made by this thread under op, and add the CPU
+    # time of the block to its local time.  With run=False the block is part
+    # of an operation that is measured elsewhere, such as one of its workers.
+    outer = getattr(metrics_local, "operation", None)
+    metrics_local.operation = op
+    start = time.time()
+    cpu = thread_time()
+    try:
+        yield
+    finally:
+        metrics_local.operation = outer
+        with metrics_lock:
+            data = operation_metrics(op)
+            data["local_seconds"] += thread_time() - cpu
+            if run:
+                data["runs"] += 1
+                data["seconds"] += time.time() - start
+
+
+def add_rate_limit_wait(seconds):
+    with metrics_lock:
+        operation_metrics(current_operation())["rate_limit_seconds"] += seconds
+
+
+def add_retry():
+    with metrics_lock:
+        operation_metrics(current_operation())["retries"] += 1
+
+
+def add_job_wait(seconds):
+    with metrics_lock:
+        operation_metrics(current_operation())["job_wait_seconds"] += max(seconds, 0)
+
+
+@contextlib.contextmanager
+def measure_job_wait():
+    # Time a post(), patch() or delete() call that waits for its job.  All
+    # but its first request, which submits the job, is time spent waiting.
+    metrics_local.job_requests = requests = []
+    start = time.time()
+    try:
+        yield
+    finally:
+        metrics_local.job_requests = None
+        add_job_wait(time.time() - start - sum(requests[:1]))
+
+
+def metrics_response_hook(response, *args, **kwargs):
+    # Count a finished request.  Reading the body here lets us include it in
+    # the network time; requests would read it right after the hook anyway.
+    start = time.time()
+    received = len(response.content or b"")
+    seconds = getattr(response, "send_seconds", response.elapsed.total_seconds()) + \
+              time.time() - start
+    request = response.request
+    body = request.body or b""
+    if not isinstance(body, bytes):
+        body = body.encode("utf-8")
+    call = request.method + " " + uuid_pattern.sub("{uuid}", urlsplit(request.url).path)
+    bucket = 0
+    while bucket < len(metrics_buckets) and seconds > metrics_buckets[bucket]:
+        bucket += 1
+    requests = getattr(metrics_local, "job_requests", None)
+    if requests is not None:
+        requests.append(seconds)
+    with metrics_lock:
+        data = operation_metrics(current_operation())
+        data["calls"][call] = data["calls"].get(call, 0) + 1
+        data["latency"][bucket] += 1
+        data["network_seconds"] += seconds
+        data["bytes_sent"] += len(request.path_url) + len(body)
+        data["bytes_received"] += received
+    return response
+
+
+def install_metrics(session):
+    # Count the REST calls made through a requests session.
+    hooks = session.hooks["response"]
+    if metrics_response_hook not in hooks:
+        hooks.append(metrics_response_hook)
+
+
+def bucket_name(bound):
+    if bound < 1:
+        return "%gms" % (bound * 1000)
+    return "%gs" % bound
+
+
+def metrics_report():
+    # Returns the metrics as a JSON friendly dict, with cumulative latency
+    # buckets as in a Prometheus histogram.
+    report = collections.OrderedDict()
+    with metrics_lock:
+        for op, data in metrics_data.items():
+            entry = collections.OrderedDict()
+            for name in ["runs", "seconds", "local_seconds", "network_seconds",
+                         "job_wait_seconds", "rate_limit_seconds", "bytes_sent",
+                         "bytes_received", "retries"]:
+                entry[name] = data[name]
+            entry["calls"] = collections.OrderedDict(data["calls"])
+            buckets = collections.OrderedDict()
+            total = 0
+            for bound, count in zip(metrics_buckets + ["+Inf"], data["latency"]):
+                total += count
+                buckets[str(bound)] = total
+            entry["latency_buckets"] = buckets
+            report[op] = entry
+    return {"version": version, "time": time.time(), "operations": report}
+
+
+def print_stats(report):
+    # Print the metrics of each operation.  These go to stderr so that they
+    # do not mix with the output of the operation.
+    for op, data in report["operations"].items():
+        calls = sum(data["calls"].values())
+        output = []
+        output.append("Statistics for %s (%d run(s)):" % (op, data["runs"]))
+        output.append("  Time: %.3fs wall, %.3fs local, %.3fs network, %.3fs job wait, "
+                      "%.3fs rate limit" % \
+                      (data["seconds"], data["local_seconds"], data["network_seconds"],
+                       data["job_wait_seconds"], data["rate_limit_seconds"]))
+        output.append("  REST calls: %d, %d bytes sent, %d bytes received, %d throttled and retried" % \
+                      (calls, data["bytes_sent"], data["bytes_received"], data["retries"]))
+        for call, count in data["calls"].items():
+            method, endpoint = call.split(" ", 1)
+            output.append("    %-7s %-60s %6d" % (method, endpoint, count))
+        if calls:
+            latency = []
+            previous = 0
+            for bound, total in data["latency_buckets"].items():
+                if total > previous:
+                    if bound == "+Inf":
+                        name = ">" + bucket_name(metrics_buckets[-1])
+                    else:
+                        name = "<=" + bucket_name(float(bound))
+                    latency.append("%s: %d" % (name, total - previous))
+                previous = total
+            output.append("  Latency: " + ", ".join(latency))
+        sys.stderr.write("\n".join(output) + "\n")
+
+
+def prometheus_text(report):
+    # Format the metrics in the Prometheus text exposition format.
+    lines = []
+
+    def metric(name, kind, description):
+        lines.append("# HELP pyce_rest_" + name + " " + description)
+        lines.append("# TYPE pyce_rest_" + name + " " + kind)
+
+    def sample(name, labels, value):
+        label_text = ",".join('%s="%s"' % (key, str(text).replace('"', '\\"'))
+                              for key, text in labels)
+        lines.append("pyce_rest_%s{%s} %s" % (name, label_text, repr(value)))
+
+    operations = report["operations"]
+    metric("operation_runs_total", "counter", "Operations run.")
+    for op, data in operations.items():
+        sample("operation_runs_total", [("operation", op)], data["runs"])
+    for name, description in [
+            ("operation_seconds", "Wall time of the operations."),
+            ("local_seconds", "CPU time spent in pyce_rest."),
+            ("network_seconds", "Time spent waiting on REST calls."),
+            ("job_wait_seconds", "Time spent waiting for ONTAP jobs."),
+            ("rate_limit_seconds", "Time spent waiting for the host-wide rate limit."),
+            ("bytes_sent", "Bytes sent in REST requests."),
+            ("bytes_received", "Bytes received in REST responses."),
+            ("retries", "REST calls retried after the cluster throttled them.")]:
+        key = name.replace("operation_", "")
+        metric(name + "_total", "counter", description)
+        for op, data in operations.items():
+            sample(name + "_total", [("operation", op)], data[key])
+    metric("requests_total", "counter", "REST calls by method and endpoint.")
+    for op, data in operations.items():
+        for call, count in data["calls"].items():
+            method, endpoint = call.split(" ", 1)
+            sample("requests_total", [("operation", op), ("method", method),
+                                      ("endpoint", endpoint)], count)
+    metric("request_seconds", "histogram", "Latency of the REST calls.")
+    for op, data in operations.items():
+        for bound, total in data["latency_buckets"].items():
+            sample("request_seconds_bucket", [("operation", op), ("le", bound)], total)
+        sample("request_seconds_sum", [("operation", op)], data["network_seconds"])
+        sample("request_seconds_count", [("operation", op)], sum(data["calls"].values()))
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics(path, report):
+    # Write the metrics file through a temporary file, so that a collector
+    # never reads a partly written one.
+    if path.endswith(".prom"):
+        text = prometheus_text(report)
+    else:
+        text = json.dumps(report, indent=1) + "\n"
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(prefix=".pyce_rest.", dir=directory)
+    try:
+        with os.fdopen(fd, "w") as metrics_file:
+            metrics_file.write(text)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except OSError:
+        os.unlink(temp_path)
+        raise
+
+
+# ---------------------------------------------------------------------------
+# THROTTLING
+#
+# Every REST call on a connection goes through its RequestScheduler, which
+# limits the calls in flight.  The limit grows by one for every limit calls
+# that succeed (additive increase), and is halved when the cluster throttles
+# us with a 429 or 503, a busy job queue or a failed connection.  It drops by
+# a tenth when a call takes more than ce_concurrency_latency_factor times as
+# long as the fastest calls to the same endpoint.  Only calls sent after the
+# last decrease can lower the limit again, so that a burst of failures from
+# calls sent under the old limit only counts once.
+#
+# Throttled calls are retried up to ce_retry_attempts times, with a random
+# ("full jitter") backoff of up to ce_retry_backoff * 2^attempt seconds, or
+# the Retry-After of the response if longer.  GET, HEAD, OPTIONS and PATCH
+# calls are retried on any throttling response.  POST and DELETE calls are
+# only retried on a 429, which the cluster returns before doing anything.
+#
+# When the cluster keeps throttling us at a limit of one call, the circuit
+# breaker opens.  All calls then wait ce_breaker_cooldown seconds, after
+# which a single call probes the cluster.  If it is throttled too, the
+# breaker opens again for twice as long.  Calls fail once the breaker has
+# been open for ce_breaker_timeout seconds.
+# ---------------------------------------------------------------------------
+
+# Errors in 5xx responses that mean the cluster is too busy to take the call.
+throttle_pattern = re.compile("(?i)too many|queue is full|job queue|busy|try again")
+
+
+def throttled_response(response):
+    status = response.status_code
+    if status in (429, 503):
+        return True
+    return status >= 500 and throttle_pattern.search(response.text or "") is not None
+
+
+def retry_delay(attempt, response):
+    # Returns the seconds to wait before retrying a throttled call.
+    maximum = config_option("ce_retry_max_backoff", 30)
+    delay = random.uniform(0, min(maximum, config_option("ce_retry_backoff", 0.5) * 2 ** attempt))
+    try:
+        delay = max(delay, min(maximum, float(response.headers.get("Retry-After", 0))))
+    except ValueError:
+        pass
+    return delay
+
+
+class RequestScheduler(object):
+    # Limits the REST calls in flight on one connection (see "THROTTLING").
+    def __init__(self, name, maximum):
+        self.name = name
+        self.condition = threading.Condition()
+        self.maximum = maximum
+        self.limit = float(min(maximum, config_option("ce_concurrency_start", maximum)))
+        self.inflight = 0
+        self.baselines = {}
+        self.last_decrease = 0.0
+        self.failures = 0
+        self.state = "closed"
+        self.open_until = 0.0
+        self.opened = None
+        self.cooldown = config_option("ce_breaker_cooldown", 5)
+
+    def acquire(self):
+        # Wait for a free slot, and returns the time the call is sent.
+        import requests
+
+        with self.condition:
+            while True:
+                now = time.time()
+                if self.state == "open":
+                    if self.opened and now - self.opened > config_option("ce_breaker_timeout", 300):
+                        raise requests.exceptions.ConnectionError(
+                            "Cluster " + self.name + " is overloaded, circuit breaker open.")
+                    if now < self.open_until:
+                        self.condition.wait(self.open_until - now)
+                        continue
+                    self.state = "half_open"
+                    self.inflight += 1
+                    return now
+                if self.state == "closed" and self.inflight < int(self.limit):
+                    self.inflight += 1
+                    return now
+                self.condition.wait()
+
+    def release(self, call, started, seconds, signal):
+        # Adjust the limit for a finished call.  signal is "ok", "throttled"
+        # or "failed".
+        with self.condition:
+            self.inflight -= 1
+            now = time.time()
+            fresh = started >= self.last_decrease
+            if signal != "ok":
+                if self.state == "half_open":
+                    self.open_breaker(now, self.cooldown * 2)
+                elif fresh:
+                    if self.limit <= 1:
+                        self.failures += 1
+                        if self.failures >= config_option("ce_breaker_threshold", 5):
+                            self.open_breaker(now, self.cooldown)
+                    self.decrease(now, 0.5)
+            else:
+                self.failures = 0
+                if self.state == "half_open":
+                    self.state = "closed"
+                    self.opened = None
+                    self.cooldown = config_option("ce_breaker_cooldown", 5)
+                baseline = self.baselines.get(call, seconds)
+                self.baselines[call] = min(seconds, baseline + (seconds - baseline) * 0.05)
+                factor = config_option("ce_concurrency_latency_factor", 3)
+                if fresh and seconds > 0.05 and seconds > baseline * factor:
+                    self.decrease(now, 0.9)
+                else:
+                    self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def decrease(self, now, factor):
+        self.limit = max(1.0, self.limit * factor)
+        self.last_decrease = now
+
+    def open_breaker(self, now, cooldown):
+        self.state = "open"
+        self.cooldown = min(cooldown, config_option("ce_breaker_max_cooldown", 60))
+        self.open_until = now + self.cooldown
+        self.failures = 0
+        if self.opened is None:
+            self.opened = now
+        sys.stderr.write("Cluster %s is overloaded, pausing requests for %gs.\n" % \
+                         (self.name, self.cooldown))
+
+
+def send_scheduled(adapter, send, request, kwargs):
+    # Send a request through the scheduler of its connection, retrying it
+    # while it is throttled.
+    import requests
+
+    scheduler = adapter.host_connection.scheduler
+    call = request.method + " " + uuid_pattern.sub("{uuid}", urlsplit(request.url).path)
+    retry = request.method in ("GET", "HEAD", "OPTIONS", "PATCH")
+    rate_limit = adapter.host_connection.rate_limit
+    attempt = 0
+    while True:
+        # Wait for the rate limit before taking a slot, so that the wait does
+        # not count as latency.
+        if rate_limit is not None:
+            rate_limit.take()
+        started = scheduler.acquire()
+        try:
+            response = send(adapter, request, **kwargs)
+        except requests.exceptions.RequestException:
+            scheduler.release(call, started, time.time() - started, "failed")
+            raise
+        seconds = time.time() - started
+        response.send_seconds = seconds
+        throttled = throttled_response(response)
+        scheduler.release(call, started, seconds, "throttled" if throttled else "ok")
+        if not throttled or attempt >= config_option("ce_retry_attempts", 5) or \
+           not (retry or response.status_code == 429):
+            return response
+        add_retry()
+        # Read the body, so that the connection goes back to the pool.
+        response.content
+        time.sleep(retry_delay(attempt, response))
+        attempt += 1
+
+
+# ---------------------------------------------------------------------------
+# RATE LIMIT
+#
+# ce_rate_limits caps the REST calls per second that all of the pyce_rest
+# processes on this host send to a cluster together, such as the many
+# invocations started by a build agent.  Each cluster has a token bucket in a
+# small file under ce_rate_limit_dir, which the processes update under an
+# flock().  A call takes a token, or reserves the next free one and sleeps
+# until it is due, so that waiting calls are served in turn and the rate
+# holds however many processes there are.  The bucket fills up to "burst"
+# tokens while the cluster is idle.
+# ---------------------------------------------------------------------------
+
+def rate_limit_settings(cluster):
+    # Returns the (rate, burst) of a cluster, or None if it is not limited.
+    limits = config_option("ce_rate_limits", {})
+    limit = limits.get(cluster, limits.get("*"))
+    if not limit:
+        return None
+    rate = float(limit["rate"])
+    return rate, float(limit.get("burst", rate))
+
+
+def rate_limit_dir():
+    return config_option("ce_rate_limit_dir",
+                         os.path.join(tempfile.gettempdir(),
+                                      "pyce_rest-rate-" + str(os.getuid())))
+
+
+class RateLimit(object):
+    # The host-wide token bucket of one cluster.
+    def __init__(self, cluster, rate, burst):
+        self.cluster = cluster
+        self.rate = rate
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.fd = None
+
+    def open(self):
+        directory = rate_limit_dir()
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        name = re.sub("[^A-Za-z0-9_.-]", "_", self.cluster) + ".bucket"
+        return os.open(os.path.join(directory, name), os.O_RDWR | os.O_CREAT, 0o600)
+
+    def take(self):
+        # Take a token, sleeping until it is due if the bucket is empty.
+        # flock() does not keep out the threads of one process, hence the
+        # thread lock.
+        import fcntl
+
+        with self.lock:
+            if self.fd is None:
+                self.fd = self.open()
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                now = time.time()
+                try:
+                    tokens, stored = [float(value) for value in os.pread(self.fd, 64, 0).split()]
+                except ValueError:
+                    tokens, stored = self.burst, now
+                tokens = min(self.burst, tokens + max(0.0, now - stored) * self.rate) - 1
+                # The state is padded to a fixed size, so that it is always
+                # overwritten completely.
+                os.pwrite(self.fd, ("%f %f" % (tokens, now)).ljust(63).encode("ascii") + b"\n", 0)
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+        if tokens < 0:
+            time.sleep(-tokens / self.rate)
+            add_rate_limit_wait(-tokens / self.rate)
+
+
+# ---------------------------------------------------------------------------
+# CONNECTIONS
+#
+# The netapp_ontap HostConnection keeps one requests session, whose default
+# adapter pools at most 10 connections.  Threads beyond that open a new
+# connection, and TLS handshake, for each call and discard it afterwards.
+# Our connections size the pool from ce_http_pool_size (or the number of
+# workers), enable TCP keep-alive and apply the ce_http_* settings.  With
+# ce_http_sessions = "thread", every thread gets a session and pool of its
+# own instead of sharing one.
+# ---------------------------------------------------------------------------
+
+connection_classes = {}
+
+
+def connection_class():
+    # Returns the HostConnection subclass used for our connections.  It is
+    # defined on first use, as netapp_ontap is only imported then.
+    if "connection" in connection_classes:
+        return connection_classes["connection"]
+    from netapp_ontap.host_connection import HostConnection as NaHostConnection
+    from netapp_ontap.host_connection import LoggingAdapter as NaLoggingAdapter
+
+    class KeepAliveAdapter(NaLoggingAdapter):
+        # Turns on TCP keep-alive, so that idle pooled connections, such as
+        # those waiting between job polls, are not dropped by firewalls.
+        def init_poolmanager(self, *args, **kwargs):
+            if config_option("ce_http_keepalive", True):
+                from urllib3.connection import HTTPConnection
+
+                kwargs["socket_options"] = HTTPConnection.default_socket_options + \
+                    [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+            NaLoggingAdapter.init_poolmanager(self, *args, **kwargs)
+
+    class ScheduledAdapter(KeepAliveAdapter):
+        # Sends every call through the connection's RateLimit and
+        # RequestScheduler.
+        def send(self, request, **kwargs):
+            if self.host_connection.scheduler is None:
+                if self.host_connection.rate_limit is not None:
+                    self.host_connection.rate_limit.take()
+                return KeepAliveAdapter.send(self, request, **kwargs)
+            return send_scheduled(self, KeepAliveAdapter.send, request, kwargs)
+
+    class PooledHostConnection(NaHostConnection):
+        def __init__(self, *args, **kwargs):
+            self.pool_size = kwargs.pop("pool_size")
+            self.thread_sessions = kwargs.pop("thread_sessions")
+            self.sessions = threading.local()
+            NaHostConnection.__init__(self, *args, **kwargs)
+            self.scheduler = None
+            if config_option("ce_adaptive_concurrency", True):
+                self.scheduler = RequestScheduler(self.host, self.pool_size)
+            self.rate_limit = None
+            settings = rate_limit_settings(self.host)
+            if settings:
+                self.rate_limit = RateLimit(self.host, *settings)
+
+        # HostConnection keeps its session in _request_session, which is
+        # stored per thread with thread_sessions.
+        def get_request_session(self):
+            if self.thread_sessions:
+                return getattr(self.sessions, "session", None)
+            return self.__dict__.get("shared_session")
+
+        def set_request_session(self, session):
+            if self.thread_sessions:
+                self.sessions.session = session
+            else:
+                self.__dict__["shared_session"] = session
+
+        def del_request_session(self):
+            self.set_request_session(None)
+
+        _request_session = property(get_request_session, set_request_session,
+                                    del_request_session)
+
+        @property
+        def session(self):
+            existing = self._request_session
+            session = NaHostConnection.session.fget(self)
+            if session is not existing:
+                configure_session(self, session, ScheduledAdapter)
+            return session
+
+    connection_classes["connection"] = PooledHostConnection
+    return PooledHostConnection
+
+
+def configure_session(connection, session, adapter_class):
+    # Replace the default adapter of a new session with one using our pool
+    # settings, and apply the keep-alive and compression settings.
+    retries = session.adapters[connection.origin].max_retries
+    session.mount(connection.origin, adapter_class(
+        connection, max_retries=retries, timeout=connection.protocol_timeouts,
+        pool_connections=1, pool_maxsize=connection.pool_size,
+        pool_block=config_option("ce_http_pool_block", False)))
+    if not config_option("ce_http_keepalive", True):
+        session.headers["Connection"] = "close"
+    if not config_option("ce_http_gzip", True):
+        session.headers["Accept-Encoding"] = "identity"
+    install_metrics(session)
+
+
+def new_connection(host, username, password, workers=None, timeout=None,
+                   **connection_args):
+    # Returns a connection with the ce_http_* settings, and with timeout,
+    # HTTP timeouts of at most that many seconds.  The port and scheme are
+    # only passed when set, for older netapp_ontap versions that do not
+    # accept them.
+    for name in ["port", "scheme"]:
+        if connection_args.get(name) is None:
+            connection_args.pop(name, None)
+    pool_size = config_option("ce_http_pool_size", None) or max(10, workers or 0)
+    timeouts = config_option("ce_http_timeout", (6, 45))
+    if not isinstance(timeouts, (tuple, list)):
+        timeouts = (timeouts, timeouts)
+    if timeout:
+        timeouts = tuple(min(value, timeout) for value in timeouts)
+    return connection_class()(
+        host = host,
+        username = username,
+        password = password,
+        verify = False,
+        poll_timeout = 120,
+        poll_interval = config_option("ce_job_poll_interval", 2),
+        protocol_timeouts = tuple(timeouts),
+        pool_size = pool_size,
+        thread_sessions = config_option("ce_http_sessions", "shared") == "thread",
+        **connection_args
+    )
+
+
+def connect(workers=None):
+    # Setup the REST API connection to ONTAP.
+    # Using verify=False to ignore that we may see self-signed SSL certificates.
+    from netapp_ontap import config as NaConfig
+
+    NaConfig.CONNECTION = new_connection(
+        pyceRestConfig.ce_cluster,
+        pyceRestConfig.ce_user,
+        pyceRestConfig.ce_passwd,
+        workers,
+        port = config_option("ce_port", None),
+        scheme = config_option("ce_scheme", None),
+    )
+
+
+# ---------------------------------------------------------------------------
+# TARGETS
+#
+# ce_targets lists cluster and SVM pairs, each reached with its own
+# connection.  "--targets" runs a list operation on several of them at once,
+# one thread per target, and merges their records into one stream as they
+# arrive, tagged with the cluster and SVM.  Each target has ce_target_timeout
+# seconds (or its own "timeout") to finish.  A target that fails or is
+# slower is reported at the end without holding up the others.  The other
+# operations take a single target, which replaces ce_cluster and ce_vserver.
+# ---------------------------------------------------------------------------
+
+target_operations = ["list_volumes", "list_snapshots", "list_clones", "list_mirrors"]
+
+
+def config_targets():
+    # Returns the targets in ce_targets by name, with the settings they leave
+    # out taken from the single cluster settings.
+    targets = collections.OrderedDict()
+    for target in config_option("ce_targets", []):
+        target = dict(target)
+        target.setdefault("cluster", pyceRestConfig.ce_cluster)
+        target.setdefault("vserver", pyceRestConfig.ce_vserver)
+        target.setdefault("user", pyceRestConfig.ce_user)
+        target.setdefault("passwd", pyceRestConfig.ce_passwd)
+        target.setdefault("port", config_option("ce_port", None))
+        target.setdefault("scheme", config_option("ce_scheme", None))
+        target.setdefault("timeout", config_option("ce_target_timeout", 60))
+        target.setdefault("name", target["cluster"] + ":" + target["vserver"])
+        targets[target["name"]] = target
+    return targets
+
+
+def select_targets(names):
+    # Returns the targets for "all" or a comma separated list of target
+    # names, and the first unknown name (or None).
+    targets = config_targets()
+    if names == "all":
+        return list(targets.values()), None
+    selected = []
+    for name in names.split(","):
+        if name not in targets:
+            return None, name
+        selected.append(targets[name])
+    return selected, None
+
 
-    # Create the snapmirror.
-    # This assumes we have already created a DP mirror destination.
-    mirror = NaSnapmirrorRelationship.from_dict(sm_dict)
+def use_target(target):
+    # Make a target the cluster and SVM of this run.
+    pyceRestConfig.ce_cluster = target["cluster"]
+    pyceRestConfig.ce_vserver = target["vserver"]
+    pyceRestConfig.ce_user = target["user"]
+    pyceRestConfig.ce_passwd = target["passwd"]
+    pyceRestConfig.ce_port = target["port"]
+    pyceRestConfig.ce_scheme = target["scheme"]
+
+
+def run_targets(op, options, targets, workers=None):
+    # Run a list operation on every target at once and print the merged
+    # records.  Returns the number of targets that failed, timed out or did
+    # not find what was asked for.
+    import queue
+
+    events = queue.Queue(maxsize=10000)
+    output = output_format()
+
+    def run_target(target, connection):
+        # Records and headers go to the sink, and anything else that the
+        # operation prints is sent along when it finishes.
+        target_local.cluster = target["cluster"]
+        target_local.vserver = target["vserver"]
+        output_local.format = output
+        output_local.sink = lambda kind, value: events.put((target["name"], kind, value))
+        sys.stdout.local.buffer = io.StringIO()
+        try:
+            with connection:
+                with measure_operation(op, run=False):
+                    if call_operation(op, options) is False:
+                        events.put((target["name"], "failed", None))
+        except Exception as error:
+            events.put((target["name"], "error", error))
+        finally:
+            events.put((target["name"], "output", sys.stdout.local.buffer.getvalue()))
+            sys.stdout.local.buffer = None
+            events.put((target["name"], "done", None))
+
+    # The threads are daemons, so that a target that never answers does not
+    # keep us from exiting.
+    capture_thread_output()
+    by_name = collections.OrderedDict((target["name"], target) for target in targets)
+    start = time.time()
+    deadlines = {}
+    for target in targets:
+        connection = new_connection(target["cluster"], target["user"], target["passwd"],
+                                    workers, target["timeout"], port=target["port"],
+                                    scheme=target["scheme"])
+        deadlines[target["name"]] = start + target["timeout"]
+        thread = threading.Thread(target=run_target, args=(target, connection))
+        thread.daemon = True
+        thread.start()
+
+    pending = set(by_name)
+    failures = collections.OrderedDict()
+    failed = set()
+    messages = collections.OrderedDict()
+
+    def next_event():
+        # Returns the next event of a pending target, or None once no
+        # target is pending.
+        while pending:
+            now = time.time()
+            for name in [name for name in pending if deadlines[name] <= now]:
+                pending.discard(name)
+                failures[name] = "Timed out after %ss." % by_name[name]["timeout"]
+            if not pending:
+                break
+            try:
+                name, kind, value = events.get(
+                    timeout=min(deadlines[name] for name in pending) - now)
+            except queue.Empty:
+                continue
+            if name not in pending:
+                continue
+            if kind == "error":
+                failures[name] = str(value)
+            elif kind == "failed":
+                failed.add(name)
+            elif kind == "output":
+                messages[name] = value.splitlines()
+            elif kind == "done":
+                pending.discard(name)
+            else:
+                return name, kind, value
+        return None
+
+    # Print the header of the first target with records (a target that
+    # found nothing may not have sent its column headings), then every
+    # target's records as they arrive.
+    tag_format = "%-16s %-16s "
+    meta = None
+    headers = collections.OrderedDict()
+    while meta is None:
+        event = next_event()
+        if event is None:
+            break
+        name, kind, value = event
+        if kind == "header":
+            headers.setdefault(name, value)
+        elif kind == "records":
+            meta = value
+            if name in headers:
+                headers.move_to_end(name, last=False)
+    if headers:
+        message, heading, rule = list(headers.values())[0]
+        message += " (" + str(len(targets)) + " targets)"
+        if heading:
+            heading = tag_format % ("Cluster", "SVM") + heading
+            rule = "-" * 34 + rule
+        print_list_header(message, heading, rule)
+
+    def records():
+        while True:
+            event = next_event()
+            if event is None:
+                return
+            name, kind, value = event
+            if kind == "record":
+                target = by_name[name]
+                yield (target["cluster"], target["vserver"]) + tuple(value)
+
+    if meta is not None:
+        columns, row_format, table_row = meta
+        print_records(["cluster", "svm"] + list(columns), records(),
+                      tag_format + row_format,
+                      lambda record: tuple(record[:2]) + tuple(table_row(record[2:])))
+
+    # Then what each target printed besides its records, and the failures.
+    # Only a table has room for these on stdout.
+    lines = []
+    for name in by_name:
+        lines.extend("Target " + name + ": " + line for line in messages.get(name, []) if line)
+        if name in failures:
+            lines.append("Error on target " + name + ": " + failures[name])
+    for line in lines:
+        if output_format() == "table":
+            print(line)
+        else:
+            sys.stderr.write(line + "\n")
+    return len(failed.union(failures))
+
+
+def check_options(op, options):
+    # Returns an error message if the operation is unknown or is missing one
+    # of its required arguments, otherwise returns None.
+    if op not in operations:
+        return "Invalid operation type: " + op
+    if op in ["list_volumes", "delete_volume", "list_snapshots", "prune_snapshots",
+              "create_volume", "create_volumes", "remount_volume",
+              "create_snapshot", "delete_snapshot",
+              "create_clone", "create_clones", "create_mirror"]:
+        if not options.volume:
+            return "Missing volume name for op: " + op
+    if op in ["create_snapshot", "delete_snapshot", "create_clone",
+              "create_clones"]:
+        if not options.snapshot:
+            return "Missing snapshot name for op: " + op
+    if op in ["create_clone", "create_clones", "checkout_clone", "return_clone"]:
+        if not options.clone:
+            return "Missing clone name for op: " + op
+    if op == "list_clones":
+        if not options.clone and not options.volume:
+            return "Missing clone name or parent volume for op: " + op
+    if op in ["create_volume", "create_volumes", "remount_volume", "create_clone",
+              "create_clones", "checkout_clone"]:
+        if not options.junction:
+            return "Missing junction path for op: " + op
+    if op in ["create_mirror", "update_mirror", "update_mirrors", "delete_mirror"]:
+        if not options.mirror:
+            return "Missing mirror volume for op: " + op
+    if op == "create_clones":
+        if not options.count or options.count < 1:
+            return "Missing clone count for op: " + op
+        error = check_templates(op, options.clone, options.junction, options.count)
+        if error:
+            return error
+    if op == "create_volumes":
+        if not options.count or options.count < 1:
+            return "Missing volume count for op: " + op
+        error = check_templates(op, options.volume, options.junction, options.count)
+        if error:
+            return error
+    if op == "capacity_report":
+        if options.count is not None and options.count < 1:
+            return "Invalid number of top volumes for op: " + op
+    if op in ["checkout_clone", "return_clone", "fill_pool"]:
+        if not getattr(options, "pool", None):
+            return "Missing clone pool for op: " + op
+    if getattr(options, "pool", None) and \
+            options.pool not in config_option("ce_clone_pools", {}):
+        return "Unknown clone pool: " + options.pool
+    if getattr(options, "template", None) and \
+            options.template not in config_option("ce_volume_templates", {}):
+        return "Unknown volume template: " + options.template
+    if op == "prune_snapshots":
+        if options.keep is None and not options.max_age and not options.match:
+            return "Missing retention rule (--keep, --max-age or --match) for op: " + op
+        if options.keep is not None and options.keep < 0:
+            return "Invalid number of snapshots to keep for op: " + op
+        if options.max_age:
+            try:
+                parse_age(options.max_age)
+            except ValueError:
+                return "Invalid maximum age for op: " + op
+        if options.match:
+            try:
+                re.compile(options.match)
+            except re.error:
+                return "Invalid snapshot name regex for op: " + op
+        if options.per_volume < 1:
+            return "Invalid number of deletes per volume for op: " + op
+    if op == "batch":
+        if not options.manifest:
+            return "Missing batch manifest for op: " + op
+    if op == "reconcile":
+        if not options.manifest:
+            return "Missing desired state file for op: " + op
+    if op == "wait_jobs":
+        if not options.jobs:
+            return "Missing job uuids for op: " + op
+    if getattr(options, "format", None) not in [None] + output_formats:
+        return "Invalid output format: " + options.format
+    if getattr(options, "sort", None) not in [None] + list(snapshot_orders):
+        return "Invalid sort order: " + options.sort
+    if op in ["batch", "create_clones", "create_volumes", "prune_snapshots",
+              "update_mirrors", "reconcile"] or getattr(options, "recursive", None):
+        if options.workers < 1:
+            return "Invalid number of workers for op: " + op
+    return None
+
+
+def run_operation(op, options):
+    # Run an operation with the output format of its options, which may be
+    # a daemon or batch request.  Returns False if the operation failed
+    # without raising an error.
+    output_local.format = getattr(options, "format", None)
     try:
-        mirror.post()
-    except NetAppRestError:
-        print("Error creating mirror!")
-        raise
-    print("Mirror created succesfully.")
+        with measure_operation(op):
+            return call_operation(op, options)
+    finally:
+        output_local.format = None
 
 
-def update_mirror(dst):
-    # First find the snapmirror relationship uuid.
-    sm_args = {
-        "destination.path": pyceRestConfig.ce_vserver + ":" + dst,
-        "destination.svm.name": pyceRestConfig.ce_vserver,
-    }
+def call_operation(op, options):
+    # Call the requested operation.  Returns False if a list operation did
+    # not find what it was asked for.
+    if op == "list_volumes":
+        list_volumes(options.volume)
+
+    if op == "create_volume":
+        create_volume(options.volume, options.junction, "rw",
+                      getattr(options, "template", None))
+
+    if op == "delete_volume":
+        delete_volume(options.volume)
+
+    if op == "remount_volume":
+        remount_volume(options.volume, options.junction)
+
+    if op == "list_snapshots":
+        return list_snapshots(options.volume, getattr(options, "sort", None))
+
+    if op == "create_snapshot":
+        create_snapshot(options.volume, options.snapshot)
+
+    if op == "delete_snapshot":
+        delete_snapshot(options.volume, options.snapshot)
+
+    if op == "list_clones":
+        list_clones(options.clone, options.volume, options.snapshot)
+
+    if op == "create_clone":
+        create_clone(options.volume, options.clone, options.snapshot, options.junction)
+
+    if op == "checkout_clone":
+        checkout_clone(options.pool, options.clone, options.junction)
+
+    if op == "return_clone":
+        return_clone(options.pool, options.clone)
+
+    if op == "fill_pool":
+        fill_pool(options.pool)
+
+    if op == "pool_status":
+        pool_status(getattr(options, "pool", None))
+
+    if op == "list_mirrors":
+        list_mirrors()
+
+    if op == "capacity_report":
+        prefixes = None
+        if getattr(options, "prefixes", None):
+            prefixes = [prefix.strip() for prefix in options.prefixes.split(",")]
+        capacity_report(options.volume or "*", options.count or 10, prefixes)
+
+    if op == "create_mirror":
+        # The relationship needs the destination volume, and the transfer
+        # needs the relationship, so only the transfer job can be deferred.
+        with blocking_jobs():
+            create_volume(options.mirror, "", "dp")
+            create_mirror(options.volume, options.mirror)
+        update_mirror(options.mirror)
+
+    if op == "update_mirror":
+        update_mirror(options.mirror)
+
+    if op == "delete_mirror":
+        delete_mirror(options.mirror)
+
+
+# ---------------------------------------------------------------------------
+# CONCURRENT EXECUTION
+#
+# Helpers shared by the daemon and batch modes, which run several operations
+# at once on one connection and must keep the output of each one separate.
+# ---------------------------------------------------------------------------
+
+# Options that make up a single operation request.
+request_option_names = ["volume", "junction", "snapshot", "clone", "mirror", "template",
+                        "pool", "format", "sort", "count", "prefixes"]
+
+# Operations that drive other operations.  These cannot be sent to the
+# daemon or listed in a batch manifest.
+driver_operations = ["serve", "batch", "create_clones", "create_volumes", "wait_jobs",
+                     "prune_snapshots", "update_mirrors", "reconcile"]
+
+
+class ThreadOutput(object):
+    # A sys.stdout or sys.stderr replacement that sends writes to a per-thread
+    # buffer while a daemon request is running on that thread, so the output
+    # of concurrent requests is never mixed.
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, data):
+        buffer = getattr(self.local, "buffer", None)
+        if buffer is None:
+            return self.stream.write(data)
+        return buffer.write(data)
+
+    def flush(self):
+        self.stream.flush()
+
+    def fileno(self):
+        return self.stream.fileno()
+
+
+def capture_thread_output():
+    # Install ThreadOutput as sys.stdout and sys.stderr, once.
+    if not isinstance(sys.stdout, ThreadOutput):
+        sys.stdout.flush()
+        sys.stdout = ThreadOutput(sys.stdout)
+    if not isinstance(sys.stderr, ThreadOutput):
+        sys.stderr.flush()
+        sys.stderr = ThreadOutput(sys.stderr)
+
+
+def request_options(request):
+    # Turn a request dict into an operation and its options.  Returns the
+    # operation, the options and an error message (or None).
+    op = request.get("operation") or ""
+    values = {}
+    for key in request_option_names:
+        values[key] = request.get(key) or None
+    options = Values(values)
+    # CSV manifests give every value as a string.
+    if options.count is not None:
+        try:
+            options.count = int(options.count)
+        except (TypeError, ValueError):
+            return op, options, "Invalid count: " + str(options.count)
+    if op in driver_operations:
+        return op, options, "Invalid operation type: " + op
+    return op, options, check_options(op, options)
+
+
+def run_captured(op, options):
+    # Run a single operation and capture everything that it prints, with its
+    # stderr text kept apart as "errors".  Needs capture_thread_output() to
+    # have been called first.
+    output = io.StringIO()
+    errors = io.StringIO()
+    sys.stdout.local.buffer = output
+    sys.stderr.local.buffer = errors
+    status = 0
+    start = time.time()
     try:
-        mirror = NaSnapmirrorRelationship.find(fields="uuid", **sm_args)
-    except NetAppRestError:
-        print("Error finding mirror volume!")
+        if run_operation(op, options) is False:
+            status = 1
+    except Exception as error:
+        print("Error: " + str(error))
+        status = 1
+    finally:
+        sys.stdout.local.buffer = None
+        sys.stderr.local.buffer = None
+    return {"status": status, "output": output.getvalue(), "errors": errors.getvalue(),
+            "seconds": time.time() - start}
+
+
+# ---------------------------------------------------------------------------
+# ASYNC ENGINE
+#
+# netapp_ontap is a blocking library, so the engine runs each operation on a
+# worker thread with run_in_executor() and lets an asyncio event loop overlap
+# their network waits.  At most ce_workers (or --workers) operations are in
+# flight at once.  Each call may name its own HostConnection, which is made
+# the current connection on the worker thread, so one event loop can drive
+# operations against several clusters.  The CLI, batch mode and library
+# callers all run their operations here.  On Ctrl-C, run_loop() cancels what
+# is still queued and returns at once, without waiting for a call that is
+# blocked on the network.
+# ---------------------------------------------------------------------------
+
+engine = {"executor": None}
+
+
+class EngineExecutor(concurrent.futures.Executor):
+    # A thread pool like concurrent.futures.ThreadPoolExecutor, except that
+    # its threads are daemons (like the target threads), so that exiting
+    # after Ctrl-C does not wait for the calls that they are running.
+    def __init__(self, workers):
+        self.workers = workers
+        self.calls = queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def submit(self, function, *args, **kwargs):
+        future = concurrent.futures.Future()
+        self.calls.put((future, function, args, kwargs))
+        with self.lock:
+            if len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+        return future
+
+    def work(self):
+        while True:
+            call = self.calls.get()
+            if call is None:
+                return
+            future, function, args, kwargs = call
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = function(*args, **kwargs)
+            except BaseException as error:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        if cancel_futures:
+            while True:
+                try:
+                    call = self.calls.get_nowait()
+                except queue.Empty:
+                    break
+                if call is not None:
+                    call[0].cancel()
+        with self.lock:
+            threads = list(self.threads)
+        for thread in threads:
+            self.calls.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+
+def set_engine_workers(workers):
+    if engine["executor"] is not None:
+        engine["executor"].shutdown(wait=False)
+    engine["executor"] = EngineExecutor(workers)
+
+
+def call_with_connection(connection, function, *args, **kwargs):
+    if connection is None:
+        return function(*args, **kwargs)
+    with connection:
+        return function(*args, **kwargs)
+
+
+async def run_async(function, *args, **kwargs):
+    # Run a blocking function on the engine's thread pool.  A "connection"
+    # keyword argument selects the HostConnection used for the call.
+    import asyncio
+
+    connection = kwargs.pop("connection", None)
+    if engine["executor"] is None:
+        set_engine_workers(config_option("ce_workers", 8))
+    call = functools.partial(call_with_connection, connection, function,
+                             *args, **kwargs)
+    return await asyncio.get_event_loop().run_in_executor(engine["executor"], call)
+
+
+def async_operation(function):
+    async def operation(*args, **kwargs):
+        return await run_async(function, *args, **kwargs)
+    operation.__name__ = function.__name__ + "_async"
+    return operation
+
+
+# Async versions of each operation, taking the same arguments plus an
+# optional "connection" keyword.
+list_volumes_async = async_operation(list_volumes)
+create_volume_async = async_operation(create_volume)
+delete_volume_async = async_operation(delete_volume)
+remount_volume_async = async_operation(remount_volume)
+list_snapshots_async = async_operation(list_snapshots)
+create_snapshot_async = async_operation(create_snapshot)
+delete_snapshot_async = async_operation(delete_snapshot)
+list_clones_async = async_operation(list_clones)
+create_clone_async = async_operation(create_clone)
+list_mirrors_async = async_operation(list_mirrors)
+create_mirror_async = async_operation(create_mirror)
+update_mirror_async = async_operation(update_mirror)
+delete_mirror_async = async_operation(delete_mirror)
+run_operation_async = async_operation(run_operation)
+
+
+async def run_request_async(request, connection=None):
+    # Run one request dict, as used by the daemon and batch modes, and return
+    # its reply with the captured output.  Needs capture_thread_output().
+    if "error" in request:
+        return {"status": 2, "output": request["error"] + "\n", "seconds": 0}
+    op, options, error = request_options(request)
+    if error:
+        return {"status": 2, "output": error + "\n", "seconds": 0}
+    return await run_async(run_captured, op, options, connection=connection)
+
+
+def run_loop(coroutine):
+    # Run a coroutine to completion on a new event loop.
+    import asyncio
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    except KeyboardInterrupt:
+        # Cancel the operations that have not started and stop waiting for
+        # the running ones, whose daemon threads end when we exit.
+        if engine["executor"] is not None:
+            engine["executor"].shutdown(wait=False, cancel_futures=True)
+        tasks = asyncio.all_tasks(loop)
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
         raise
+    finally:
+        loop.close()
 
-    # If we found the relationshp, perform the update.
-    if mirror:
-        print("Updating mirror " + dst)
-        mirror_transfer = NaSnapmirrorTransfer(mirror.uuid)
+
+# ---------------------------------------------------------------------------
+# DAEMON
+#
+# The daemon keeps one warm REST connection (and its keep-alive session) open
+# and accepts operations from "--client" invocations over a local unix socket.
+# Each request is one JSON line with the operation and its options, and each
+# reply is one JSON line with the captured output and an exit status.
+# ---------------------------------------------------------------------------
+
+# Read-only operations.  Identical concurrent requests for these share one
+# backend fetch and all receive the same output.
+daemon_read_operations = ["list_volumes", "list_snapshots", "list_clones",
+                          "list_mirrors", "capacity_report"]
+
+daemon_lock = threading.Lock()
+daemon_inflight = {}
+
+
+def daemon_socket_path():
+    return config_option("ce_daemon_socket",
+                         os.path.join(tempfile.gettempdir(),
+                                      "pyce_rest-" + str(os.getuid()) + ".sock"))
+
+
+def daemon_request(request):
+    op, options, error = request_options(request)
+    if error:
+        return {"status": 2, "output": error + "\n"}
+    if op not in daemon_read_operations:
+        return run_captured(op, options)
+
+    # Coalesce identical read requests that arrive while one is in flight.
+    key = json.dumps([op, vars(options)], sort_keys=True)
+    with daemon_lock:
+        pending = daemon_inflight.get(key)
+        owner = pending is None
+        if owner:
+            pending = {"done": threading.Event(), "reply": None}
+            daemon_inflight[key] = pending
+    if not owner:
+        pending["done"].wait()
+        return pending["reply"]
+    try:
+        pending["reply"] = run_captured(op, options)
+    finally:
+        with daemon_lock:
+            del daemon_inflight[key]
+        pending["done"].set()
+    return pending["reply"]
+
+
+class DaemonRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
         try:
-            mirror_transfer.post()
-        except NetAppRestError:
-            print("Error updating mirror!")
-            raise
-        print("Mirror updated.")
+            request = json.loads(line.decode("utf-8"))
+        except ValueError:
+            reply = {"status": 2, "output": "Invalid daemon request.\n"}
+        else:
+            reply = daemon_request(request)
+        self.wfile.write((json.dumps(reply) + "\n").encode("utf-8"))
+
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(socket_path):
+    # Remove a socket left behind by a daemon that is no longer running.
+    if os.path.exists(socket_path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+        except OSError:
+            os.unlink(socket_path)
+        else:
+            print("A pyce_rest daemon is already listening on: " + socket_path)
+            sys.exit(1)
+        finally:
+            probe.close()
+
+    # Only the owner may connect, since the daemon holds the credentials.
+    old_umask = os.umask(0o077)
+    try:
+        server = DaemonServer(socket_path, DaemonRequestHandler)
+    finally:
+        os.umask(old_umask)
+
+    print("pyce_rest daemon listening on: " + socket_path)
+    capture_thread_output()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+
+
+def forward_to_daemon(socket_path, op, options):
+    # Send the operation to the daemon, print its output and return its
+    # exit status.
+    request = {"operation": op}
+    for key in request_option_names:
+        request[key] = getattr(options, key)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        line = sock.makefile("rb").readline()
+    except OSError:
+        print("Error: Unable to reach the pyce_rest daemon at: " + socket_path)
+        return 1
+    finally:
+        sock.close()
+    try:
+        reply = json.loads(line.decode("utf-8"))
+    except ValueError:
+        print("Error: Invalid reply from the pyce_rest daemon.")
+        return 1
+    sys.stderr.write(reply.get("errors", ""))
+    sys.stdout.write(reply["output"])
+    return reply["status"]
+
+
+# ---------------------------------------------------------------------------
+# BATCH
+#
+# A batch manifest lists one operation per line, either as JSON objects
+# (JSONL) or as CSV with a header row.  The keys or columns are "operation"
+# plus the option names in request_option_names, for example:
+#   {"operation": "create_snapshot", "volume": "build123", "snapshot": "snap1"}
+# or
+#   operation,volume,snapshot
+#   create_snapshot,build123,snap1
+# ---------------------------------------------------------------------------
+
+def read_manifest(path):
+    # Returns a list of (line number, request dict) tuples.
+    with open(path) as manifest:
+        lines = manifest.read().splitlines()
+    entries = []
+    first = ""
+    for line in lines:
+        if line.strip():
+            first = line.strip()
+            break
+    if first.startswith("{"):
+        for number, line in enumerate(lines, 1):
+            if not line.strip() or line.lstrip().startswith("#"):
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError:
+                request = {"error": "Invalid JSON in batch manifest."}
+            if not isinstance(request, dict):
+                request = {"error": "Invalid JSON in batch manifest."}
+            entries.append((number, request))
     else:
-        print("Mirror not found.")
+        reader = csv.DictReader(lines)
+        for row in reader:
+            entries.append((reader.line_num, row))
+    return entries
 
 
-def delete_mirror(dst):
-    # First find the snapmirror relationship uuid.
-    sm_args = {
-        "destination.path": pyceRestConfig.ce_vserver + ":" + dst,
-        "destination.svm.name": pyceRestConfig.ce_vserver,
-    }
+async def batch_async(entries):
+    # Run the manifest entries on the engine and report each result as it
+    # completes.  Returns the number of failed entries.
+    import asyncio
+
+    async def run_entry(number, request):
+        return number, request, await run_request_async(request)
+
+    failed = 0
+    tasks = [run_entry(number, request) for number, request in entries]
+    for task in asyncio.as_completed(tasks):
+        number, request, reply = await task
+        if reply["status"] == 0:
+            result = "succeeded"
+        else:
+            result = "failed"
+            failed += 1
+        print("Line %d: %s %s in %.2fs" % \
+              (number, request.get("operation") or "", result, reply["seconds"]))
+        for line in reply["output"].splitlines():
+            print("    " + line)
+        sys.stderr.write(reply.get("errors", ""))
+    return failed
+
+
+def batch(manifest_path, workers):
+    try:
+        entries = read_manifest(manifest_path)
+    except (OSError, csv.Error) as error:
+        print("Error reading batch manifest: " + str(error))
+        return False
+    print("Running " + str(len(entries)) + " operations from " + manifest_path + \
+          " with " + str(workers) + " workers.")
+    print("")
+
+    # Run the operations on the async engine, whose workers all share the
+    # one connection.
+    capture_thread_output()
+    set_engine_workers(workers)
+    start = time.time()
+    failed = run_loop(batch_async(entries))
+    elapsed = time.time() - start
+
+    # Print the throughput summary.
+    rate = 0
+    if elapsed > 0:
+        rate = len(entries) / elapsed
+    print("")
+    print("Batch complete: %d operations, %d succeeded, %d failed in %.2fs (%.1f operations/sec)." % \
+          (len(entries), len(entries) - failed, failed, elapsed, rate))
+    return failed == 0
+
+
+# ---------------------------------------------------------------------------
+# RECONCILE
+#
+# "-o reconcile -f state.yaml" makes the SVM match a desired state file,
+# which lists volumes, clones and mirrors with the same keys as a batch
+# manifest:
+#
+#   volumes:
+#     - {volume: build123, junction: /builds/build123, template: scratch,
+#        snapshots: [nightly]}
+#   clones:
+#     - {clone: ci_1, volume: build123, snapshot: nightly, junction: /ci/ci_1}
+#   mirrors:
+#     - {volume: build123, mirror: build123_mirror}
+#
+# The current state of the named objects is read with a few bulk queries (100
+# names per query), and only the missing or different ones are changed:
+# create_volume, remount_volume, create_snapshot, create_clone and
+# create_mirror (with its DP volume and first transfer).  The snapshot a
+# clone is made from is created if it is missing, and a new volume or clone
+# without a junction is mounted at /<name>.  Nothing is ever deleted.
+# The changes run workers at a time, each as soon as the changes it depends
+# on are done, so an SVM that already matches the file gets no mutating
+# calls at all.  JSON files need nothing else, YAML files need PyYAML.
+# ---------------------------------------------------------------------------
+
+def load_desired_state(path):
+    # Returns the volumes, clones and mirrors lists of a desired state file.
+    # Raises ValueError if it cannot be parsed or is missing a key.
+    with open(path) as state_file:
+        text = state_file.read()
+    if path.endswith(".json") or text.lstrip().startswith("{"):
+        state = json.loads(text)
+    else:
+        try:
+            import yaml
+        except ImportError:
+            raise ValueError("PyYAML is needed to read " + path + ", use a JSON file instead.")
+        try:
+            state = yaml.safe_load(text)
+        except yaml.YAMLError as error:
+            raise ValueError(str(error))
+    if not isinstance(state, dict):
+        raise ValueError("The desired state must be a mapping of volumes, clones and mirrors.")
+    lists = []
+    for kind, keys in [("volumes", ["volume"]), ("clones", ["clone", "volume", "snapshot"]),
+                       ("mirrors", ["volume", "mirror"])]:
+        entries = state.get(kind) or []
+        for entry in entries:
+            if not isinstance(entry, dict) or any(not entry.get(key) for key in keys):
+                raise ValueError("Every entry of " + kind + " needs " + ", ".join(keys) + ".")
+        lists.append(entries)
+    return lists
+
+
+def chunks(names, size=100):
+    names = sorted(set(names))
+    for start in range(0, len(names), size):
+        yield names[start:start + size]
+
+
+def current_state(volume_names, snapshot_volumes, mirror_names):
+    # Returns the current volumes (a dict of name to record), snapshots (a
+    # set of (volume, snapshot) tuples) and mirrors (a dict of destination
+    # to source volume name) for the given names.
+    from netapp_ontap.resources import Volume as NaVolume
+    from netapp_ontap.resources import Snapshot as NaSnapshot
+    from netapp_ontap.resources import SnapmirrorRelationship as NaSnapmirrorRelationship
+
+    vserver = current_vserver()
+    volumes = {}
+    for names in chunks(volume_names):
+        volume_args = {
+            "svm.name": vserver,
+            "name": "|".join(names),
+            "fields": "name,uuid,type,nas.path,clone.parent_volume.name",
+        }
+        for volume in collection_records(NaVolume, **volume_args):
+            volumes[volume["name"]] = volume
+            uuid_cache_put("volume", volume["name"], volume["uuid"])
+    snapshots = set()
+    for names in chunks(name for name in snapshot_volumes if name in volumes):
+        snapshot_args = {
+            "svm.name": vserver,
+            "volume.name": "|".join(names),
+            "fields": "volume.name,name",
+        }
+        for snapshot in collection_records(NaSnapshot, "*", **snapshot_args):
+            snapshots.add((snapshot["volume"]["name"], snapshot["name"]))
+    mirrors = {}
+    for names in chunks(mirror_names):
+        sm_args = {
+            "destination.path": "|".join(vserver + ":" + name for name in names),
+            "destination.svm.name": vserver,
+            "fields": "uuid,source.path,destination.path",
+        }
+        for mirror in collection_records(NaSnapmirrorRelationship, **sm_args):
+            dst = mirror["destination"]["path"].split(":", 1)[-1]
+            mirrors[dst] = record_value(mirror, "source.path", "").split(":", 1)[-1]
+            uuid_cache_put("mirror", dst, mirror["uuid"])
+    return volumes, snapshots, mirrors
+
+
+def reconcile_plan(desired_volumes, desired_clones, desired_mirrors):
+    # Compare the desired state with the current one.  Returns a list of
+    # changes, each a (key, description, function, keys it depends on)
+    # tuple, and a list of conflicts that need a person to look at them.
+    snapshot_volumes = [entry["volume"] for entry in desired_volumes if entry.get("snapshots")]
+    snapshot_volumes += [entry["clone"] for entry in desired_clones if entry.get("snapshots")]
+    snapshot_volumes += [entry["volume"] for entry in desired_clones]
+    volumes, snapshots, mirrors = current_state(
+        [entry["volume"] for entry in desired_volumes] +
+        [entry["clone"] for entry in desired_clones] +
+        [entry["volume"] for entry in desired_clones] +
+        [entry["volume"] for entry in desired_mirrors] +
+        [entry["mirror"] for entry in desired_mirrors],
+        snapshot_volumes, [entry["mirror"] for entry in desired_mirrors])
+
+    changes = collections.OrderedDict()
+    conflicts = []
+    desired_names = set([entry["volume"] for entry in desired_volumes] +
+                        [entry["clone"] for entry in desired_clones])
+
+    def change(key, description, function, needs=()):
+        if key not in changes:
+            changes[key] = (key, description, function, list(needs))
+
+    def exists(name):
+        # Whether a volume exists or is in the desired state.
+        return name in volumes or name in desired_names
+
+    def ensure_junction(name, junction_path):
+        current = record_value(volumes[name], "nas.path", None)
+        if junction_path and current != junction_path:
+            change(("remount", name), "remount_volume %s %s (was %s)" % \
+                   (name, junction_path, current or "unmounted"),
+                   functools.partial(remount_volume, name, junction_path))
+
+    def ensure_snapshot(volume_name, snapshot_name):
+        if (volume_name, snapshot_name) not in snapshots:
+            change(("snapshot", volume_name, snapshot_name),
+                   "create_snapshot %s %s" % (volume_name, snapshot_name),
+                   functools.partial(create_snapshot, volume_name, snapshot_name),
+                   [("volume", volume_name)])
+
+    for entry in desired_volumes:
+        name = entry["volume"]
+        if name in volumes:
+            ensure_junction(name, entry.get("junction"))
+        else:
+            junction_path = entry.get("junction") or "/" + name
+            change(("volume", name), "create_volume %s %s" % (name, junction_path),
+                   functools.partial(create_volume, name, junction_path, "rw",
+                                     entry.get("template")))
+    for entry in desired_clones:
+        name, parent = entry["clone"], entry["volume"]
+        if name in volumes:
+            current = record_value(volumes[name], "clone.parent_volume.name", None)
+            if current != parent:
+                conflicts.append("Volume %s exists, but is not a clone of %s." % (name, parent))
+            ensure_junction(name, entry.get("junction"))
+            continue
+        if not exists(parent):
+            conflicts.append("Parent volume %s of clone %s does not exist." % (parent, name))
+            continue
+        ensure_snapshot(parent, entry["snapshot"])
+        junction_path = entry.get("junction") or "/" + name
+        change(("volume", name), "create_clone %s of %s %s %s" % \
+               (name, parent, entry["snapshot"], junction_path),
+               functools.partial(create_clone, parent, name, entry["snapshot"], junction_path),
+               [("volume", parent), ("snapshot", parent, entry["snapshot"])])
+    for entry in desired_volumes + desired_clones:
+        name = entry.get("clone") or entry["volume"]
+        if exists(name):
+            for snapshot_name in entry.get("snapshots") or []:
+                ensure_snapshot(name, snapshot_name)
+    for entry in desired_mirrors:
+        src, dst = entry["volume"], entry["mirror"]
+        if dst in mirrors:
+            if mirrors[dst] != src:
+                conflicts.append("Mirror %s exists, but its source is %s, not %s." % \
+                                 (dst, mirrors[dst], src))
+            continue
+        if not exists(src):
+            conflicts.append("Source volume %s of mirror %s does not exist." % (src, dst))
+            continue
+        if dst in volumes:
+            if volumes[dst].get("type") not in (None, "dp"):
+                conflicts.append("Mirror destination %s is not a DP volume." % dst)
+                continue
+        else:
+            change(("volume", dst), "create_volume %s (DP)" % dst,
+                   functools.partial(create_volume, dst, "", "dp"))
+
+        def create_and_update(src=src, dst=dst):
+            create_mirror(src, dst)
+            update_mirror(dst)
+
+        change(("mirror", dst), "create_mirror %s of %s" % (dst, src), create_and_update,
+               [("volume", src), ("volume", dst)])
+    return list(changes.values()), conflicts
+
+
+def apply_changes(changes, workers):
+    # Run the changes workers at a time, each once the changes it depends on
+    # have succeeded.  Changes that depend on a failed change are skipped.
+    # Returns the number of changes applied.
+    import concurrent.futures
+
+    def run(function):
+        # Returns what the change printed, which is printed in one piece once
+        # it finishes, and the exception that it failed with, if any.
+        output = io.StringIO()
+        sys.stdout.local.buffer = output
+        error = None
+        try:
+            with measure_operation("reconcile", run=False):
+                with blocking_jobs():
+                    function()
+        except Exception as exception:
+            error = exception
+        finally:
+            sys.stdout.local.buffer = None
+        return output.getvalue(), error
+
+    planned = set(change[0] for change in changes)
+    pending = list(changes)
+    done = set()
+    failed = set()
+    running = {}
+    capture_thread_output()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            waiting = []
+            for key, description, function, needs in pending:
+                needs = [need for need in needs if need in planned]
+                if any(need in failed for need in needs):
+                    print("Skipping " + description + ", as a change it needs failed.")
+                    failed.add(key)
+                elif all(need in done for need in needs):
+                    running[executor.submit(run, function)] = (key, description)
+                else:
+                    waiting.append((key, description, function, needs))
+            pending = waiting
+            if not running:
+                break
+            finished, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                key, description = running.pop(future)
+                output, error = future.result()
+                sys.stdout.write(output)
+                if error is not None:
+                    print("Error in " + description + ": " + str(error))
+                    failed.add(key)
+                    continue
+                done.add(key)
+    return len(done)
+
+
+def reconcile(path, workers, dry_run=False):
+    from netapp_ontap.error import NetAppRestError
+
+    try:
+        desired_volumes, desired_clones, desired_mirrors = load_desired_state(path)
+    except (OSError, ValueError) as error:
+        print("Error reading desired state: " + str(error))
+        return False
+    print("Reconciling %d volumes, %d clones and %d mirrors from %s" % \
+          (len(desired_volumes), len(desired_clones), len(desired_mirrors), path))
+
+    start = time.time()
     try:
-        mirror = NaSnapmirrorRelationship.find(fields="uuid", **sm_args)
+        changes, conflicts = reconcile_plan(desired_volumes, desired_clones, desired_mirrors)
     except NetAppRestError:
-        print("Error finding mirror volume!")
+        print("Error reading the current state!")
         raise
+    for conflict in conflicts:
+        print("Conflict: " + conflict)
+    if not changes:
+        if conflicts:
+            print("Nothing to change, but %d conflicts to resolve (%.2fs)." % \
+                  (len(conflicts), time.time() - start))
+            return False
+        print("Nothing to change, the SVM matches %s (%.2fs)." % (path, time.time() - start))
+        return True
+    print("%d changes needed:" % len(changes))
+    for key, description, function, needs in changes:
+        print("  " + description)
+    if dry_run:
+        return not conflicts
 
-    # If we found the relationshp, delete it.
-    if mirror:
-        print("Deleting mirror " + dst)
-        try:
-            mirror.delete()
-        except NetAppRestError:
-            print("Error deleting mirror!")
-            raise
-        print("Mirror deleted.")
-    else:
-        print("Mirror not found.")
+    applied = apply_changes(changes, workers)
+    print("Applied %d of %d changes in %.2fs." % (applied, len(changes), time.time() - start))
+    return applied == len(changes) and not conflicts
 
 
 def help_text():
@@ -481,17 +4166,30 @@ def help_text():
   The following operation types are supported:
     list_volumes
     create_volume
+    create_volumes
     delete_volume
     remount_volume
     list_snapshots
     create_snapshot
     delete_snapshot
+    prune_snapshots
     list_clones
     create_clone
+    create_clones
+    checkout_clone
+    return_clone
+    fill_pool
+    pool_status
     list_mirrors
     create_mirror
     update_mirror
+    update_mirrors
     delete_mirror
+    capacity_report
+    reconcile
+    serve
+    batch
+    wait_jobs
 
   Examples
     List all volumes with the string "build" in them:
@@ -500,6 +4198,13 @@ def help_text():
     Create a new volume named "build123" with a junction-path of "/builds/build123":
     %> pyce_rest.py -o create_volume -v build123 -j /builds/build123
 
+    Create a volume from the "scratch" template in ce_volume_templates:
+    %> pyce_rest.py -o create_volume -v build124 -j /builds/build124 --template scratch
+
+    Create 50 volumes named "home_1" to "home_50" from the "home" template,
+    16 at a time, mounted under "/home":
+    %> pyce_rest.py -o create_volumes -v home_{n} -n 50 -j /home/{name} --template home --workers 16
+
     Delete a volume or a clone named "build123":
     %> pyce_rest.py -o delete_volume -v build123 
 
@@ -522,6 +4227,29 @@ def help_text():
     snapshot "snap1", and use a junction-path of "/builds/build123_clone":
     %> pyce_rest.py -o create_clone -c build123_clone -v build123 -s snap1 -j /builds/build123_clone
 
+    Create 200 clones named "test_1" to "test_200" from volume "build123",
+    using snapshot "snap1", 32 at a time, mounted under "/tests":
+    %> pyce_rest.py -o create_clones -v build123 -s snap1 -n 200 -c test_{n} -j /tests/{name} --workers 32
+
+    Fill the "ci" clone pool from ce_clone_pools, then check out one of its
+    clones as "ci_job42" at "/ci/job42", and delete it when done:
+    %> pyce_rest.py -o fill_pool --pool ci
+    %> pyce_rest.py -o checkout_clone --pool ci -c ci_job42 -j /ci/job42
+    %> pyce_rest.py -o return_clone --pool ci -c ci_job42
+
+    List every clone of volume "build123", and the clones of those clones,
+    or only those made from its snapshot "snap1":
+    %> pyce_rest.py -o list_clones -v build123
+    %> pyce_rest.py -o list_clones -v build123 -s snap1
+
+    Delete volume "build123" after deleting its clone tree leaf first, each
+    level 16 clones at a time (show what would be deleted with --dry-run):
+    %> pyce_rest.py -o delete_volume -v build123 --recursive --dry-run
+    %> pyce_rest.py -o delete_volume -v build123 --recursive --workers 16
+
+    Show the ready clones and hit rate of every clone pool:
+    %> pyce_rest.py -o pool_status
+
     List snapmirror relationships:
     %> pyce_rest.py -o list_mirrors
 
@@ -531,8 +4259,75 @@ def help_text():
     Update snapmirror relationship:
     %> pyce_rest.py -o update_mirror -m build123_mirror
 
+    Update every snapmirror relationship whose destination starts with "dr_",
+    8 transfers at a time, and wait for the transfers to finish:
+    %> pyce_rest.py -o update_mirrors -m "dr_*" --workers 8 --wait
+
+    Update a list of snapmirror relationships:
+    %> pyce_rest.py -o update_mirrors -m build123_mirror,build124_mirror
+
     Delete snapmirror relationship:
     %> pyce_rest.py -o delete_mirror -m build123_mirror
+
+    Make the SVM match the volumes, clones, snapshots and mirrors listed in
+    a YAML or JSON file, creating or remounting only what differs (show the
+    changes first with --dry-run):
+    %> pyce_rest.py -o reconcile -f build_env.yaml --dry-run
+    %> pyce_rest.py -o reconcile -f build_env.yaml --workers 16
+
+    Start a daemon that keeps the ONTAP connection warm, then send an
+    operation to it from a client invocation:
+    %> pyce_rest.py -o serve
+    %> pyce_rest.py --client -o list_volumes -v build
+
+    Run the operations listed in a JSONL or CSV manifest, 16 at a time:
+    %> pyce_rest.py -o batch -f nightly.jsonl --workers 16
+
+    Submit the jobs of every operation in a manifest first, then wait for
+    all of them together:
+    %> pyce_rest.py -o batch -f nightly.jsonl --no-wait
+
+    Create a snapshot without waiting for its job, then wait for the job:
+    %> pyce_rest.py -o create_snapshot -v build123 -s snap1 --no-wait
+    %> pyce_rest.py -o wait_jobs --jobs 1cd8a442-86d1-11e0-ae1c-123478563412
+
+    List the snapshots of every volume whose name starts with "build",
+    oldest first, or of every volume in the SVM:
+    %> pyce_rest.py -o list_snapshots -v "build*" --sort age
+    %> pyce_rest.py -o list_snapshots -v "*" --sort volume --format csv
+
+    Show which "ci_" snapshots of the "build" volumes are older than 7 days,
+    keeping the newest 3 of each volume, then delete them 16 at a time.
+    Snapshots without a create time are never pruned, and are listed as
+    kept:
+    %> pyce_rest.py -o prune_snapshots -v "build*" --match "^ci_" --keep 3 --max-age 7d --dry-run
+    %> pyce_rest.py -o prune_snapshots -v "build*" --match "^ci_" --keep 3 --max-age 7d --workers 16
+
+    Watch snapmirror relationships and print state and transfer changes,
+    with transfer rates and lag trends:
+    %> pyce_rest.py -o list_mirrors --watch
+
+    List the "build" volumes of every cluster and SVM in ce_targets, or of
+    the "east" and "west" targets, as one list tagged with cluster and SVM:
+    %> pyce_rest.py -o list_volumes -v build --targets all
+    %> pyce_rest.py -o list_volumes -v build --targets east,west --format csv
+
+    Create a volume on the "west" target instead of ce_cluster/ce_vserver:
+    %> pyce_rest.py -o create_volume -v build125 -j /builds/build125 --targets west
+
+    Report the total and used space of the SVM, the utilization percentiles,
+    the 10 largest and fullest volumes and the space used per name prefix:
+    %> pyce_rest.py -o capacity_report
+
+    Report on the "build" and "ci" volumes, with the 20 largest and fullest
+    of them, as JSON:
+    %> pyce_rest.py -o capacity_report -n 20 --prefixes "build*,ci_*" --format json
+
+    List volumes as one JSON object per line, with sizes in bytes:
+    %> pyce_rest.py -o list_volumes -v build --format ndjson
+
+    Show where the time of an operation goes, and keep a cProfile dump:
+    %> pyce_rest.py -o list_snapshots -v build123 --stats --profile snap.prof
 """
 
     return help_text
@@ -541,146 +4336,245 @@ def help_text():
 # MAIN
 # ---------------------------------------------------------------------------
 
-# Parse CLI options
-help_text = help_text()
-OptionParser.format_epilog = lambda self, formatter: self.epilog
-parser = OptionParser(epilog=help_text, version=version)
-parser.add_option("-o", dest="operation", help="operation type (see below)")
-parser.add_option("-v", dest="volume", help="volume name")
-parser.add_option("-j", dest="junction", help="junction path")
-parser.add_option("-s", dest="snapshot", help="snapshot name")
-parser.add_option("-c", dest="clone", help="clone name")
-parser.add_option("-m", dest="mirror", help="snapmirror destination volume name")
-parser.add_option("-d", dest="debug", action="store_true", help="debug mode")
-(options, args) = parser.parse_args()
-
-# Check for a valid operation type.
-op = options.operation
-operations = ["list_volumes","create_volume","delete_volume","remount_volume",
-              "list_snapshots","create_snapshot","delete_snapshot",
-              "list_clones","create_clone",
-              "list_mirrors", "create_mirror","update_mirror","delete_mirror",
-             ]
-if not op:
-    print("No operation type given.")
-    print("Use -h to see usage and examples.")
-    sys.exit(2)
-if op not in operations:
-    print("Invalid operation type: " + op)
-    print("Use -h to see usage and examples.")
-    sys.exit(2)
-
-# Make sure we have the required arguments for each operation
-if op == "list_volumes" or op == "delete_volume" or op == "list_snapshots":
-    if not options.volume:
-        print("Missing volume name for op: " + op)
-        print("Use -h to see usage and examples.")
-        sys.exit(2)
-if op == "create_volume" or op == "remount_volume":
-    if not options.volume:
-        print("Missing volume name for op: " + op)
-        print("Use -h to see usage and examples.")
-        sys.exit(2)
-    if not options.junction:
-        print("Missing junction path for op: " + op)
-        print("Use -h to see usage and examples.")
-        sys.exit(2)
-if op == "create_snapshot" or op == "delete_snapshot":
-    if not options.volume:
-        print("Missing volume name for op: " + op)
-        print("Use -h to see usage and examples.")
-        sys.exit(2)
-    if not options.snapshot:
-        print("Missing snapshot name for op: " + op)
-        print("Use -h to see usage and examples.")
-        sys.exit(2)
-if op == "list_clones":
-    if not options.clone:
-        print("Missing clone name for op: " + op)
-        print("Use -h to see usage and examples.")
-        sys.exit(2)
-if op == "create_clone":
-    if not options.volume:
-        print("Missing volume name for op: " + op)
-        print("Use -h to see usage and examples.")
-        sys.exit(2)
-    if not options.snapshot:
-        print("Missing snapshot name for op: " + op)
-        print("Use -h to see usage and examples.")
-        sys.exit(2)
-    if not options.clone:
-        print("Missing clone name for op: " + op)
-        print("Use -h to see usage and examples.")
-        sys.exit(2)
-    if not options.junction:
-        print("Missing junction path for op: " + op)
-        print("Use -h to see usage and examples.")
-        sys.exit(2)
-if op == "create_mirror":
-    if not options.volume:
-        print("Missing volume name for op: " + op)
-        print("Use -h to see usage and examples.")
-        sys.exit(2)
-    if not options.mirror:
-        print("Missing mirror volume for op: " + op)
+def main():
+    # Parse CLI options
+    epilog = help_text()
+    default_workers = config_option("ce_workers", 8)
+    default_interval = config_option("ce_watch_interval", 5)
+    OptionParser.format_epilog = lambda self, formatter: self.epilog
+    parser = OptionParser(epilog=epilog, version=version)
+    parser.add_option("-o", dest="operation", help="operation type (see below)")
+    parser.add_option("-v", dest="volume", help="volume name")
+    parser.add_option("-j", dest="junction", help="junction path")
+    parser.add_option("-s", dest="snapshot", help="snapshot name")
+    parser.add_option("-c", dest="clone", help="clone name")
+    parser.add_option("-m", dest="mirror", help="snapmirror destination volume name")
+    parser.add_option("-d", dest="debug", action="store_true", help="debug mode")
+    parser.add_option("--pool", dest="pool", help="clone pool from ce_clone_pools")
+    parser.add_option("-n", dest="count", type="int",
+                      help="number of clones or volumes, or of top volumes in "
+                           "capacity_report")
+    parser.add_option("--prefixes", dest="prefixes",
+                      help="comma separated volume name patterns that "
+                           "capacity_report rolls up, such as build*")
+    parser.add_option("--template", dest="template",
+                      help="volume template from ce_volume_templates")
+    parser.add_option("-f", dest="manifest",
+                      help="batch manifest file (JSONL or CSV), or reconcile "
+                           "desired state file (YAML or JSON)")
+    parser.add_option("--workers", dest="workers", type="int", default=default_workers,
+                      help="number of operations to run concurrently")
+    parser.add_option("--no-wait", dest="no_wait", action="store_true",
+                      help="submit jobs without waiting for them to finish")
+    parser.add_option("--wait", dest="wait", action="store_true",
+                      help="with update_mirrors, wait for the transfers to finish")
+    parser.add_option("--jobs", dest="jobs", help="comma separated job uuids")
+    parser.add_option("--client", dest="client", action="store_true",
+                      help="forward the operation to a running pyce_rest daemon")
+    parser.add_option("--socket", dest="socket",
+                      help="unix socket path of the pyce_rest daemon")
+    parser.add_option("--format", dest="format",
+                      help="output format of list operations: table (default), "
+                           "json, ndjson or csv")
+    parser.add_option("--keep", dest="keep", type="int",
+                      help="prune_snapshots keeps this many of the newest snapshots")
+    parser.add_option("--max-age", dest="max_age",
+                      help="prune_snapshots deletes snapshots older than this, "
+                           "such as 12h or 7d")
+    parser.add_option("--match", dest="match",
+                      help="prune_snapshots only considers snapshot names "
+                           "matching this regex")
+    parser.add_option("--per-volume", dest="per_volume", type="int", default=1,
+                      help="number of concurrent snapshot deletes per volume")
+    parser.add_option("--dry-run", dest="dry_run", action="store_true",
+                      help="print the snapshots prune_snapshots would delete, "
+                           "the clones delete_volume --recursive would delete, or "
+                           "the changes reconcile would make")
+    parser.add_option("--recursive", dest="recursive", action="store_true",
+                      help="with delete_volume, delete the clones of the volume "
+                           "(and their clones) first")
+    parser.add_option("--sort", dest="sort",
+                      help="sort list_snapshots by age or by volume")
+    parser.add_option("--watch", dest="watch", action="store_true",
+                      help="keep polling list_mirrors and print changes, "
+                           "in the table, ndjson or csv format")
+    parser.add_option("--interval", dest="interval", type="float",
+                      default=default_interval,
+                      help="seconds between list_mirrors --watch polls while "
+                           "transfers are running")
+    parser.add_option("--targets", dest="targets",
+                      help="comma separated names of ce_targets, or all, to "
+                           "run a list operation on")
+    parser.add_option("--page-size", dest="page_size", type="int",
+                      help="number of records per page for list operations, "
+                           "0 for the cluster default")
+    parser.add_option("--stats", dest="stats", action="store_true",
+                      help="print REST call and timing statistics to stderr")
+    parser.add_option("--metrics-file", dest="metrics_file",
+                      default=config_option("ce_metrics_file", None),
+                      help="write metrics as JSON, or as a Prometheus textfile "
+                           "if the name ends in .prom")
+    parser.add_option("--profile", dest="profile",
+                      help="write a cProfile dump of the run to this file")
+    (options, args) = parser.parse_args()
+
+    # Check for a valid operation type.
+    op = options.operation
+    if not op:
+        print("No operation type given.")
         print("Use -h to see usage and examples.")
         sys.exit(2)
-if op == "update_mirror" or op == "delete_mirror":
-    if not options.mirror:
-        print("Missing mirror volume for op: " + op)
+
+    # Make sure we have the required arguments for the operation.
+    error = check_options(op, options)
+    if not error and options.page_size is not None and options.page_size < 0:
+        error = "Invalid page size: " + str(options.page_size)
+    if not error and options.watch and op == "list_mirrors" and not options.interval > 0:
+        error = "Invalid watch interval: " + str(options.interval)
+    # A JSON array is only complete at the end, and a watch never ends.
+    if not error and options.watch and options.format == "json":
+        error = "The json format cannot be used with --watch, use ndjson or csv."
+    targets = None
+    if not error and options.targets:
+        targets, unknown = select_targets(options.targets)
+        if unknown is not None:
+            error = "Unknown target: " + unknown
+        elif not targets:
+            error = "No targets in ce_targets."
+        elif options.client:
+            error = "Targets cannot be used in client mode."
+        elif len(targets) > 1 and (op not in target_operations or options.watch):
+            error = "Only list operations can run on several targets."
+    if error:
+        print(error)
         print("Use -h to see usage and examples.")
         sys.exit(2)
 
-# If we get here, everything should be OK
-
-# Setup the REST API connection to ONTAP.
-# Using verify=False to ignore that we may see self-signed SSL certificates.
-NaConfig.CONNECTION = NaHostConnection(
-    host = pyceRestConfig.ce_cluster,
-    username = pyceRestConfig.ce_user,
-    password = pyceRestConfig.ce_passwd,
-    verify = False,
-    poll_timeout = 120,
-)
-
-# Call the requested operation
-if op == "list_volumes":
-    list_volumes(options.volume)
+    # If we get here, everything should be OK
 
-if op == "create_volume":
-    create_volume(options.volume, options.junction, "rw")
+    # In client mode the daemon does all of the work for us.
+    socket_path = options.socket or daemon_socket_path()
+    if options.client:
+        if op in driver_operations or options.recursive:
+            print("The " + op + " operation cannot be run in client mode.")
+            sys.exit(2)
+        # These set up the daemon's own connection and reporting, so they
+        # belong on the serve command line.  A watch never finishes, so it
+        # cannot be a daemon request either.
+        daemon_options = [("--no-wait", options.no_wait),
+                          ("--page-size", options.page_size is not None),
+                          ("--stats", options.stats),
+                          ("--workers", options.workers != default_workers),
+                          ("--watch", options.watch),
+                          ("--interval", options.interval != default_interval)]
+        for name, given in daemon_options:
+            if given:
+                print("The " + name + " option cannot be used in client mode.")
+                sys.exit(2)
+        sys.exit(forward_to_daemon(socket_path, op, options))
 
-if op == "delete_volume":
-    delete_volume(options.volume)
+    if options.page_size is not None:
+        pyceRestConfig.ce_page_size = options.page_size
 
-if op == "remount_volume":
-    remount_volume(options.volume, options.junction)
+    # An operation on one target works on it as if it were the cluster and
+    # SVM of the config.
+    if targets and len(targets) == 1:
+        use_target(targets[0])
+        targets = None
 
-if op == "list_snapshots":
-    list_snapshots(options.volume)
-   
-if op == "create_snapshot":
-    create_snapshot(options.volume, options.snapshot)
+    # Setup the REST API connection to ONTAP.
+    connect(options.workers)
+    if options.no_wait:
+        job_state["poller"] = JobPoller()
 
-if op == "delete_snapshot":
-    delete_snapshot(options.volume, options.snapshot)
+    profile = None
+    if options.profile:
+        profile = cProfile.Profile()
+        profile.enable()
 
-if op == "list_clones":
-    list_clones(options.clone)
-
-if op == "create_clone":
-    create_clone(options.volume, options.clone, options.snapshot, options.junction)
-
-if op == "list_mirrors":
-    list_mirrors()
-
-if op == "create_mirror":
-    create_volume(options.mirror, "", "dp")
-    create_mirror(options.volume, options.mirror)
-    update_mirror(options.mirror)
+    # Call the requested operation
+    try:
+        if op == "serve":
+            serve(socket_path)
+        elif op == "batch":
+            # With --no-wait the batch submits every job first, then waits for
+            # all of them together.
+            with measure_operation(op):
+                if not batch(options.manifest, options.workers):
+                    sys.exit(1)
+                if options.no_wait and not wait_jobs(job_state["poller"]):
+                    sys.exit(1)
+        elif op == "wait_jobs":
+            poller = JobPoller()
+            for job in options.jobs.split(","):
+                poller.add(job.strip(), None)
+            with measure_operation(op):
+                if not wait_jobs(poller):
+                    sys.exit(1)
+        elif targets:
+            output_local.format = options.format
+            with measure_operation(op):
+                if run_targets(op, options, targets, options.workers):
+                    sys.exit(1)
+        elif op == "list_mirrors" and options.watch:
+            # Watching runs on this thread, so that Ctrl-C stops it.
+            output_local.format = options.format
+            with measure_operation(op):
+                watch_mirrors(options.interval)
+        elif op == "prune_snapshots":
+            max_age = None
+            if options.max_age:
+                max_age = parse_age(options.max_age)
+            output_local.format = options.format
+            with measure_operation(op):
+                if not prune_snapshots(options.volume, options.keep, max_age,
+                                       options.match, options.dry_run,
+                                       options.workers, options.per_volume):
+                    sys.exit(1)
+        elif op == "delete_volume" and options.recursive:
+            with measure_operation(op):
+                if not delete_volume_tree(options.volume, options.workers, options.dry_run):
+                    sys.exit(1)
+        elif op == "reconcile":
+            with measure_operation(op):
+                if not reconcile(options.manifest, options.workers, options.dry_run):
+                    sys.exit(1)
+        elif op == "update_mirrors":
+            with measure_operation(op):
+                if not update_mirrors(options.mirror, options.workers, options.wait):
+                    sys.exit(1)
+        elif op == "create_volumes":
+            with measure_operation(op):
+                if not create_volumes(options.volume, options.junction, options.count,
+                                      options.template, options.workers):
+                    sys.exit(1)
+        elif op == "create_clones":
+            with measure_operation(op):
+                if not create_clones(options.volume, options.snapshot, options.count,
+                                     options.clone, options.junction, options.workers):
+                    sys.exit(1)
+        else:
+            set_engine_workers(options.workers)
+            if run_loop(run_operation_async(op, options)) is False:
+                sys.exit(1)
+    except BrokenPipeError:
+        # The reader of our output, such as "head", has gone away.  Point
+        # stdout at /dev/null so that the final flush does not fail too.
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        sys.exit(1)
+    finally:
+        # Report even when the operation failed.
+        if profile:
+            profile.disable()
+            profile.dump_stats(options.profile)
+        if options.stats or options.metrics_file:
+            report = metrics_report()
+            if options.stats:
+                print_stats(report)
+            if options.metrics_file:
+                write_metrics(options.metrics_file, report)
 
-if op == "update_mirror":
-    update_mirror(options.mirror)
 
-if op == "delete_mirror":
-    delete_mirror(options.mirror)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+################################################################################
+#
+# Regression tests for pyce_rest
+#
+# Each test runs pyce_rest.py as its own process against an in-process
+# pyce_mock server, as pyce_bench.py does, and checks the REST calls that
+# the mock saw.
+#
+# Run "python3 -m pytest test_pyce_rest.py" or "python3 test_pyce_rest.py".
+#
+################################################################################
+
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+import concurrent.futures
+
+import pyce_mock
+import pyce_bench
+
+# Volumes and clones in the mock, and records per page.  Neither count is a
+# multiple of the page size, so the last page is a short one.
+volume_count = 250
+clone_count = 230
+page_size = 100
+
+
+def pages(count):
+    return (count + page_size - 1) // page_size
+
+
+class ListQueryTest(unittest.TestCase):
+    # list_volumes and list_clones must fetch their records and fields with
+    # one collection query per page, not one request per volume.
+    @classmethod
+    def setUpClass(cls):
+        cls.server = pyce_mock.start(volumes=volume_count, snapshots=1,
+                                     clones=clone_count, mirrors=0)
+        cls.directory = tempfile.mkdtemp(prefix="pyce_test.")
+        pyce_bench.write_config(cls.directory, cls.server.server_address[1],
+                                page_size=page_size)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        shutil.rmtree(cls.directory)
+
+    def run_operation(self, *args):
+        # Returns the output lines of a pyce_rest.py run and the calls that
+        # the mock saw, by endpoint.
+        self.server.cluster.reset_stats()
+        process = subprocess.run([sys.executable, "-c", pyce_bench.runner] + list(args),
+                                 cwd=self.directory, stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE)
+        self.assertEqual(process.returncode, 0, process.stderr.decode("utf-8", "replace"))
+        stats = self.server.cluster.stats_dict()
+        return process.stdout.decode("utf-8").splitlines(), stats["endpoints"]
+
+    def test_list_volumes(self):
+        lines, endpoints = self.run_operation("-o", "list_volumes", "-v", "vol")
+        self.assertEqual(len(lines), volume_count + 4)
+        self.assertEqual(endpoints, {"GET /api/storage/volumes": pages(volume_count)})
+
+    def test_list_clones(self):
+        lines, endpoints = self.run_operation("-o", "list_clones", "-c", "clone")
+        self.assertEqual(len(lines), clone_count + 4)
+        self.assertEqual(endpoints, {"GET /api/storage/volumes": pages(clone_count)})
+
+
+
+class UuidCacheTest(unittest.TestCase):
+    # A volume renamed outside of pyce_rest must not send an operation on its
+    # old name to another volume through a cached uuid.
+    @classmethod
+    def setUpClass(cls):
+        cls.server = pyce_mock.start(volumes=5, snapshots=2, clones=0, mirrors=0)
+        cls.directory = tempfile.mkdtemp(prefix="pyce_test.")
+        pyce_bench.write_config(cls.directory, cls.server.server_address[1],
+                                settings=["ce_uuid_cache_ttl = 3600"])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        shutil.rmtree(cls.directory)
+
+    run_operation = ListQueryTest.run_operation
+
+    def rename(self, old, new):
+        cluster = self.server.cluster
+        with cluster.lock:
+            volume = cluster.find_volume({"name": old})
+            cluster.patch_volume(volume, {"name": new})
+            return volume["uuid"]
+
+    def snapshot_names(self, uuid):
+        return [snapshot["name"] for snapshot in self.server.cluster.snapshots[uuid].values()]
+
+    def test_renamed_volume(self):
+        # Warm the cache, then swap vol00003 in under the name vol00002.
+        self.run_operation("-o", "list_snapshots", "-v", "vol00002")
+        old_uuid = self.rename("vol00002", "vol00002_old")
+        new_uuid = self.rename("vol00003", "vol00002")
+
+        self.run_operation("-o", "delete_snapshot", "-v", "vol00002", "-s", "hourly.0")
+        self.assertNotIn("hourly.0", self.snapshot_names(new_uuid))
+        self.assertIn("hourly.0", self.snapshot_names(old_uuid))
+
+        self.run_operation("-o", "create_snapshot", "-v", "vol00002", "-s", "renamed")
+        self.assertIn("renamed", self.snapshot_names(new_uuid))
+        self.assertNotIn("renamed", self.snapshot_names(old_uuid))
+
+        lines, endpoints = self.run_operation("-o", "list_snapshots", "-v", "vol00002",
+                                              "--format", "csv")
+        self.assertEqual([line.split(",")[1] for line in lines[1:]],
+                         self.snapshot_names(new_uuid))
+
+        # With a good cache entry, a delete is a single DELETE plus its job.
+        lines, endpoints = self.run_operation("-o", "delete_snapshot", "-v", "vol00002",
+                                              "-s", "renamed")
+        self.assertNotIn("renamed", self.snapshot_names(new_uuid))
+        self.assertNotIn("GET /api/storage/volumes", endpoints)
+        self.assertEqual(endpoints["DELETE /api/storage/volumes/{uuid}/snapshots"], 1)
+
+
+
+
+class PoolCheckoutTest(unittest.TestCase):
+    # Two hosts, each with its own pool lock, checking out clones of the same
+    # pool at once must never both get the same clone.
+    @classmethod
+    def setUpClass(cls):
+        cls.server = pyce_mock.start(volumes=1, snapshots=1, clones=0, mirrors=0)
+        cls.directories = []
+        for host in range(2):
+            directory = tempfile.mkdtemp(prefix="pyce_test.")
+            pyce_bench.write_config(directory, cls.server.server_address[1])
+            cls.directories.append(directory)
+        cls.directory = cls.directories[0]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        for directory in cls.directories:
+            shutil.rmtree(directory)
+
+    run_operation = ListQueryTest.run_operation
+
+    def checkout(self, directory, clone):
+        return subprocess.run([sys.executable, "-c", pyce_bench.runner, "-o", "checkout_clone",
+                               "--pool", "bench", "-c", clone, "-j", "/" + clone],
+                              cwd=directory, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def test_concurrent_checkouts(self):
+        self.run_operation("-o", "create_volume", "-v", "bench_vol", "-j", "/bench_vol")
+        self.run_operation("-o", "create_snapshot", "-v", "bench_vol", "-s", "bench_snap")
+        for attempt in range(3):
+            self.run_operation("-o", "fill_pool", "--pool", "bench")
+            clones = ["ci%d_%d" % (attempt, host) for host in range(2)]
+            with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+                processes = list(executor.map(self.checkout, self.directories, clones))
+            for process in processes:
+                self.assertEqual(process.returncode, 0)
+            names = [volume["name"] for volume in self.server.cluster.volumes.values()]
+            for clone in clones:
+                self.assertIn(clone, names)
+
+
+if __name__ == "__main__":
+    unittest.main()